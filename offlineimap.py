@@ -18,5 +18,7 @@
 
 from offlineimap import OfflineImap
 
-oi = OfflineImap()
-oi.run()
+# Processes started by multiprocessing import this file too.
+if __name__ == '__main__':
+    oi = OfflineImap()
+    oi.run()
@@ -16,16 +16,87 @@
 
 import os
 import re
+from functools import wraps
 from sys import exc_info
 from configparser import ConfigParser, Error
 from offlineimap.localeval import LocalEval
 
 
+def _cachedlookup(method):
+    """Caches the values returned by method, a lookup of an option, until
+    the configuration is changed.
+
+    The options are read for each folder and each sync, the interpolation
+    and the conversion of their value are only done once.  Lookups with
+    keyword arguments (raw, vars, fallback) or an unhashable default are
+    not cached."""
+
+    @wraps(method)
+    def lookup(self, *args, **kwargs):
+        if kwargs:
+            return method(self, *args, **kwargs)
+        # A lookup running while the configuration changes stores its
+        # value in the dropped cache.
+        lookups = self._lookups
+        key = (method.__name__,) + args
+        try:
+            return lookups[key]
+        except KeyError:
+            value = lookups[key] = method(self, *args)
+            return value
+        except TypeError:
+            return method(self, *args)
+
+    return lookup
+
+
 class CustomConfigParser(ConfigParser):
     def __init__(self):
+        self._lookups = {}
         ConfigParser.__init__(self)
         self.localeval = None
 
+    def _changed(self):
+        self._lookups = {}
+
+    def read(self, *args, **kwargs):
+        try:
+            return ConfigParser.read(self, *args, **kwargs)
+        finally:
+            self._changed()
+
+    def read_file(self, *args, **kwargs):
+        try:
+            return ConfigParser.read_file(self, *args, **kwargs)
+        finally:
+            self._changed()
+
+    def add_section(self, section):
+        ConfigParser.add_section(self, section)
+        self._changed()
+
+    def set(self, section, option, value=None):
+        ConfigParser.set(self, section, option, value)
+        self._changed()
+
+    def remove_option(self, section, option):
+        try:
+            return ConfigParser.remove_option(self, section, option)
+        finally:
+            self._changed()
+
+    def remove_section(self, section):
+        try:
+            return ConfigParser.remove_section(self, section)
+        finally:
+            self._changed()
+
+    get = _cachedlookup(ConfigParser.get)
+    getint = _cachedlookup(ConfigParser.getint)
+    getfloat = _cachedlookup(ConfigParser.getfloat)
+    getboolean = _cachedlookup(ConfigParser.getboolean)
+
+    @_cachedlookup
     def getdefault(self, section, option, default, *args, **kwargs):
         """Same as config.get, but returns the value of `default`
         if there is no such option specified."""
@@ -35,6 +106,7 @@ class CustomConfigParser(ConfigParser):
         else:
             return default
 
+    @_cachedlookup
     def getdefaultint(self, section, option, default, *args, **kwargs):
         """Same as config.getint, but returns the value of `default`
         if there is no such option specified."""
@@ -44,6 +116,7 @@ class CustomConfigParser(ConfigParser):
         else:
             return default
 
+    @_cachedlookup
     def getdefaultfloat(self, section, option, default, *args, **kwargs):
         """Same as config.getfloat, but returns the value of `default`
         if there is no such option specified."""
@@ -53,6 +126,7 @@ class CustomConfigParser(ConfigParser):
         else:
             return default
 
+    @_cachedlookup
     def getdefaultboolean(self, section, option, default, *args, **kwargs):
         """Same as config.getboolean, but returns the value of `default`
         if there is no such option specified."""
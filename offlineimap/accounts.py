@@ -21,7 +21,7 @@ import time
 from sys import exc_info
 import traceback
 
-from offlineimap import mbnames, CustomConfig, OfflineImapError
+from offlineimap import mbnames, moves, hooks, CustomConfig, OfflineImapError
 from offlineimap import globals
 from offlineimap.repository import Repository
 from offlineimap.ui import getglobalui
@@ -88,6 +88,9 @@ class Account(CustomConfig.ConfigHelperMixin):
         self.remoterepos = None
         self.localrepos = None
         self.statusrepos = None
+        self.hookprocess = None
+        # Signal gets set when this account only should stop looping.
+        self.stop_signal = Event()
 
     def getlocaleval(self):
         return self.localeval
@@ -135,6 +138,13 @@ class Account(CustomConfig.ConfigHelperMixin):
             # abort ASAP
             cls.abort_NOW_signal.set()
 
+    def stop(self):
+        """Ends the autorefresh loop of this account once the current sync,
+        if any, is done.  Unlike set_abort_event(), the other accounts
+        keep on syncing."""
+
+        self.stop_signal.set()
+
     def get_abort_event(self):
         """Checks if an abort signal had been sent.
 
@@ -150,7 +160,7 @@ class Account(CustomConfig.ConfigHelperMixin):
         if skipsleep:
             self.config.set(self.getsection(), "skipsleep", '0')
         return skipsleep or Account.abort_soon_signal.is_set() or \
-               Account.abort_NOW_signal.is_set()
+               Account.abort_NOW_signal.is_set() or self.stop_signal.is_set()
 
     def _sleeper(self):
         """Sleep if the account is set to autorefresh.
@@ -182,7 +192,8 @@ class Account(CustomConfig.ConfigHelperMixin):
 
         if sleepresult:
             if Account.abort_soon_signal.is_set() or \
-                    Account.abort_NOW_signal.is_set():
+                    Account.abort_NOW_signal.is_set() or \
+                    self.stop_signal.is_set():
                 return 2
             self.quicknum = 0
             return 1
@@ -283,6 +294,10 @@ class SyncableAccount(Account):
             self.remoterepos = Repository(self, 'remote')
             self.localrepos = Repository(self, 'local')
             self.statusrepos = Repository(self, 'status')
+            command = self.getconf('hookprocess', '')
+            if command:
+                self.hookprocess = hooks.HookProcess(
+                    self, command, self.getconffloat('hooktimeout', 30.0))
         except OfflineImapError as e:
             self.ui.error(e, exc_info()[2])
             if e.severity >= OfflineImapError.ERROR.CRITICAL:
@@ -319,6 +334,8 @@ class SyncableAccount(Account):
                 self._unlock()
                 if looping and self._sleeper() >= 2:
                     looping = 0
+        if self.hookprocess is not None:
+            self.hookprocess.stop()
 
     def get_local_folder(self, remotefolder):
         """Return the corresponding local folder for a given remotefolder."""
@@ -327,6 +344,13 @@ class SyncableAccount(Account):
             remotefolder.getvisiblename().
                 replace(self.remoterepos.getsep(), self.localrepos.getsep()))
 
+    def get_status_folder(self, remotefolder):
+        """Return the corresponding status folder for a given remotefolder."""
+
+        return self.statusrepos.getfolder(
+            remotefolder.getvisiblename().
+                replace(self.remoterepos.getsep(), self.statusrepos.getsep()))
+
     # The syncrunner will loop on this method. This means it is called more than
     # once during the run.
     def __sync(self):
@@ -352,8 +376,7 @@ class SyncableAccount(Account):
             quick = False
 
 
-        hook = self.getconf('presynchook', '')
-        self.callhook(hook, "quick" if quick else "full")
+        self.synchook('presync', "quick" if quick else "full")
 
         if self.utf_8_support and self.remoterepos.getdecodefoldernames():
             raise OfflineImapError("Configuration mismatch in account " +
@@ -381,11 +404,8 @@ class SyncableAccount(Account):
                 self.ui.syncfolders(remoterepos, localrepos)
 
             # Iterate through all folders on the remote repo and sync.
+            remotefolders = []
             for remotefolder in remoterepos.getfolders():
-                # Check for CTRL-C or SIGTERM.
-                if Account.abort_NOW_signal.is_set():
-                    break
-
                 if not remotefolder.sync_this:
                     self.ui.debug('', "Not syncing filtered folder '%s'"
                                       "[%s]" % (remotefolder.getname(), remoterepos))
@@ -408,6 +428,20 @@ class SyncableAccount(Account):
                     self.ui.debug('', "Not syncing filtered folder '%s'"
                                       "[%s]" % (localfolder.getname(), localfolder.repository))
                     continue  # Ignore filtered folder.
+                remotefolders.append(remotefolder)
+
+            if self.getconfboolean('movedetection', False) and \
+                    not self.dryrun:
+                if moves.supported(self):
+                    moves.MoveDetector(self).run(remotefolders)
+                else:
+                    self.ui.debug('', "Move detection is not supported by "
+                                      "account %s" % self)
+
+            for remotefolder in remotefolders:
+                # Check for CTRL-C or SIGTERM.
+                if Account.abort_NOW_signal.is_set():
+                    break
 
                 if not globals.options.singlethreading:
                     thread = InstanceLimitedThread(
@@ -435,7 +469,10 @@ class SyncableAccount(Account):
             remoterepos.forgetfolders()
         except:
             # Error while syncing. Drop all connections that we have, they
-            # might be bogus by now (e.g. after suspend).
+            # might be bogus by now (e.g. after suspend).  The folders are
+            # forgotten as well, with what was learnt of them.
+            localrepos.forgetfolders()
+            remoterepos.forgetfolders()
             localrepos.dropconnections()
             remoterepos.dropconnections()
             raise
@@ -444,8 +481,30 @@ class SyncableAccount(Account):
             localrepos.holdordropconnections()
             remoterepos.holdordropconnections()
 
-        hook = self.getconf('postsynchook', '')
-        self.callhook(hook, "quick" if quick else "full")
+        self.synchook('postsync', "quick" if quick else "full")
+
+    def synchook(self, event, syncmode):
+        """Runs the hook of event, 'presync' or 'postsync', and sends the
+        event to the hook process."""
+
+        self.callhook(self.getconf(event + 'hook', ''), syncmode)
+        self.hookevent(event, syncmode)
+
+    def hookevent(self, event, syncmode, **values):
+        """Sends an event to the hook process, if any, see
+        :mod:`offlineimap.hooks`."""
+
+        if self.hookprocess is None or Account.abort_NOW_signal.is_set():
+            return
+        if self.dryrun:
+            self.ui.callhook("Hook process event: " + event)
+            return
+        try:
+            self.hookprocess.send(event, syncmode, **values)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            self.ui.error(e, exc_info()[2], msg="Sending event to hook process")
 
     def callhook(self, cmd, syncmode):
         # Check for CTRL-C or SIGTERM and run postsynchook.
@@ -472,32 +531,38 @@ class SyncableAccount(Account):
             self.ui.error(e, exc_info()[2], msg="Calling hook")
 
 
+def getsyncmutex(account, localfolder):
+    """Returns the lock serializing the syncs of localfolder, held by
+    syncfolder() and the move detection."""
+
+    account_name = account.getname()
+    localfolder_name = localfolder.getfullname()
+
+    with SYNC_MUTEXES_LOCK:
+        if SYNC_MUTEXES.get(account_name) is None:
+            SYNC_MUTEXES[account_name] = {}
+        # The localfolder full name is good to uniquely identify the sync
+        # transaction.
+        if SYNC_MUTEXES[account_name].get(localfolder_name) is None:
+            # XXX: This lock could be an external file lock so we can remove
+            # the lock at the account level.
+            SYNC_MUTEXES[account_name][localfolder_name] = Lock()
+        return SYNC_MUTEXES[account_name][localfolder_name]
+
+
 # XXX: This function should likely be refactored. This should not be passed the
 # account instance.
-def syncfolder(account, remotefolder, quick):
+def syncfolder(account, remotefolder, quick, syncmode=None):
     """Synchronizes given remote folder for the specified account.
 
     Filtered folders on the remote side will not invoke this function.
+    The syncmode of the hook process events defaults to quick or full.
 
     When called in concurrently for the same localfolder, syncs are
     serialized."""
 
     def acquire_mutex():
-        account_name = account.getname()
-        localfolder_name = localfolder.getfullname()
-
-        with SYNC_MUTEXES_LOCK:
-            if SYNC_MUTEXES.get(account_name) is None:
-                SYNC_MUTEXES[account_name] = {}
-            # The localfolder full name is good to uniquely identify the sync
-            # transaction.
-            if SYNC_MUTEXES[account_name].get(localfolder_name) is None:
-                # XXX: This lock could be an external file lock so we can remove
-                # the lock at the account level.
-                SYNC_MUTEXES[account_name][localfolder_name] = Lock()
-
-        # Acquire the lock.
-        SYNC_MUTEXES[account_name][localfolder_name].acquire()
+        getsyncmutex(account, localfolder).acquire()
 
     def release_mutex():
         SYNC_MUTEXES[account.getname()][localfolder.getfullname()].release()
@@ -522,6 +587,19 @@ def syncfolder(account, remotefolder, quick):
             localfolder.save_uidvalidity()
             remotefolder.save_uidvalidity()
 
+    def statusflags():
+        return dict((uid, frozenset(statusfolder.getmessageflags(uid)))
+                    for uid in statusfolder.getmessageuidlist())
+
+    def changes(before, after):
+        """Returns the numbers of new, deleted and flagged messages
+        between two statusflags()."""
+
+        return dict(new=len(after.keys() - before.keys()),
+                    deleted=len(before.keys() - after.keys()),
+                    flagged=sum(1 for uid, flags in after.items()
+                                if uid in before and before[uid] != flags))
+
     def cachemessagelists_upto_date(date):
         """Returns messages with uid > min(uids of messages newer than date)."""
 
@@ -592,7 +670,6 @@ def syncfolder(account, remotefolder, quick):
 
     remoterepos = account.remoterepos
     localrepos = account.localrepos
-    statusrepos = account.statusrepos
 
     ui = getglobalui()
     ui.registerthread(account)
@@ -608,8 +685,7 @@ def syncfolder(account, remotefolder, quick):
                     localfolder.getname())
 
         # Load status folder.
-        statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().
-                                             replace(remoterepos.getsep(), statusrepos.getsep()))
+        statusfolder = account.get_status_folder(remotefolder)
         statusfolder.openfiles()
         statusfolder.cachemessagelist()
 
@@ -655,6 +731,9 @@ def syncfolder(account, remotefolder, quick):
             check_uid_validity()
             remotefolder.cachemessagelist()
 
+        if account.hookprocess is not None:
+            before = statusflags()
+
         # Synchronize remote changes.
         if not localrepos.getconfboolean('readonly', False):
             ui.syncingmessages(remoterepos, remotefolder, localrepos, localfolder)
@@ -673,6 +752,11 @@ def syncfolder(account, remotefolder, quick):
 
         statusfolder.save()
         localrepos.restore_atime()
+        if account.hookprocess is not None:
+            account.hookevent('folder', syncmode or ("quick" if quick
+                                                     else "full"),
+                              folder=localfolder.getvisiblename(),
+                              **changes(before, statusflags()))
     except (KeyboardInterrupt, SystemExit):
         raise
     except OfflineImapError as e:
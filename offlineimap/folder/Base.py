@@ -21,6 +21,9 @@ import os.path
 import re
 import time
 from sys import exc_info
+# Base class of BrokenProcessPool, which would import the process pool.
+from concurrent.futures import BrokenExecutor
+from contextlib import ExitStack
 
 from email import policy
 from email.parser import BytesParser
@@ -32,6 +35,7 @@ from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 import offlineimap.accounts
 from offlineimap import imaputil
+from offlineimap.utils import msgpool
 
 
 class BaseFolder:
@@ -98,6 +102,11 @@ class BaseFolder:
         self._sync_deletes = self.config.getdefaultboolean(
             self.repoconfname, "sync_deletes", True)
         self._dofsync = self.config.getdefaultboolean("general", "fsync", True)
+        # Number of messages per group commit, 0 to sync each message.
+        self._fsync_batch = 0
+        if self._dofsync:
+            self._fsync_batch = self.config.getdefaultint(
+                "general", "fsync_batch", 0)
 
         # Determine if we're running static or dynamic folder filtering
         # and check filtering status.
@@ -165,6 +174,15 @@ class BaseFolder:
         """
         return self._dofsync
 
+    def getfsyncbatch(self):
+        """Number of copied messages per group commit, 0 if disabled.
+
+        In a group commit, messages are written without being synced, then
+        synced all at once when the dstfolder transaction ends, and only
+        then the statusfolder transaction is committed."""
+
+        return self._fsync_batch
+
     def suggeststhreads(self):
         """Returns True if this folder suggests using threads for actions.
 
@@ -173,11 +191,6 @@ class BaseFolder:
 
         return False
 
-    def waitforthread(self):
-        """Implements method that waits for thread to be usable.
-        Should be implemented only for folders that suggest threads."""
-        raise NotImplementedError
-
     def quickchanged(self, statusfolder):
         """ Runs quick check for folder changes and returns changed
         status: True -- changed, False -- not changed.
@@ -188,8 +201,8 @@ class BaseFolder:
         return True
 
     def getinstancelimitnamespace(self):
-        """For threading folders, returns the instancelimitname for
-        InstanceLimitedThreads."""
+        """For threading folders, returns the instancelimitname of the
+        WorkerPool copying their messages."""
 
         raise NotImplementedError
 
@@ -314,6 +327,13 @@ class BaseFolder:
 
         self._base_saved_uidvalidity = newval
 
+    def forgetsyncstate(self):
+        """Forgets what was learnt of the folder during a sync, for the
+        folder objects kept by their repository across syncs."""
+
+        if hasattr(self, '_base_saved_uidvalidity'):
+            del self._base_saved_uidvalidity
+
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
 
@@ -383,6 +403,54 @@ class BaseFolder:
 
         raise NotImplementedError
 
+    def getmessagepolicy(self):
+        """Returns the key in self.policy of the policy messages are parsed
+        and saved with, or None if getmessagebytes() is not supported."""
+
+        return None
+
+    def getmessagebytes(self, uid):
+        """Returns the raw message, as getmessage() would parse it."""
+
+        raise NotImplementedError
+
+    def getpreparedmessage(self, uid, dstfolder):
+        """Returns the message object of uid, to be saved in dstfolder.
+
+        If the message pool is enabled (see utils/msgpool.py), the message
+        is parsed and serialized for dstfolder by another process. The
+        returned message then only has its headers parsed, see
+        msgpool.PreparedMessage. Otherwise, this is getmessage()."""
+
+        inpolicy = self.getmessagepolicy()
+        outpolicy = dstfolder.getmessagepolicy()
+        pool = msgpool.getmessagepool(self.config)
+        if pool is None or inpolicy is None or outpolicy is None:
+            return self.getmessage(uid)
+
+        raw = self.getmessagebytes(uid)
+        try:
+            data, defects, error = pool.prepare(raw, self.policy[inpolicy],
+                                                dstfolder.policy[outpolicy])
+        except BrokenExecutor as e:
+            self.ui.warn("Message parsing process died, parsing messages "
+                         "in process from now on: %s" % e)
+            msgpool.disablemessagepool()
+            return self.getmessage(uid)
+        if defects is not None:
+            # We don't automatically apply fixes as to attempt to preserve
+            # the original message.
+            self.ui.warn("UID {} has defects: {}".format(uid, defects))
+        if error is not None:
+            msg_id = self._extract_message_id(raw)[0].decode(
+                'ascii', errors='surrogateescape')
+            raise OfflineImapError(
+                "UID {} ({}) could not be processed!\n  {}".format(
+                    uid, msg_id, error),
+                OfflineImapError.ERROR.MESSAGE)
+        return msgpool.PreparedMessage.from_bytes(data,
+                                                  dstfolder.policy[outpolicy])
+
     def getmaxage(self):
         """Return maxage.
 
@@ -549,6 +617,18 @@ class BaseFolder:
 
         raise NotImplementedError
 
+    def savemessagesflags(self, uidflags):
+        """Sets the flags of many messages at once.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :param uidflags: dict of UID -> new set of flags"""
+
+        for uid, flags in list(uidflags.items()):
+            self.savemessageflags(uid, flags)
+
     def addmessageflags(self, uid, flags):
         """Adds the specified flags to the message's flag set.
 
@@ -567,7 +647,10 @@ class BaseFolder:
     def addmessagesflags(self, uidlist, flags):
         """Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
-        dryrun mode."""
+        dryrun mode.
+
+        :returns: None, or the set of UIDs left untouched because the
+            backend found they changed since the message list was loaded"""
 
         for uid in uidlist:
             if self.uidexists(uid):
@@ -590,7 +673,10 @@ class BaseFolder:
         """
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
-        dryrun mode."""
+        dryrun mode.
+
+        :returns: None, or the set of UIDs left untouched, see
+            addmessagesflags()"""
 
         for uid in uidlist:
             self.deletemessageflags(uid, flags)
@@ -779,6 +865,18 @@ class BaseFolder:
         for uid in uidlist:
             self.deletemessage(uid)
 
+    def copymessagesto(self, uidlist, dstfolder, statusfolder):
+        """Copies messages of uidlist to dstfolder at once, for the backends
+        which can do better than copymessageto() on each message, e.g.
+        with a server-side copy.  The statusfolder is updated.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a dryrun mode.
+
+        :returns: the UIDs of uidlist left to copymessageto()"""
+
+        return uidlist
+
     def copymessageto(self, uid, dstfolder, statusfolder, register=1):
         """Copies a message from self to dst if needed, updating the status
 
@@ -789,7 +887,8 @@ class BaseFolder:
         :param uid: uid of the message to be copied.
         :param dstfolder: A BaseFolder-derived instance
         :param statusfolder: A LocalStatusFolder instance
-        :param register: whether we should register a new thread."
+        :param register: whether the thread should be registered with
+            the account, if not already."
         :returns: Nothing on success, or raises an Exception."""
 
         # Sometimes, it could be the case that if a sync takes awhile,
@@ -797,7 +896,9 @@ class BaseFolder:
         # synced to the status cache.  This is only a problem with
         # self.getmessage().  So, don't call self.getmessage unless
         # really needed.
-        if register:  # Output that we start a new thread.
+        if register and \
+                self.ui.getthreadaccount() is not self.repository.account:
+            # Copy workers run the jobs of any folder of the repository.
             self.ui.registerthread(self.repository.account)
 
         try:
@@ -808,7 +909,7 @@ class BaseFolder:
             # If any of the destinations actually stores the message body,
             # load it up.
             if dstfolder.storesmessages():
-                message = self.getmessage(uid)
+                message = self.getpreparedmessage(uid, dstfolder)
             # Succeeded? -> IMAP actually assigned a UID. If newid
             # remained negative, no server was willing to assign us an
             # UID. If newid is 0, saving succeeded, but we could not
@@ -881,7 +982,8 @@ class BaseFolder:
                 return (b"<Unknown Message-ID>", False)
         return (msg_id, True)
 
-    def _quote_boundary_fix(self, raw_msg_bytes):
+    @staticmethod
+    def _quote_boundary_fix(raw_msg_bytes):
         """Modify a raw message to quote the boundary separator for multipart messages.
 
         This function quotes only the first occurrence of the boundary field in
@@ -936,8 +1038,6 @@ class BaseFolder:
         # We have no new mail yet.
         self.have_newmail = False
 
-        threads = []
-
         copylist = [uid for uid in self.getmessageuidlist()
                     if not statusfolder.uidexists(uid)]
         num_to_copy = len(copylist)
@@ -955,43 +1055,55 @@ class BaseFolder:
             )
             return
 
-        with self:
-            for num, uid in enumerate(copylist):
-                # Bail out on CTRL-C or SIGTERM.
-                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
-                    break
-
-                if uid == 0:
-                    msg = "Assertion that UID != 0 failed; ignoring message."
-                    self.ui.warn(msg)
-                    continue
-
-                if uid > 0 and dstfolder.uidexists(uid):
-                    # dstfolder has message with that UID already,
-                    # only update status.
-                    flags = self.getmessageflags(uid)
-                    rtime = self.getmessagetime(uid)
-                    statusfolder.savemessage(uid, None, flags, rtime)
-                    continue
-
-                self.ui.copyingmessage(uid, num + 1, num_to_copy, self,
-                                       dstfolder)
-                # Exceptions are caught in copymessageto().
-                if self.suggeststhreads():
-                    self.waitforthread()
-                    thread = threadutil.InstanceLimitedThread(
-                        self.getinstancelimitnamespace(),
-                        target=self.copymessageto,
-                        name="Copy message from %s:%s" % (self.repository,
-                                                          self),
-                        args=(uid, dstfolder, statusfolder)
-                    )
-                    thread.start()
-                    threads.append(thread)
+        copylist = self.copymessagesto(copylist, dstfolder, statusfolder)
+
+        pool = None
+        if self.suggeststhreads():
+            pool = threadutil.getworkerpool(self.getinstancelimitnamespace())
+        batchsize = self.getfsyncbatch() or max(len(copylist), 1)
+        for start in range(0, len(copylist), batchsize):
+            with ExitStack() as transaction:
+                if self.getfsyncbatch():
+                    # Leaving the stack commits dstfolder first, then
+                    # statusfolder: the status never references a message
+                    # which is not on disk yet.
+                    transaction.enter_context(statusfolder)
+                    transaction.enter_context(dstfolder)
                 else:
-                    self.copymessageto(uid, dstfolder, statusfolder, register=0)
-            for thread in threads:
-                thread.join()  # Block until all "copy" threads are done.
+                    transaction.enter_context(self)
+                jobs = threadutil.JobGroup()
+                for num, uid in enumerate(copylist[start:start + batchsize],
+                                          start):
+                    # Bail out on CTRL-C or SIGTERM.
+                    if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                        break
+
+                    if uid == 0:
+                        msg = "Assertion that UID != 0 failed; ignoring message."
+                        self.ui.warn(msg)
+                        continue
+
+                    if uid > 0 and dstfolder.uidexists(uid):
+                        # dstfolder has message with that UID already,
+                        # only update status.
+                        flags = self.getmessageflags(uid)
+                        rtime = self.getmessagetime(uid)
+                        statusfolder.savemessage(uid, None, flags, rtime)
+                        continue
+
+                    self.ui.copyingmessage(uid, num + 1, num_to_copy, self,
+                                           dstfolder)
+                    # Exceptions are caught in copymessageto().
+                    if pool is not None:
+                        # Blocks while the workers are all busy.
+                        pool.submit(jobs, self.copymessageto,
+                                    uid, dstfolder, statusfolder)
+                    else:
+                        self.copymessageto(uid, dstfolder, statusfolder,
+                                           register=0)
+                jobs.wait()  # Block until all "copy" jobs are done.
+            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                break
 
         # Execute new mail hook if we have new mail.
         if self.have_newmail:
@@ -1077,11 +1189,12 @@ class BaseFolder:
         This function checks and protects us from action in ryrun mode.
         """
 
-        # For each flag, we store a list of uids to which it should be
-        # added.  Then, we can call addmessagesflags() to apply them in
-        # bulk, rather than one call per message.
+        # Messages are grouped by the set of flags to add, and by the set
+        # of flags to remove, so that e.g. all the messages getting +SR
+        # are updated by a single addmessagesflags() call.
         addflaglist = {}
         delflaglist = {}
+        statusflaglist = {}
         for uid in self.getmessageuidlist():
             # Ignore messages with negative UIDs missed by pass 1 and
             # don't do anything if the message has been deleted remotely
@@ -1095,32 +1208,35 @@ class BaseFolder:
 
             selfflags = self.combine_flags_and_keywords(uid, dstfolder)
 
-            addflags = selfflags - statusflags
-            delflags = statusflags - selfflags
-
-            for flag in addflags:
-                if flag not in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            for flag in delflags:
-                if flag not in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
-
-        for flag, uids in list(addflaglist.items()):
-            self.ui.addingflags(uids, flag, dstfolder)
+            addflags = frozenset(selfflags - statusflags)
+            delflags = frozenset(statusflags - selfflags)
+            if addflags:
+                addflaglist.setdefault(addflags, []).append(uid)
+            if delflags:
+                delflaglist.setdefault(delflags, []).append(uid)
+            if (addflags or delflags) and statusfolder.uidexists(uid):
+                statusflaglist[uid] = set(selfflags)
+
+        for flags, uids in list(addflaglist.items()):
+            self.ui.addingflags(uids, sorted(flags), dstfolder)
             if self.repository.account.dryrun:
                 continue  # Don't actually add in a dryrun.
-            dstfolder.addmessagesflags(uids, set(flag))
-            statusfolder.addmessagesflags(uids, set(flag))
+            modified = dstfolder.addmessagesflags(uids, set(flags))
+            for uid in modified or ():
+                # Left untouched, see the next sync.
+                statusflaglist.pop(uid, None)
 
-        for flag, uids in list(delflaglist.items()):
-            self.ui.deletingflags(uids, flag, dstfolder)
+        for flags, uids in list(delflaglist.items()):
+            self.ui.deletingflags(uids, sorted(flags), dstfolder)
             if self.repository.account.dryrun:
                 continue  # Don't actually remove in a dryrun.
-            dstfolder.deletemessagesflags(uids, set(flag))
-            statusfolder.deletemessagesflags(uids, set(flag))
+            modified = dstfolder.deletemessagesflags(uids, set(flags))
+            for uid in modified or ():
+                statusflaglist.pop(uid, None)
+
+        if statusflaglist and not self.repository.account.dryrun:
+            # The status gets all the changes at once.
+            statusfolder.savemessagesflags(statusflaglist)
 
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
@@ -58,6 +58,11 @@ class GmailFolder(IMAPFolder):
         ignorelabels = self.repository.account.getconf('ignorelabels', '')
         self.ignorelabels = set([v for v in re.split(r'\s*,\s*', ignorelabels) if len(v)])
 
+    def getmessagepolicy(self):
+        if self.synclabels:
+            return None  # Labels are embedded by getmessage().
+        return super(GmailFolder, self).getmessagepolicy()
+
     def getmessage(self, uid):
         """Retrieve message with UID from the IMAP server (incl body).  Also
            gets Gmail labels and embeds them into the message.
@@ -211,7 +216,8 @@ class GmailFolder(IMAPFolder):
         labels = labels - self.ignorelabels
         uidlist = [uid for uid in uidlist if uid > 0]
         if len(uidlist) > 0:
-            imapobj = self.imapserver.acquireconnection()
+            imapobj = self.imapserver.acquireconnection(
+                self.getfullIMAPname())
             try:
                 labels_str = '(' + ' '.join([imaputil.quote(lb) for lb in labels]) + ')'
                 # Coalesce uid's into ranges
@@ -20,7 +20,8 @@ import binascii
 import re
 import time
 from sys import exc_info
-from offlineimap import imaputil, imaplibutil, OfflineImapError
+import offlineimap.accounts
+from offlineimap import imaputil, OfflineImapError
 from offlineimap import globals
 from imaplib2 import MonthNames
 from .Base import BaseFolder
@@ -29,6 +30,9 @@ from email.errors import NoBoundaryInMultipartDefect
 # Globals
 CRLF = '\r\n'
 MSGCOPY_NAMESPACE = 'MSGCOPY_'
+# Maximum length of the sequence sets of the STORE commands, for the IMAP
+# servers with a limited line length (RFC 2683 advises 1000 octets).
+STORE_SEQUENCE_MAXLEN = 900
 
 
 class IMAPFolder(BaseFolder):
@@ -54,6 +58,10 @@ class IMAPFolder(BaseFolder):
         self.randomgenerator = random.Random()
         # self.ui is set in BaseFolder.
         self.imap_query = ['BODY.PEEK[]']
+        # Highest MODSEQ of the messages when their list was loaded, if the
+        # server supports CONDSTORE, and the UIDs we changed since.
+        self._modseq = None
+        self._storeduids = set()
 
         # number of times to retry fetching messages
         self.retrycount = self.repository.getconfint('retrycount', 2)
@@ -100,10 +108,6 @@ class IMAPFolder(BaseFolder):
             return False
         return not globals.options.singlethreading
 
-    # Interface from BaseFolder
-    def waitforthread(self):
-        self.imapserver.connectionwait()
-
     def getmaxage(self):
         if self.config.getdefault("Account %s" %
                                   self.accountname, "maxage", None):
@@ -116,6 +120,17 @@ class IMAPFolder(BaseFolder):
     def getinstancelimitnamespace(self):
         return MSGCOPY_NAMESPACE + self.repository.getname()
 
+    # Interface from BaseFolder
+    def forgetsyncstate(self):
+        """Also forgets the UIDVALIDITY on the server, a folder recreated
+        since has a new one, and the UIDs not to copy."""
+
+        super(IMAPFolder, self).forgetsyncstate()
+        if hasattr(self, '_uidvalidity'):
+            del self._uidvalidity
+        self.copy_ignoreUIDs = self.repository.get_copy_ignore_UIDs(
+            self.getvisiblename())
+
     # Interface from BaseFolder
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
@@ -126,10 +141,13 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # Use cached value if existing.
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
-            # SELECT (if not already done) and get current UIDVALIDITY.
-            self.__selectro(imapobj)
+            # SELECT and get current UIDVALIDITY.  The connection may still
+            # be on the folder from a previous sync, whose UIDVALIDITY
+            # response is consumed already.
+            self.__selectro(imapobj, force=True)
             typ, uidval = imapobj.response('UIDVALIDITY')
             assert uidval != [None] and uidval is not None, \
                 "response('UIDVALIDITY') returned [None]!"
@@ -275,6 +293,21 @@ class IMAPFolder(BaseFolder):
         # By default consider all messages in this folder.
         return '1:*'
 
+    def __hasmodseq(self, imapobj):
+        """Whether the server keeps modification sequences for the
+        selected folder (CONDSTORE, RFC 7162)."""
+
+        if 'CONDSTORE' not in imapobj.capabilities:
+            return False
+        typ, data = imapobj.response('NOMODSEQ')
+        return data == [None]
+
+    # Interface from BaseFolder
+    def dropmessagelistcache(self):
+        super(IMAPFolder, self).dropmessagelistcache()
+        self._modseq = None
+        self._storeduids = set()
+
     # Interface from BaseFolder
     def msglist_item_initializer(self, uid):
         return {'uid': uid, 'flags': set(), 'time': 0}
@@ -291,13 +324,17 @@ class IMAPFolder(BaseFolder):
             if not msgsToFetch:
                 return  # No messages to sync.
 
+            condstore = self.__hasmodseq(imapobj)
+            if condstore:
+                items = '(FLAGS UID INTERNALDATE MODSEQ)'
+            else:
+                items = '(FLAGS UID INTERNALDATE)'
             # Get the flags and UIDs for these. single-quotes prevent
             # imaplib2 from quoting the sequence.
             fetch_msg = "%s" % msgsToFetch
             self.ui.debug('imap', "calling imaplib2 fetch command: %s %s" %
-                          (fetch_msg, '(FLAGS UID INTERNALDATE)'))
-            res_type, response = imapobj.fetch(
-                fetch_msg, '(FLAGS UID INTERNALDATE)')
+                          (fetch_msg, items))
+            res_type, response = imapobj.fetch(fetch_msg, items)
             if res_type != 'OK':
                 msg = "FETCHING UIDs in folder [%s]%s failed. "\
                       "Server responded '[%s] %s'" % \
@@ -306,27 +343,27 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+        modseq = 0
         for messagestr in response:
             # Looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg.
-            # Discard initial message number.
             if messagestr is None:
                 continue
-            messagestr = messagestr.decode('utf-8').split(' ', 1)[1]
-            options = imaputil.flags2hash(messagestr)
-            if 'UID' not in options:
+            if condstore:
+                mo = imaputil.FETCH_MODSEQ_RE.search(messagestr)
+                if mo is not None:
+                    modseq = max(modseq, int(mo.group(1)))
+            uid, flags, keywords, rtime = \
+                imaputil.parse_fetch_flags(messagestr)
+            if uid is None:
                 self.ui.warn('No UID in message with options %s' %
-                             str(options), minor=1)
+                             messagestr.decode('utf-8', 'replace'), minor=1)
             else:
-                uid = int(options['UID'])
-                self.messagelist[uid] = self.msglist_item_initializer(uid)
-                flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                keywords = imaputil.flagsimap2keywords(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(
-                    messagestr.encode('utf-8'))
                 self.messagelist[uid] = {'uid': uid,
                                          'flags': flags,
                                          'time': rtime,
                                          'keywords': keywords}
+        if condstore and modseq > 0:
+            self._modseq = modseq
         self.ui.messagelistloaded(self.repository, self, self.getmessagecount())
 
     # Interface from BaseFolder
@@ -360,6 +397,14 @@ class IMAPFolder(BaseFolder):
 
         return msg
 
+    # Interface from BaseFolder
+    def getmessagepolicy(self):
+        return '8bit-RFC'
+
+    # Interface from BaseFolder
+    def getmessagebytes(self, uid):
+        return self._fetch_raw_from_imap(str(uid), self.retrycount)[0][1]
+
     # Interface from BaseFolder
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
@@ -666,7 +711,8 @@ class IMAPFolder(BaseFolder):
             msg_id = '[broken message-id]'
 
         retry_left = 2  # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         # NB: in the finally clause for this try we will release
         # NB: the acquired imapobj, so don't do that twice unless
         # NB: you will put another connection to imapobj.  If you
@@ -734,7 +780,8 @@ class IMAPFolder(BaseFolder):
                     # Connection has been reset, release connection and retry.
                     retry_left -= 1
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullIMAPname())
                     if not retry_left:
                         raise OfflineImapError(
                             "Saving msg (%s) in folder '%s', "
@@ -831,22 +878,21 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap', 'savemessage: returning new UID %d' % uid)
         return uid
 
-    def _fetch_from_imap(self, uids, retry_num=1):
-        """Fetches data from IMAP server.
+    def _fetch_raw_from_imap(self, uids, retry_num=1):
+        """Fetches data from IMAP server, see _fetch_from_imap().
 
-        Arguments:
-        - uids: message UIDS (OfflineIMAP3: First UID returned only)
-        - retry_num: number of retries to make
+        Returns: data obtained by this query, as returned by imaplib."""
 
-        Returns: data obtained by this query."""
-
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=None)
         try:
             query = "(%s)" % (" ".join(self.imap_query))
             fails_left = retry_num  # Retry on dropped connection.
             while fails_left:
                 try:
-                    imapobj.select(self.getfullIMAPname(), readonly=True)
+                    # Keep the mailbox selected read-write if it is.
+                    imapobj.select(self.getfullIMAPname(), readonly=not
+                                   imapobj.isselected(self.getfullIMAPname()))
                     res_type, data = imapobj.uid('fetch', uids, query)
                     break
                 except imapobj.abort as e:
@@ -864,7 +910,8 @@ class IMAPFolder(BaseFolder):
                                       retry_num - fails_left, retry_num))
                     # Release dropped connection, and get a new one.
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullIMAPname(), readonly=None)
         finally:
             # The imapobj here might be different than the one created before
             # the ``try`` clause. So please avoid transforming this to a nice
@@ -890,6 +937,18 @@ class IMAPFolder(BaseFolder):
                 reason = "IMAP server '%s' does not have a message " \
                          "with UID '%s'" % (self.getrepository(), uids)
             raise OfflineImapError(reason, severity)
+        return data
+
+    def _fetch_from_imap(self, uids, retry_num=1):
+        """Fetches data from IMAP server.
+
+        Arguments:
+        - uids: message UIDS (OfflineIMAP3: First UID returned only)
+        - retry_num: number of retries to make
+
+        Returns: data obtained by this query."""
+
+        data = self._fetch_raw_from_imap(uids, retry_num)
 
         # JI: In offlineimap, this function returned a tuple of strings for each
         # fetched UID, offlineimap3 calls to the imap object return bytes and so
@@ -966,28 +1025,27 @@ class IMAPFolder(BaseFolder):
         so you need to ensure that it is never called in a
         dryrun mode."""
 
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
-            result = self._store_to_imap(imapobj, str(uid), 'FLAGS',
-                                         imaputil.flagsmaildir2imap(flags))
+            with imapobj.discarding('FETCH'):
+                self._store_to_imap(imapobj, str(uid), 'FLAGS.SILENT',
+                                    imaputil.flagsmaildir2imap(flags))
         except imapobj.readonly:
             self.ui.flagstoreadonly(self, [uid], flags)
             return
         finally:
             self.imapserver.releaseconnection(imapobj)
-
-        if not result:
-            self.messagelist[uid]['flags'] = flags
-        else:
-            flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
+        self.messagelist[uid]['flags'] = flags
+        self._storeduids.add(uid)
 
     # Interface from BaseFolder
     def addmessageflags(self, uid, flags):
         self.addmessagesflags([uid], flags)
 
     def __addmessagesflags_noconvert(self, uidlist, flags):
-        self.__processmessagesflags('+', uidlist, flags)
+        return self.__processmessagesflags('+', uidlist, flags,
+                                           conditional=True)
 
     # Interface from BaseFolder
     def addmessagesflags(self, uidlist, flags):
@@ -995,7 +1053,7 @@ class IMAPFolder(BaseFolder):
         add flags and get a converted UID, and if we don't have noconvert,
         then UIDMaps will try to convert it twice."""
 
-        self.__addmessagesflags_noconvert(uidlist, flags)
+        return self.__addmessagesflags_noconvert(uidlist, flags)
 
     # Interface from BaseFolder
     def deletemessageflags(self, uid, flags):
@@ -1003,60 +1061,80 @@ class IMAPFolder(BaseFolder):
 
     # Interface from BaseFolder
     def deletemessagesflags(self, uidlist, flags):
-        self.__processmessagesflags('-', uidlist, flags)
+        return self.__processmessagesflags('-', uidlist, flags,
+                                           conditional=True)
 
-    def __processmessagesflags_real(self, operation, uidlist, flags):
-        imapobj = self.imapserver.acquireconnection()
+    def __storeflags(self, imapobj, sequence, item, imapflags,
+                     unchangedsince=None):
+        """Sends a UID STORE, conditional if unchangedsince is given.
+
+        :returns: the set of UIDs left untouched because their MODSEQ is
+            above unchangedsince"""
+
+        args = [sequence]
+        if unchangedsince is not None:
+            args.append('(UNCHANGEDSINCE %d)' % unchangedsince)
+        result = imapobj.uid('store', *args, item, imapflags)
+        if result[0] != 'OK':
+            raise OfflineImapError(
+                'Error with store: %s' % '. '.join(result[1]),
+                OfflineImapError.ERROR.MESSAGE)
+        if unchangedsince is None:
+            return set()
+        typ, modified = imapobj.response('MODIFIED')
+        return set(uid for sequence in modified if sequence
+                   for uid in imaputil.uid_sequence_to_list(
+                       sequence.decode('ascii')))
+
+    def __processmessagesflags(self, operation, uidlist, flags,
+                               conditional=False):
+        """Adds or removes flags of the messages in uidlist, with as few
+        STORE commands as the line length allows.
+
+        The server is asked not to echo the new flags.  With conditional
+        and CONDSTORE, messages changed on the server since their list was
+        loaded are left untouched.
+
+        :returns: the set of UIDs left untouched"""
+
+        # Our own changes update the MODSEQ of the messages, those cannot
+        # be checked anymore.
+        groups = [(None, uidlist)]
+        if conditional and self._modseq is not None:
+            groups = [
+                (self._modseq, [uid for uid in uidlist
+                                if uid not in self._storeduids]),
+                (None, [uid for uid in uidlist if uid in self._storeduids])]
+        modified = set()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             try:
                 imapobj.select(self.getfullIMAPname())
             except imapobj.readonly:
                 self.ui.flagstoreadonly(self, uidlist, flags)
-                return
-            response = imapobj.uid('store',
-                                   imaputil.uid_sequence(uidlist),
-                                   operation + 'FLAGS',
-                                   imaputil.flagsmaildir2imap(flags))
-            if response[0] != 'OK':
-                raise OfflineImapError(
-                    'Error with store: %s' % '. '.join(response[1]),
-                    OfflineImapError.ERROR.MESSAGE)
-            response = response[1]
+                return modified
+            imapflags = imaputil.flagsmaildir2imap(flags)
+            with imapobj.discarding('FETCH'):
+                for unchangedsince, uids in groups:
+                    for _, sequence in imaputil.uid_sequence_chunks(
+                            uids, STORE_SEQUENCE_MAXLEN):
+                        modified |= self.__storeflags(
+                            imapobj, sequence, operation + 'FLAGS.SILENT',
+                            imapflags, unchangedsince)
         finally:
             self.imapserver.releaseconnection(imapobj)
-        # Some IMAP servers do not always return a result.  Therefore,
-        # only update the ones that it talks about, and manually fix
-        # the others.
-        needupdate = list(uidlist)
-        for result in response:
-            if result is None:
-                # Compensate for servers that don't return anything from
-                # STORE.
-                continue
-            attributehash = imaputil.flags2hash(imaputil.imapsplit(result)[1])
-            if not ('UID' in attributehash and 'FLAGS' in attributehash):
-                # Compensate for servers that don't return a UID attribute.
+        for uid in uidlist:
+            if uid in modified or uid not in self.messagelist:
                 continue
-            flagstr = attributehash['FLAGS']
-            uid = int(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flagstr)
-            try:
-                needupdate.remove(uid)
-            except ValueError:  # Let it slide if it's not in the list.
-                pass
-        for uid in needupdate:
             if operation == '+':
                 self.messagelist[uid]['flags'] |= flags
             elif operation == '-':
                 self.messagelist[uid]['flags'] -= flags
-
-    def __processmessagesflags(self, operation, uidlist, flags):
-        # Hack for those IMAP servers with a limited line length.
-        batch_size = 100
-        for i in range(0, len(uidlist), batch_size):
-            self.__processmessagesflags_real(operation,
-                                             uidlist[i:i + batch_size], flags)
-        return
+            self._storeduids.add(uid)
+        if modified:
+            self.ui.flagsconflict(self, sorted(modified))
+        return modified
 
     # Interface from BaseFolder
     def change_message_uid(self, uid, new_uid):
@@ -1080,8 +1158,9 @@ class IMAPFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        self.__addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
+        self.__processmessagesflags('+', uidlist, set('T'))
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             try:
                 imapobj.select(self.getfullIMAPname())
@@ -1094,3 +1173,225 @@ class IMAPFolder(BaseFolder):
             self.imapserver.releaseconnection(imapobj)
         for uid in uidlist:
             del self.messagelist[uid]
+
+    def countmessages(self):
+        """Returns the number of messages in the folder, from a STATUS
+        command: the folder is not selected."""
+
+        imapobj = self.imapserver.acquireconnection()
+        try:
+            res_type, data = imapobj.status(self.getfullIMAPname(),
+                                            '(MESSAGES)')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        mo = re.search(rb'MESSAGES ([0-9]+)', data[0] or b'')
+        if res_type != 'OK' or mo is None:
+            raise OfflineImapError("STATUS of folder %s[%s] failed. Server "
+                                   "responded: %s %s" % (
+                                       self.getrepository(), self, res_type,
+                                       data), OfflineImapError.ERROR.FOLDER)
+        return int(mo.group(1))
+
+    def searchuids(self):
+        """Returns the set of the UIDs in the folder, without loading the
+        message list."""
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=None)
+        try:
+            imapobj.select(self.getfullIMAPname(), readonly=not
+                           imapobj.isselected(self.getfullIMAPname()))
+            res_type, data = imapobj.uid('search', 'ALL')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        if res_type != 'OK':
+            raise OfflineImapError("UID SEARCH in folder %s[%s] failed. "
+                                   "Server responded: %s %s" % (
+                                       self.getrepository(), self, res_type,
+                                       data), OfflineImapError.ERROR.FOLDER)
+        return set(int(uid) for uid in b' '.join(
+            item for item in data if item).split())
+
+    def fetchheaders(self, uidlist):
+        """Fetches the headers of the messages of uidlist still in the
+        folder.
+
+        :returns: dict of UID -> (headers as bytes, size of the message
+            with CRLF line endings, set of maildir flags)"""
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=None)
+        try:
+            imapobj.select(self.getfullIMAPname(), readonly=not
+                           imapobj.isselected(self.getfullIMAPname()))
+            res_type, data = imapobj.uid(
+                'fetch', imaputil.uid_sequence(uidlist),
+                '(FLAGS RFC822.SIZE BODY.PEEK[HEADER])')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        if res_type != 'OK':
+            raise OfflineImapError("FETCH of headers in folder %s[%s] "
+                                   "failed. Server responded: %s %s" % (
+                                       self.getrepository(), self, res_type,
+                                       data), OfflineImapError.ERROR.FOLDER)
+        headers = {}
+        for num, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            # Items after the literal end up in the next element.
+            response = item[0]
+            if num + 1 < len(data) and isinstance(data[num + 1], bytes):
+                response += data[num + 1]
+            uid, flags, _, _ = imaputil.parse_fetch_flags(response)
+            mo = imaputil.FETCH_SIZE_RE.search(response)
+            if uid is None or mo is None:
+                continue
+            headers[uid] = (item[1], int(mo.group(1)), flags)
+        return headers
+
+    def __copyuids(self, imapobj, command, sequence, dstfolder):
+        """Copies (command 'COPY') or moves (command 'MOVE') the messages of
+        the UID sequence to dstfolder, from the mailbox selected on
+        imapobj.
+
+        :returns: dict of UID -> UID in dstfolder, from the COPYUID
+            responses"""
+
+        res_type, data = imapobj.uid(command, sequence,
+                                     dstfolder.getfullIMAPname())
+        if res_type != 'OK':
+            raise OfflineImapError(
+                "UID %s of messages %s from folder %s to %s[%s] "
+                "failed. Server responded: %s %s" % (
+                    command, sequence, self, dstfolder,
+                    dstfolder.getrepository(), res_type, data),
+                OfflineImapError.ERROR.FOLDER)
+        copied = {}
+        for copyuid in imapobj.response('COPYUID')[1]:
+            if copyuid is None:
+                continue
+            _, srcset, dstset = copyuid.decode('ascii').split()
+            copied.update(zip(imaputil.uid_sequence_to_list(srcset),
+                              imaputil.uid_sequence_to_list(dstset)))
+        return copied
+
+    def _getserveruid(self, uid):
+        """Returns the UID on the server of the message uid."""
+
+        return uid
+
+    def savecopiedmessages(self, copied):
+        """Records the messages copied to this folder on the server.
+
+        :param copied: list of (uid, UID in this folder on the server,
+            flags) of the copied messages
+        :returns: dict of uid -> UID of the message in this folder"""
+
+        saved = {}
+        for uid, serveruid, flags in copied:
+            self.messagelist[serveruid] = \
+                self.msglist_item_initializer(serveruid)
+            self.messagelist[serveruid]['flags'] = flags
+            saved[uid] = serveruid
+        return saved
+
+    # Interface from BaseFolder
+    def copymessagesto(self, uidlist, dstfolder, statusfolder):
+        """Copies the messages with UID COPY if dstfolder is on the same
+        server, rather than downloading and appending them one by one.
+
+        The server must support UIDPLUS to tell the UIDs of the copies.
+        See BaseFolder.copymessagesto()."""
+
+        if not isinstance(dstfolder, IMAPFolder) or dstfolder.filterheaders \
+                or not self.repository.isonsameserver(dstfolder.repository):
+            return uidlist
+        copylist = [uid for uid in uidlist
+                    if uid != 0 and not (uid > 0 and dstfolder.uidexists(uid))]
+        if not copylist:
+            return uidlist
+        serveruids = dict((self._getserveruid(uid), uid) for uid in copylist)
+
+        copied = {}
+        name = self.getfullIMAPname()
+        imapobj = self.imapserver.acquireconnection(name, readonly=None)
+        try:
+            if 'UIDPLUS' not in imapobj.capabilities:
+                return uidlist
+            # COPY works as well on a mailbox selected read-only.
+            imapobj.select(name, readonly=not imapobj.isselected(name))
+            imapobj.response('COPYUID')  # Drop stale responses.
+            self.ui.copyingmessagesonserver(sorted(serveruids), self,
+                                            dstfolder)
+            for _, sequence in imaputil.uid_sequence_chunks(
+                    sorted(serveruids), STORE_SEQUENCE_MAXLEN):
+                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                    break
+                copied.update(self.__copyuids(imapobj, 'COPY', sequence,
+                                              dstfolder))
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.FOLDER:
+                raise
+            # The messages left are copied one by one.
+            self.ui.error(e, exc_info()[2])
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+
+        copies = []
+        for serveruid, dstuid in copied.items():
+            uid = serveruids.get(serveruid)
+            if uid is not None:
+                copies.append((uid, dstuid, self.getmessageflags(uid)))
+        saved = dstfolder.savecopiedmessages(copies)
+        with statusfolder:
+            for uid, _, flags in copies:
+                new_uid = saved.get(uid)
+                if new_uid is None:
+                    continue
+                rtime = self.getmessagetime(uid)
+                if new_uid != uid:
+                    self.change_message_uid(uid, new_uid)
+                    statusfolder.deletemessage(uid)
+                statusfolder.savemessage(new_uid, None, flags, rtime)
+                if 'S' not in flags:
+                    self.have_newmail = True
+        return [uid for uid in uidlist if uid not in saved]
+
+    def movemessagesto(self, uidlist, dstfolder):
+        """Moves messages to dstfolder, a folder of the same repository,
+        on the server: with UID MOVE if supported, or else UID COPY, then
+        flagging them deleted and expunging them.
+
+        The server must support UIDPLUS to tell the UIDs of the messages
+        in dstfolder, nothing is moved otherwise.
+
+        Note that this function does not check against dryrun settings.
+
+        :returns: dict of UID -> UID in dstfolder, of the moved messages"""
+
+        moved = {}
+        imapobj = self.imapserver.acquireconnection(self.getfullIMAPname())
+        try:
+            if 'UIDPLUS' not in imapobj.capabilities:
+                return moved
+            try:
+                imapobj.select(self.getfullIMAPname())
+            except imapobj.readonly:
+                self.ui.deletereadonly(self, uidlist)
+                return moved
+            command = 'MOVE' if 'MOVE' in imapobj.capabilities else 'COPY'
+            imapobj.response('COPYUID')  # Drop stale responses.
+            for uids, sequence in imaputil.uid_sequence_chunks(
+                    uidlist, STORE_SEQUENCE_MAXLEN):
+                moved.update(self.__copyuids(imapobj, command, sequence,
+                                             dstfolder))
+                if command == 'COPY':
+                    self.__storeflags(imapobj, sequence, '+FLAGS.SILENT',
+                                      imaputil.flagsmaildir2imap(set('T')))
+                    if self.expunge:
+                        imapobj.uid('EXPUNGE', sequence)
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        for uid in moved:
+            self.messagelist.pop(uid, None)
+        return moved
@@ -18,21 +18,36 @@
 from sys import exc_info
 import os
 import threading
+import time
+import offlineimap.accounts
 from .Base import BaseFolder
 
 
 class LocalStatusFolder(BaseFolder):
-    """LocalStatus backend implemented as a plain text file."""
+    """LocalStatus backend implemented as a plain text file.
+
+    Each save rewrites the whole file, so changes are not saved one by
+    one: the file is rewritten once autosave_changes changes are pending
+    (or a tenth of the messages, if more), once a change is pending for
+    autosave_interval seconds, on abort, and at the end of the folder
+    sync.  Changes lost in a crash only cause messages to be copied or
+    flagged again, as the status never gets ahead of the folders."""
 
     cur_version = 2
     magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT %d"
+    # Save policy, see above.
+    autosave_changes = 100
+    autosave_interval = 30
 
     def __init__(self, name, repository):
         self.sep = '.'  # needs to be set before super.__init__()
+        self._dirty = 0  # Changes not saved yet.
         super(LocalStatusFolder, self).__init__(name, repository)
         self.root = repository.root
         self.filename = os.path.join(self.getroot(), self.getfolderbasename())
         self.savelock = threading.Lock()
+        self._dirtysince = None
+        self._in_transactions = 0
         # Should we perform fsyncs as often as possible?
         self.doautosave = self.config.getdefaultboolean(
             "general", "fsync", False)
@@ -120,7 +135,7 @@ class LocalStatusFolder(BaseFolder):
                              'to version 2 for %s:%s' % (self.repository, self))
                 self.readstatus_v1(cachefd)
                 cachefd.close()
-                self.save()
+                self.saveall()
 
             # NOTE: Add other format transitions here in the future.
             # elif line == (self.magicline % 2):
@@ -163,10 +178,57 @@ class LocalStatusFolder(BaseFolder):
             self.ui.debug('', "could not remove file %s: %s" %
                           (self.filename, e))
 
+    # Interface from BaseFolder
+    def dropmessagelistcache(self):
+        # Called at the end of the folder sync, even on errors.
+        if self._dirty:
+            self.saveall()
+        super(LocalStatusFolder, self).dropmessagelistcache()
+
+    def __enter__(self):
+        # With group commits, the status must only be saved once the
+        # messages of the batch are synced to disk.
+        with self.savelock:
+            self._in_transactions += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.savelock:
+            self._in_transactions -= 1
+            if self._in_transactions > 0:
+                return
+        if exc_type is not None and self.getfsyncbatch():
+            # The messages of the batch may not be on disk, forget about
+            # the changes not saved yet.
+            self._dirty = 0
+            self._dirtysince = None
+            self.cachemessagelist()
+        else:
+            self._changed(0)
+
+    def _changed(self, count=1):
+        """Records count changes of the messagelist, and saves it if the
+        save policy says so."""
+
+        with self.savelock:
+            self._dirty += count
+            if not self._dirty:
+                return
+            now = time.monotonic()
+            if self._dirtysince is None:
+                self._dirtysince = now
+            if self._in_transactions:
+                return
+            due = self._dirty >= max(self.autosave_changes,
+                                     len(self.messagelist) // 10) or \
+                now - self._dirtysince >= self.autosave_interval
+        if due or offlineimap.accounts.Account.abort_NOW_signal.is_set():
+            self.saveall()
+
     def save(self):
-        """Save changed data to disk. For this backend it is the same as saveall."""
+        """Save changed data to disk, if any."""
 
-        self.saveall()
+        if self._dirty or self.isnewfolder():
+            self.saveall()
 
     def saveall(self):
         """Saves the entire messagelist to disk."""
@@ -188,6 +250,8 @@ class LocalStatusFolder(BaseFolder):
                 fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
                 os.fsync(fd)
                 os.close(fd)
+            self._dirty = 0
+            self._dirtysince = None
 
     # Interface from BaseFolder
     def savemessage(self, uid, msg, flags, rtime, mtime=0, labels=None):
@@ -213,7 +277,7 @@ class LocalStatusFolder(BaseFolder):
         self.messagelist[uid]['time'] = rtime
         self.messagelist[uid]['mtime'] = mtime
         self.messagelist[uid]['labels'] = labels
-        self.save()
+        self._changed()
         return uid
 
     # Interface from BaseFolder
@@ -227,30 +291,37 @@ class LocalStatusFolder(BaseFolder):
     # Interface from BaseFolder
     def savemessageflags(self, uid, flags):
         self.messagelist[uid]['flags'] = flags
-        self.save()
+        self._changed()
+
+    def savemessagesflags(self, uidflags):
+        """Saves flags from a dictionary in a single database operation."""
+
+        for uid, flags in list(uidflags.items()):
+            self.messagelist[uid]['flags'] = flags
+        self._changed(len(uidflags))
 
     def savemessagelabels(self, uid, labels, mtime=None):
         self.messagelist[uid]['labels'] = labels
         if mtime:
             self.messagelist[uid]['mtime'] = mtime
-        self.save()
+        self._changed()
 
     def savemessageslabelsbulk(self, labels):
         """Saves labels from a dictionary in a single database operation."""
 
         for uid, lb in list(labels.items()):
             self.messagelist[uid]['labels'] = lb
-        self.save()
+        self._changed(len(labels))
 
     def addmessageslabels(self, uids, labels):
         for uid in uids:
             self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] | labels
-        self.save()
+        self._changed(len(uids))
 
     def deletemessageslabels(self, uids, labels):
         for uid in uids:
             self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] - labels
-        self.save()
+        self._changed(len(uids))
 
     def getmessagelabels(self, uid):
         return self.messagelist[uid]['labels']
@@ -260,7 +331,7 @@ class LocalStatusFolder(BaseFolder):
 
         for uid, mt in list(mtimes.items()):
             self.messagelist[uid]['mtime'] = mt
-        self.save()
+        self._changed(len(mtimes))
 
     def getmessagemtime(self, uid):
         return self.messagelist[uid]['mtime']
@@ -278,4 +349,4 @@ class LocalStatusFolder(BaseFolder):
 
         for uid in uidlist:
             del (self.messagelist[uid])
-        self.save()
+        self._changed(len(uidlist))
@@ -95,17 +95,28 @@ class LocalStatusSQLiteFolder(BaseFolder):
         self._databaseFileLock = LocalStatusSQLiteFolder.locks[self.filename]
         self._in_transactions = 0
 
+    def __usetransactions(self):
+        # With group commits, the status must only be committed once the
+        # messages of the batch are synced to disk.
+        return not self.dofsync() or self.getfsyncbatch()
+
     def __enter__(self):
-        if not self.dofsync():
+        if self.__usetransactions():
             assert self.connection is not None
             self._in_transactions += 1
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.dofsync():
+        if self.__usetransactions():
             assert self._in_transactions > 0
             self._in_transactions -= 1
             if self._in_transactions < 1:
-                self.connection.commit()
+                if exc_type is not None and self.getfsyncbatch():
+                    # The messages of the batch may not be on disk, forget
+                    # about them. Those which are get re-linked on the
+                    # next sync.
+                    self.connection.rollback()
+                else:
+                    self.connection.commit()
 
 
     def openfiles(self):
@@ -367,6 +378,16 @@ class LocalStatusSQLiteFolder(BaseFolder):
         flags = ''.join(sorted(flags))
         self.__sql_write('UPDATE status SET flags=? WHERE id=?', (flags, uid))
 
+    def savemessagesflags(self, uidflags):
+        """Saves flags from a dictionary in a single database operation."""
+
+        data = [(''.join(sorted(flags)), uid)
+                for uid, flags in list(uidflags.items())]
+        self.__sql_write('UPDATE status SET flags=? WHERE id=?', data,
+                         executemany=True)
+        for uid, flags in list(uidflags.items()):
+            self.messagelist[uid]['flags'] = flags
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
@@ -23,7 +23,8 @@ import os
 from sys import exc_info
 from threading import Lock
 from hashlib import md5
-from offlineimap import OfflineImapError
+from concurrent.futures import ThreadPoolExecutor
+from offlineimap import OfflineImapError, globals
 from .Base import BaseFolder
 from email.errors import NoBoundaryInMultipartDefect
 
@@ -32,10 +33,40 @@ re_uidmatch = re.compile(r',U=(\d+)')
 # Find a numeric timestamp in a string (filename prefix)
 re_timestampmatch = re.compile(r'(\d+)')
 
+# Number of renames handed to a worker at once by savemessagesflags()
+RENAME_CHUNK_SIZE = 256
+
+# fdatasync() is enough for message files and cheaper, but not available
+# everywhere.
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
 timehash = {}
 timelock = Lock()
 
 
+def fsync_dir(dirname):
+    """Makes sure the entries of a directory (e.g. after renames) hit the
+    disk."""
+
+    if os.name == 'nt':
+        return  # Directories can't be opened, nor synced, on Windows.
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fdatasync_file(path):
+    """Makes sure the data of an already written file hits the disk."""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
 def _gettimeseq(date=None):
     global timehash, timelock
     timelock.acquire()
@@ -78,6 +109,58 @@ class MaildirFolder(BaseFolder):
         self.sep_subst = '-'
         if os.path.sep == self.sep_subst:
             self.sep_subst = '_'
+        # Group commit: UID -> flags of the messages saved to tmp/ and not
+        # yet synced nor moved to cur/ or new/, see __exit__().
+        self._pending = {}
+        self._pendinglock = Lock()
+        self._batch_depth = 0
+        # Whether the message list comes from the repository's watcher.
+        self._watched = False
+
+    def __enter__(self):
+        """Starts a group commit if fsync_batch is enabled.
+
+        Messages saved until the matching __exit__() are written to tmp/
+        without being synced."""
+
+        if self.getfsyncbatch():
+            with self._pendinglock:
+                self._batch_depth += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Ends a group commit: all pending messages are synced to disk in
+        one pass, then moved to cur/ or new/.
+
+        This is done even on error, so that callers can commit the status
+        of the messages saved so far."""
+
+        if not self.getfsyncbatch():
+            return
+        with self._pendinglock:
+            self._batch_depth -= 1
+            if self._batch_depth > 0:
+                return
+            pending, self._pending = self._pending, {}
+        if pending:
+            self.__commit_pending(pending)
+
+    def __commit_pending(self, pending):
+        fullname = self.getfullname()
+        paths = [os.path.join(fullname, self.messagelist[uid]['filename'])
+                 for uid in pending]
+        nthreads = self.config.getdefaultint(self.repoconfname,
+                                             "renamethreads", 4)
+        if globals.options.singlethreading or nthreads < 2:
+            for path in paths:
+                fdatasync_file(path)
+        else:
+            # Let the filesystem merge the flushes of concurrent syncs.
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                list(executor.map(fdatasync_file, paths))
+        # Data is on disk, move messages to their final place; this syncs
+        # tmp/, cur/ and new/ once each. Flags may have changed while
+        # pending, so always rebuild the names.
+        self.__savemessagesflags(pending, force=True)
 
     # Interface from BaseFolder
     def getfullname(self):
@@ -174,26 +257,15 @@ class MaildirFolder(BaseFolder):
 
         date_excludees = {}
         for dirannex, filename in files:
-            if filename.startswith('.'):
-                continue  # Ignore dot files.
             # We store just dirannex and filename, ie 'cur/123...'
             filepath = os.path.join(dirannex, filename)
-            # Check maxsize if this message should be considered.
-            if maxsize and (os.path.getsize(
-                    os.path.join(self.getfullname(), filepath)) > maxsize):
+            entry = self.__scanentry(filepath, maxsize)
+            if entry is None:
                 continue
-
-            prefix, uid, fmd5, flags = self._parse_filename(filename)
+            uid, flags = entry
             if uid is None:  # Assign negative uid to upload it.
                 uid = nouidcounter
                 nouidcounter -= 1
-            else:  # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                if not uidmatch:
-                    uid = nouidcounter
-                    nouidcounter -= 1
-                else:
-                    uid = int(uidmatch.group(1))
             if min_uid is not None and uid > 0 and uid < min_uid:
                 continue
             if min_date is not None and not self._iswithintime(filename, min_date):
@@ -226,6 +298,66 @@ class MaildirFolder(BaseFolder):
                         retval[uid] = date_excludees[uid]
         return retval
 
+    def __scanentry(self, filepath, maxsize):
+        """Parses the entry of the folder at filepath ('cur/...' or
+        'new/...').
+
+        :returns: (UID or None if it has no valid UID, flags), or None if
+            the entry is not a message to consider."""
+
+        filename = os.path.basename(filepath)
+        if filename.startswith('.'):
+            return None  # Ignore dot files.
+        # Check maxsize if this message should be considered.
+        if maxsize and (os.path.getsize(
+                os.path.join(self.getfullname(), filepath)) > maxsize):
+            return None
+
+        prefix, uid, fmd5, flags = self._parse_filename(filename)
+        if uid is not None:  # It comes from our folder.
+            uidmatch = re_uidmatch.search(filename)
+            if not uidmatch:
+                uid = None
+            else:
+                uid = int(uidmatch.group(1))
+        return uid, flags
+
+    def __applychanges(self, messagelist, changes):
+        """Updates messagelist, as returned by _scanfolder(), with the
+        entries which changed since it was built.
+
+        Each changed entry is looked up again, so changes are applied
+        whatever happened in between.
+        :returns: messagelist"""
+
+        maxsize = self.getmaxsize()
+        byfilename = dict((msg['filename'], uid)
+                          for uid, msg in messagelist.items())
+        nouidcounter = min([uid for uid in messagelist if uid < 0] + [0]) - 1
+        # Forget about all changed entries first: a message moved from new/
+        # to cur/ keeps its UID.
+        for filepath in changes:
+            uid = byfilename.get(filepath)
+            if uid is not None:
+                del messagelist[uid]
+        for filepath in sorted(changes):
+            if not os.path.exists(os.path.join(self.getfullname(), filepath)):
+                continue
+            try:
+                entry = self.__scanentry(filepath, maxsize)
+            except FileNotFoundError:
+                continue  # Vanished in the meantime.
+            if entry is None:
+                continue
+            uid, flags = entry
+            if uid is None:
+                uid = nouidcounter
+                nouidcounter -= 1
+            messagelist[uid] = self.msglist_item_initializer(uid)
+            messagelist[uid]['flags'] = flags
+            messagelist[uid]['filename'] = filepath
+        return messagelist
+
     # Interface from BaseFolder
     def quickchanged(self, statusfolder):
         """Returns True if the Maildir has changed
@@ -249,10 +381,50 @@ class MaildirFolder(BaseFolder):
     def cachemessagelist(self, min_date=None, min_uid=None):
         if self.ismessagelistempty():
             self.ui.loadmessagelist(self.repository, self)
-            self.messagelist = self._scanfolder(min_date=min_date,
-                                                min_uid=min_uid)
+            watcher = None
+            if min_date is None and min_uid is None:
+                watcher = self.repository.getwatcher()
+            if watcher is None:
+                self.messagelist = self._scanfolder(min_date=min_date,
+                                                    min_uid=min_uid)
+            else:
+                self.__cachewatchedmessagelist(watcher)
             self.ui.messagelistloaded(self.repository, self, self.getmessagecount())
 
+    def __cachewatchedmessagelist(self, watcher):
+        """Loads the message list from the one stored by the watcher at the
+        end of the previous sync, if any, applying the local changes."""
+
+        path = self.getfullname()
+        try:
+            watcher.watch(path)
+        except OSError as e:
+            self.ui.warn("Cannot watch local changes of folder %s, "
+                         "scanning it: %s" % (self, e))
+            self.messagelist = self._scanfolder()
+            return
+        checkedout = watcher.checkout(path)
+        if checkedout is None:
+            self.messagelist = self._scanfolder()
+        else:
+            messagelist, changes = checkedout
+            self.ui.debug('maildir', "Applying %d local changes to folder %s"
+                          % (len(changes), self))
+            self.messagelist = self.__applychanges(messagelist, changes)
+        self._watched = True
+
+    # Interface from BaseFolder
+    def dropmessagelistcache(self):
+        if self._watched:
+            # Keep the list for the next sync, unless it is in an
+            # inconsistent state.
+            self._watched = False
+            if all(msg['filename'][:4] in ('new/', 'cur/')
+                   for msg in self.messagelist.values()):
+                self.repository.getwatcher().checkin(self.getfullname(),
+                                                     self.messagelist)
+        super(MaildirFolder, self).dropmessagelistcache()
+
     # Interface from BaseFolder
     def getmessage(self, uid):
         """Returns an email message object."""
@@ -292,6 +464,16 @@ class MaildirFolder(BaseFolder):
                         OfflineImapError.ERROR.MESSAGE)
         return retval
 
+    # Interface from BaseFolder
+    def getmessagepolicy(self):
+        return '8bit'
+
+    # Interface from BaseFolder
+    def getmessagebytes(self, uid):
+        filename = self.messagelist[uid]['filename']
+        with open(os.path.join(self.getfullname(), filename), 'rb') as fd:
+            return fd.read()
+
     # Interface from BaseFolder
     def getmessagetime(self, uid):
         filename = self.messagelist[uid]['filename']
@@ -315,13 +497,14 @@ class MaildirFolder(BaseFolder):
                      uid, self._foldermd5, self.infosep, ''.join(sorted(flags)))
         return uniq_name.replace(os.path.sep, self.sep_subst)
 
-    def save_to_tmp_file(self, filename, msg, policy=None):
+    def save_to_tmp_file(self, filename, msg, policy=None, dofsync=None):
         """Saves given message to the named temporary file in the
         'tmp' subdirectory of $CWD.
 
         Arguments:
         - filename: name of the temporary file;
         - msg: Email message object
+        - dofsync: whether to fsync the file, defaults to the fsync setting
 
         Returns: relative path to the temporary file
         that was created."""
@@ -359,7 +542,9 @@ class MaildirFolder(BaseFolder):
         fd.write(msg.as_bytes(policy=output_policy))
         # Make sure the data hits the disk.
         fd.flush()
-        if self.dofsync():
+        if dofsync is None:
+            dofsync = self.dofsync()
+        if dofsync:
             os.fsync(fd)
         fd.close()
 
@@ -405,7 +590,11 @@ class MaildirFolder(BaseFolder):
                 # No need to check if message_timestamp is None here since it
                 # would be overridden by _gettimeseq.
         messagename = self.new_message_filename(uid, flags, date=message_timestamp)
-        tmpname = self.save_to_tmp_file(messagename, msg)
+        # In a group commit, the file is synced with the others when the
+        # commit ends.
+        batching = self._batch_depth > 0
+        tmpname = self.save_to_tmp_file(messagename, msg,
+                                        dofsync=None if not batching else False)
 
         if self._utime_from_header is True:
             try:
@@ -424,6 +613,11 @@ class MaildirFolder(BaseFolder):
         self.messagelist[uid] = self.msglist_item_initializer(uid)
         self.messagelist[uid]['flags'] = flags
         self.messagelist[uid]['filename'] = tmpname
+        if batching:
+            with self._pendinglock:
+                self._pending[uid] = flags
+            self.ui.debug('maildir', 'savemessage: pending uid %d' % uid)
+            return uid
         # savemessageflags moves msg to 'cur' or 'new' as appropriate.
         self.savemessageflags(uid, flags)
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
@@ -433,6 +627,28 @@ class MaildirFolder(BaseFolder):
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
+    def __flags_filename(self, uid, flags, force=False):
+        """Returns the relative filename of message uid once its flags are
+        set to the given set.
+
+        The message goes into 'cur' if it has been seen, 'new' otherwise.
+        The flags part of the name is only rebuilt if flags changed, unless
+        force is set."""
+
+        dir_prefix, filename = os.path.split(self.messagelist[uid]['filename'])
+        dir_prefix = 'cur' if 'S' in flags else 'new'
+
+        if force or flags != self.messagelist[uid]['flags']:
+            # Flags have actually changed, construct new filename Strip
+            # off existing infostring
+            infomatch = self.re_flagmatch.search(filename)
+            if infomatch:
+                filename = filename[:-len(infomatch.group())]  # strip off
+            infostr = '%s2,%s' % (self.infosep, ''.join(sorted(flags)))
+            filename += infostr
+
+        return os.path.join(dir_prefix, filename)
+
     # Interface from BaseFolder
     def savemessageflags(self, uid, flags):
         """Sets the specified message's flags to the given set.
@@ -446,21 +662,15 @@ class MaildirFolder(BaseFolder):
 
         assert uid in self.messagelist
 
-        oldfilename = self.messagelist[uid]['filename']
-        dir_prefix, filename = os.path.split(oldfilename)
-        # If a message has been seen, it goes into 'cur'
-        dir_prefix = 'cur' if 'S' in flags else 'new'
-
-        if flags != self.messagelist[uid]['flags']:
-            # Flags have actually changed, construct new filename Strip
-            # off existing infostring
-            infomatch = self.re_flagmatch.search(filename)
-            if infomatch:
-                filename = filename[:-len(infomatch.group())]  # strip off
-            infostr = '%s2,%s' % (self.infosep, ''.join(sorted(flags)))
-            filename += infostr
+        with self._pendinglock:
+            if uid in self._pending:
+                # Still in tmp/, it will get its flags when committed.
+                self._pending[uid] = flags
+                self.messagelist[uid]['flags'] = flags
+                return
 
-        newfilename = os.path.join(dir_prefix, filename)
+        oldfilename = self.messagelist[uid]['filename']
+        newfilename = self.__flags_filename(uid, flags)
         if newfilename != oldfilename:
             try:
                 os.rename(os.path.join(self.getfullname(), oldfilename),
@@ -475,6 +685,100 @@ class MaildirFolder(BaseFolder):
             self.messagelist[uid]['flags'] = flags
             self.messagelist[uid]['filename'] = newfilename
 
+    def savemessagesflags(self, uidflags):
+        """Sets the flags of many messages at once.
+
+        All new filenames are computed first, then the renames are done
+        grouped by source and destination directory, in a pool of
+        'renamethreads' threads if there are enough of them. With fsync
+        enabled, each touched directory is synced once at the end
+        rather than relying on per-message syncs.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode.
+
+        :param uidflags: dict of UID -> new set of flags"""
+
+        self.__savemessagesflags(uidflags)
+
+    def __savemessagesflags(self, uidflags, force=False):
+        renames = []
+        for uid, flags in uidflags.items():
+            oldfilename = self.messagelist[uid]['filename']
+            newfilename = self.__flags_filename(uid, flags, force)
+            if newfilename != oldfilename:
+                renames.append((os.path.dirname(oldfilename),
+                                os.path.dirname(newfilename),
+                                uid, oldfilename, newfilename))
+            else:
+                self.messagelist[uid]['flags'] = flags
+        if not renames:
+            return
+        # Keep renames between the same directories together, so that each
+        # worker mostly works on one directory pair.
+        renames.sort()
+
+        fullname = self.getfullname()
+        done = []
+        failures = []
+
+        def rename_chunk(chunk):
+            for _, _, uid, oldfilename, newfilename in chunk:
+                try:
+                    os.rename(os.path.join(fullname, oldfilename),
+                              os.path.join(fullname, newfilename))
+                except OSError as e:
+                    failures.append((oldfilename, newfilename, e))
+                else:
+                    done.append((uid, newfilename))
+
+        nthreads = self.config.getdefaultint(self.repoconfname,
+                                             "renamethreads", 4)
+        if globals.options.singlethreading or nthreads < 2 or \
+                len(renames) < RENAME_CHUNK_SIZE * 2:
+            rename_chunk(renames)
+        else:
+            chunks = [renames[i:i + RENAME_CHUNK_SIZE]
+                      for i in range(0, len(renames), RENAME_CHUNK_SIZE)]
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                list(executor.map(rename_chunk, chunks))
+
+        for uid, newfilename in done:
+            self.messagelist[uid]['flags'] = uidflags[uid]
+            self.messagelist[uid]['filename'] = newfilename
+
+        if self.dofsync():
+            dirs = set()
+            for srcdir, dstdir, _, _, _ in renames:
+                dirs.add(srcdir)
+                dirs.add(dstdir)
+            for dirname in sorted(dirs):
+                fsync_dir(os.path.join(fullname, dirname))
+
+        if failures:
+            oldfilename, newfilename, e = failures[0]
+            raise OfflineImapError(
+                "Can't rename file '%s' to '%s': %s (%d rename(s) failed)" %
+                (oldfilename, newfilename, e.errno, len(failures)),
+                OfflineImapError.ERROR.FOLDER)
+
+    # Interface from BaseFolder
+    def addmessagesflags(self, uidlist, flags):
+        """Bulk variant of addmessageflags(), see savemessagesflags()."""
+
+        self.savemessagesflags(dict(
+            (uid, self.getmessageflags(uid) | flags)
+            for uid in uidlist if self.uidexists(uid)))
+
+    # Interface from BaseFolder
+    def deletemessagesflags(self, uidlist, flags):
+        """Bulk variant of deletemessageflags(), see savemessagesflags()."""
+
+        self.savemessagesflags(dict(
+            (uid, self.getmessageflags(uid) - flags)
+            for uid in uidlist))
+
     # Interface from BaseFolder
     def change_message_uid(self, uid, new_uid):
         """Change the message from existing uid to new_uid
@@ -505,6 +809,27 @@ class MaildirFolder(BaseFolder):
         self.messagelist[new_uid]['filename'] = newfilename
         del self.messagelist[uid]
 
+    def movemessageto(self, uid, dstfolder, new_uid):
+        """Moves the message to dstfolder, a Maildir folder on the same
+        file system, as new_uid: the file is renamed, keeping its flags.
+
+        This will not update the statusfolder UIDs, you need to do that
+        yourself."""
+
+        oldfilename = self.messagelist[uid]['filename']
+        dir_prefix, filename = os.path.split(oldfilename)
+        flags = self.getmessageflags(uid)
+        newfilename = os.path.join(dir_prefix,
+                                   dstfolder.new_message_filename(new_uid,
+                                                                  flags))
+        os.rename(os.path.join(self.getfullname(), oldfilename),
+                  os.path.join(dstfolder.getfullname(), newfilename))
+        if self.dofsync():
+            fsync_dir(os.path.join(dstfolder.getfullname(), dir_prefix))
+            fsync_dir(os.path.join(self.getfullname(), dir_prefix))
+        dstfolder.messagelist[new_uid] = self.messagelist.pop(uid)
+        dstfolder.messagelist[new_uid]['filename'] = newfilename
+
     # Interface from BaseFolder
     def deletemessage(self, uid):
         """Unlinks a message file from the Maildir.
@@ -182,6 +182,15 @@ class MappedIMAPFolder(IMAPFolder):
     def dropmessagelistcache(self):
         self._mb.dropmessagelistcache()
 
+    # Interface from BaseFolder
+    def forgetsyncstate(self):
+        """Also reloads the UID maps, which may have been changed or
+        removed since."""
+
+        super(MappedIMAPFolder, self).forgetsyncstate()
+        self._mb.forgetsyncstate()
+        self.diskr2l, self.diskl2r = self._loadmaps()
+
     # Interface from BaseFolder
     def uidexists(self, ruid):
         """Checks if the (remote) UID exists in this Folder"""
@@ -239,6 +248,10 @@ class MappedIMAPFolder(IMAPFolder):
         """Returns the specified message."""
         return self._mb.getmessage(self.r2l[uid])
 
+    # Interface from BaseFolder
+    def getmessagebytes(self, uid):
+        return self._mb.getmessagebytes(self.r2l[uid])
+
     # Interface from BaseFolder
     def savemessage(self, uid, msg, flags, rtime):
         """Writes a new message, with the specified uid.
@@ -287,6 +300,27 @@ class MappedIMAPFolder(IMAPFolder):
             self._savemaps()
         return uid
 
+    def _getserveruid(self, uid):
+        return self.r2l[uid]
+
+    def savecopiedmessages(self, copied):
+        """Records the messages copied to this folder on the server, see
+        IMAPFolder.savecopiedmessages().  The uids are those of the remote
+        folder, the messages without positive uid are not recorded."""
+
+        copied = [(uid, luid, flags) for uid, luid, flags in copied
+                  if uid > 0]
+        self._mb.savecopiedmessages(copied)
+        with self.maplock:
+            for uid, luid, _ in copied:
+                self.diskl2r[luid] = uid
+                self.diskr2l[uid] = luid
+                self.l2r[luid] = uid
+                self.r2l[uid] = luid
+            if copied:
+                self._savemaps()
+        return dict((uid, uid) for uid, _, _ in copied)
+
     # Interface from BaseFolder
     def getmessageflags(self, uid):
         return self._mb.getmessageflags(self.r2l[uid])
@@ -309,8 +343,11 @@ class MappedIMAPFolder(IMAPFolder):
 
     # Interface from BaseFolder
     def addmessagesflags(self, uidlist, flags):
-        self._mb.addmessagesflags(self._uidlist(self.r2l, uidlist),
-                                  flags)
+        modified = self._mb.addmessagesflags(
+            self._uidlist(self.r2l, uidlist), flags)
+        if modified:
+            return set(self._uidlist(self.l2r, modified))
+        return modified
 
     # Interface from BaseFolder
     def change_message_uid(self, ruid, new_ruid):
@@ -366,8 +403,11 @@ class MappedIMAPFolder(IMAPFolder):
 
     # Interface from BaseFolder
     def deletemessagesflags(self, uidlist, flags):
-        self._mb.deletemessagesflags(self._uidlist(self.r2l, uidlist),
-                                     flags)
+        modified = self._mb.deletemessagesflags(
+            self._uidlist(self.r2l, uidlist), flags)
+        if modified:
+            return set(self._uidlist(self.l2r, modified))
+        return modified
 
     # Interface from BaseFolder
     def deletemessage(self, uid):
@@ -1,4 +1,16 @@
 """
 Folder Module of offlineimap
+
+The folder modules are imported on first use, e.g. folder.IMAP, so that a
+run only loads the folder types of its repositories.
 """
-from . import Base, Gmail, IMAP, Maildir, LocalStatus, UIDMaps
+from importlib import import_module
+
+_MODULES = ('Base', 'Gmail', 'GmailMaildir', 'IMAP', 'LocalStatus',
+            'LocalStatusSQLite', 'Maildir', 'UIDMaps')
+
+
+def __getattr__(name):
+    if name in _MODULES:
+        return import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
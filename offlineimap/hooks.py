@@ -0,0 +1,134 @@
+"""
+Long-lived hook process of an account.
+
+With 'hookprocess' set in the account section, a single process is
+started for the account instead of a shell per hook call.  It gets the
+sync events as JSON objects on its stdin, one per line:
+
+- {"event": "presync", "account": ..., "syncmode": ...} before each sync
+  of the account, or of a folder on IDLE,
+- {"event": "folder", "account": ..., "syncmode": ..., "folder": ...,
+  "new": ..., "deleted": ..., "flagged": ...} once a folder is synced,
+  with the number of messages added, deleted and with changed flags,
+- {"event": "postsync", "account": ..., "syncmode": ...} after the sync.
+
+The syncmode is full, quick or idle.  The process writes a line to its
+stdout once an event is handled; the line is logged as the output of the
+hook.  Without this line within 'hooktimeout' seconds, the process is
+killed, and started again for the next event.  The process gets EOF on
+its stdin when the account is done.
+"""
+
+import json
+import os
+from queue import Queue, Empty
+from subprocess import Popen, PIPE, TimeoutExpired
+from threading import Lock, Thread
+
+from offlineimap.ui import getglobalui
+
+# Time given to the process to exit on EOF, in seconds.
+STOP_TIMEOUT = 5
+
+
+class HookProcess:
+    """The hook process of an account, see the module documentation."""
+
+    def __init__(self, account, command, timeout):
+        self.account = account
+        self.command = command
+        self.timeout = timeout
+        self.ui = getglobalui()
+        self.lock = Lock()
+        self.proc = None
+        self.lines = None
+
+    def __start(self):
+        self.ui.callhook("Starting hook process: " + self.command)
+        self.proc = Popen(self.command, shell=True, stdin=PIPE, stdout=PIPE,
+                          stderr=PIPE, close_fds=True, env=os.environ.copy())
+        # The queue of each process gets its lines only, the lines of a
+        # killed process are never taken for an acknowledgement.
+        self.lines = Queue()
+        for stream, queue in ((self.proc.stdout, self.lines),
+                              (self.proc.stderr, None)):
+            thread = Thread(target=self.__reader, args=(stream, queue),
+                            name="Hook process reader [acc: %s]" %
+                                 self.account)
+            thread.daemon = True
+            thread.start()
+
+    def __reader(self, stream, queue):
+        """Logs the stderr lines of the process, and queues its stdout
+        lines, then None on EOF."""
+
+        for line in stream:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            if queue is None:
+                self.ui.callhook("Hook process stderr: %s" % line)
+            else:
+                queue.put(line)
+        if queue is not None:
+            queue.put(None)
+        stream.close()
+
+    def __kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.__close()
+
+    def __close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc = None
+
+    def send(self, event, syncmode, **values):
+        """Sends an event to the process, started if need be, and waits for
+        its acknowledgement."""
+
+        data = dict(event=event, account=self.account.getname(),
+                    syncmode=syncmode, **values)
+        line = (json.dumps(data) + '\n').encode('utf-8')
+        with self.lock:
+            if self.proc is not None and self.proc.poll() is not None:
+                self.ui.warn("Hook process of account %s exited with code "
+                             "%d, restarting it" % (self.account,
+                                                    self.proc.returncode))
+                self.__close()
+            if self.proc is None:
+                self.__start()
+            try:
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+                answer = self.lines.get(timeout=self.timeout)
+            except BrokenPipeError:
+                answer = None
+            except Empty:
+                self.ui.warn("Hook process of account %s did not answer "
+                             "event %s within %s seconds, killing it" %
+                             (self.account, event, self.timeout))
+                self.__kill()
+                return
+            if answer is None:
+                self.ui.warn("Hook process of account %s exited on event "
+                             "%s" % (self.account, event))
+                self.__kill()
+                return
+        self.ui.callhook("Hook process: %s" % answer)
+
+    def stop(self):
+        """Closes the stdin of the process and waits for it to exit, kills
+        it after STOP_TIMEOUT seconds."""
+
+        with self.lock:
+            if self.proc is None:
+                return
+            proc = self.proc
+            self.__close()
+            try:
+                proc.wait(STOP_TIMEOUT)
+            except TimeoutExpired:
+                proc.kill()
+                proc.wait()
@@ -13,7 +13,6 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
-import datetime
 import os
 import time
 import subprocess
@@ -22,30 +21,47 @@ import socket
 import errno
 import zlib
 import fcntl
+from contextlib import contextmanager
 from sys import exc_info
 from hashlib import sha512, sha384, sha256, sha224, sha1
+import ssl
 import rfc6555
-from offlineimap import OfflineImapError
+from offlineimap import OfflineImapError, imaputil
 from offlineimap.ui import getglobalui
 from imaplib2 import IMAP4, IMAP4_SSL, InternalDate
 
 
 class UsefulIMAPMixIn:
+    # Addresses and TLS state shared with the other connections to the
+    # same server, see imapserver.IMAPHost.
+    _hoststate = None
+    # Untagged responses not kept, see discarding().
+    _discarded = frozenset()
+    # SELECT commands skipped since the connection was last released,
+    # see imapserver.IMAPServer.releaseconnection().
+    selectsavoided = 0
+
     def __getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
         return None
 
+    def isselected(self, mailbox, readonly=False):
+        """Whether mailbox is selected in the readonly mode, or in any
+        mode if readonly is None."""
+
+        return self.__getselectedfolder() == mailbox and \
+            readonly in (None, self.is_readonly)
+
     def select(self, mailbox='INBOX', readonly=False, force=False):
         """Selects a mailbox on the IMAP server
 
         :returns: 'OK' on success, nothing if the folder was already
         selected or raises an :exc:`OfflineImapError`."""
 
-        if self.__getselectedfolder() == mailbox and \
-                self.is_readonly == readonly and \
-                not force:
+        if not force and self.isselected(mailbox, readonly):
             # No change; return.
+            self.selectsavoided += 1
             return
         try:
             result = super(UsefulIMAPMixIn, self).select(mailbox, readonly)
@@ -67,6 +83,30 @@ class UsefulIMAPMixIn:
             raise OfflineImapError(errstr, severity)
         return result
 
+    @contextmanager
+    def discarding(self, *names):
+        """Drops the untagged responses of the given types, e.g. 'FETCH',
+        received within this context, and those still pending.
+
+        The server sends FETCH responses when other clients change the
+        flags of messages: they would pile up until the next FETCH
+        command returns them along with its own responses."""
+
+        for name in names:
+            while self._get_untagged_response(name) is not None:
+                pass
+        self._discarded = frozenset(names)
+        try:
+            yield
+        finally:
+            self._discarded = frozenset()
+
+    # Overrides private function from IMAP4 (@imaplib2)
+    def _append_untagged(self, typ, dat):
+        if typ in self._discarded:
+            return
+        super(UsefulIMAPMixIn, self)._append_untagged(typ, dat)
+
     # Overrides private function from IMAP4 (@imaplib2)
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
@@ -75,14 +115,31 @@ class UsefulIMAPMixIn:
     def open_socket(self):
         """open_socket()
         Open socket choosing first address family available."""
-        if self.af == socket.AF_UNSPEC:
+        hoststate = self._hoststate
+        try:
+            if self.af != socket.AF_UNSPEC:
+                return self._open_socket_for_af(self.af)
+            if hoststate is not None and hoststate.family is not None:
+                # Another connection already found which family works.
+                return self._open_socket_for_af(hoststate.family)
             # happy-eyeballs!
-            return rfc6555.create_connection((self.host, self.port))
-        else:
-            return self._open_socket_for_af(self.af)
+            sock = rfc6555.create_connection((self.host, self.port))
+            if hoststate is not None:
+                hoststate.family = sock.family
+            return sock
+        except socket.error:
+            # Maybe the network changed, resolve again next time.
+            if hoststate is not None:
+                hoststate.forgetaddresses()
+            raise
 
     def _open_socket_for_af(self, af):
-        for res in socket.getaddrinfo(self.host, self.port, af, socket.SOCK_STREAM):
+        if self._hoststate is not None:
+            addresses = self._hoststate.getaddrinfo(af)
+        else:
+            addresses = socket.getaddrinfo(self.host, self.port, af,
+                                           socket.SOCK_STREAM)
+        for res in addresses:
             af, socktype, proto, canonname, sa = res
             try:
                 # use socket of our own, possibly SOCKS socket.
@@ -179,7 +236,50 @@ def new_mesg(self, s, tn=None, secs=None):
     if tn is None:
         tn = threading.currentThread().getName()
     tm = time.strftime('%M:%S', time.localtime(secs))
-    getglobalui().debug('imap', '  %s.%02d %s %s' % (tm, (secs * 100) % 100, tn, s))
+    getglobalui().debug('imap', '  %s.%02d %s %s', tm, (secs * 100) % 100, tn, s)
+
+
+def new_ssl_context(tls_level, ssl_version, ca_certs, certfile, keyfile):
+    """Returns the SSLContext imaplib2 sets up for each connection with
+    these settings."""
+
+    protocols = {}
+    if hasattr(ssl, "PROTOCOL_TLSv1_2"):
+        protocols["tls_secure"] = {
+            "tls1_2": ssl.PROTOCOL_TLSv1_2,
+            "tls1_1": ssl.PROTOCOL_TLSv1_1,
+        }
+    else:
+        protocols["tls_secure"] = {}
+    protocols["tls_no_ssl"] = protocols["tls_secure"].copy()
+    protocols["tls_no_ssl"].update({
+        "tls1": ssl.PROTOCOL_TLSv1,
+    })
+    protocols["tls_compat"] = protocols["tls_no_ssl"].copy()
+    protocols["tls_compat"].update({
+        "ssl23": ssl.PROTOCOL_SSLv23,
+        None: ssl.PROTOCOL_SSLv23,
+    })
+    if hasattr(ssl, "PROTOCOL_SSLv3"):  # Might not be available.
+        protocols["tls_compat"].update({
+            "ssl3": ssl.PROTOCOL_SSLv3
+        })
+
+    if tls_level not in protocols:
+        raise RuntimeError("unknown tls_level: %s" % tls_level)
+    if ssl_version not in protocols[tls_level]:
+        raise ssl.SSLError("Invalid SSL version '%s' requested for "
+                           "tls_version '%s'" % (ssl_version, tls_level))
+
+    ctx = ssl.SSLContext(protocols[tls_level][ssl_version])
+    if ca_certs is not None:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(ca_certs)
+    else:
+        ctx.verify_mode = ssl.CERT_NONE
+    if certfile or keyfile:
+        ctx.load_cert_chain(certfile, keyfile)
+    return ctx
 
 
 class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
@@ -189,6 +289,9 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
         if "af" in kwargs:
             self.af = kwargs['af']
             del kwargs['af']
+        if "hoststate" in kwargs:
+            self._hoststate = kwargs['hoststate']
+            del kwargs['hoststate']
         if "use_socket" in kwargs:
             self.socket = kwargs['use_socket']
             del kwargs['use_socket']
@@ -222,6 +325,29 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
                                         self._fingerprint),
                                        OfflineImapError.ERROR.REPO)
 
+    # Overrides function from IMAP4_SSL (@imaplib2)
+    def ssl_wrap_socket(self):
+        """Same as imaplib2, but the SSLContext is shared by all the
+        connections to the server and the last TLS session is resumed."""
+
+        if self._hoststate is None:
+            return super(WrappedIMAP4_SSL, self).ssl_wrap_socket()
+        ctx, session = self._hoststate.getssl(
+            self.tls_level, self.ssl_version, self.ca_certs,
+            self.certfile, self.keyfile)
+        self.sock = ctx.wrap_socket(self.sock, server_hostname=self.host,
+                                    session=session)
+        self.read_fd = self.sock.fileno()
+
+        if self.cert_verify_cb is not None:
+            cert_err = self.cert_verify_cb(self.sock.getpeercert(), self.host)
+            if cert_err:
+                raise ssl.SSLError(cert_err)
+
+        # Allow sending of keep-alive messages - seems to prevent some servers
+        # from closing SSL, leading to deadlocks.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
 
 class WrappedIMAP4(UsefulIMAPMixIn, IMAP4):
     """Improved version of imaplib.IMAP4 overriding select()."""
@@ -230,6 +356,9 @@ class WrappedIMAP4(UsefulIMAPMixIn, IMAP4):
         if "af" in kwargs:
             self.af = kwargs['af']
             del kwargs['af']
+        if "hoststate" in kwargs:
+            self._hoststate = kwargs['hoststate']
+            del kwargs['hoststate']
         if "use_socket" in kwargs:
             self.socket = kwargs['use_socket']
             del kwargs['use_socket']
@@ -248,8 +377,7 @@ def Internaldate2epoch(resp):
         return None
 
     # Get the month number
-    datetime_object = datetime.datetime.strptime(mo.group('mon').decode('utf-8'), "%b")
-    mon = datetime_object.month
+    mon = imaputil.MONTHS[mo.group('mon')]
 
     zonen = mo.group('zonen')
 
@@ -28,7 +28,8 @@ import socket
 from socket import gaierror
 from sys import exc_info
 from ssl import SSLError, cert_time_to_seconds
-from threading import Lock, BoundedSemaphore, Thread, Event, current_thread
+from threading import Lock, BoundedSemaphore, Thread, Event, Condition, \
+    current_thread
 import offlineimap.accounts
 from offlineimap import imaplibutil, imaputil, threadutil, OfflineImapError
 from offlineimap.ui import getglobalui
@@ -39,6 +40,153 @@ try:
 except ImportError:
     have_gss = False
 
+# How long resolved addresses of a server are reused, in seconds.
+ADDRINFO_TTL = 60
+
+_hosts = {}
+_hostslock = Lock()
+
+
+def gethost(hostname, port):
+    """Returns the process-wide IMAPHost for hostname and port."""
+
+    key = (hostname.lower(), port)
+    with _hostslock:
+        if key not in _hosts:
+            _hosts[key] = IMAPHost(hostname, port)
+        return _hosts[key]
+
+
+class IMAPHost:
+    """State shared by the IMAPServer instances of all the accounts
+    connecting to the same host and port.
+
+    Each connection open to the host holds a slot, there are at most
+    maxhostconnections of them.  Idle connections are passed between the
+    servers with maxhostconnections set and the same shareid, and those of
+    the other servers are closed when a slot is needed.  Resolved addresses
+    and TLS contexts and sessions are shared by all the connections."""
+
+    def __init__(self, hostname, port):
+        self.ui = getglobalui()
+        self.hostname = hostname
+        self.port = port
+        self.family = None  # Address family that worked last, if any.
+        self.maxconnections = 0  # Unlimited.
+        self.connections = 0
+        self.servers = []
+        self.lock = Lock()
+        self.released = Condition(self.lock)
+        self._addrinfo = {}
+        self._sslcontexts = {}
+        self._sslsessions = {}
+
+    def register(self, server, maxconnections):
+        """Adds server to the servers of the host.  The lowest
+        maxconnections of all the servers applies, 0 means unlimited."""
+
+        with self.lock:
+            self.servers.append(server)
+            if maxconnections > 0 and (self.maxconnections == 0 or
+                                       maxconnections < self.maxconnections):
+                self.maxconnections = maxconnections
+
+    def __idleconnection(self, server, sameuser):
+        with self.lock:
+            servers = list(self.servers)
+        for other in servers:
+            if sameuser and not (server.sharesconnections and
+                                 other.sharesconnections):
+                continue
+            if (other.shareid == server.shareid) == sameuser:
+                imapobj = other.takeidleconnection()
+                if imapobj is not None:
+                    return imapobj
+        return None
+
+    def acquire(self, server):
+        """Gets a slot for a new connection of server, waiting for one if
+        there are maxconnections already.
+
+        :returns: an idle connection of a server it can share connections
+            with, it keeps its slot, or None if server has to open a
+            connection."""
+
+        while True:
+            imapobj = self.__idleconnection(server, True)
+            if imapobj is not None:
+                self.ui.debug('imap', "%s: reusing a connection to %s" %
+                              (server.repos, self.hostname))
+                return imapobj
+            with self.lock:
+                if not self.maxconnections or \
+                        self.connections < self.maxconnections:
+                    self.connections += 1
+                    return None
+            imapobj = self.__idleconnection(server, False)
+            if imapobj is not None:
+                self.ui.debug('imap', "%s: closing an idle connection of "
+                              "another account to %s" %
+                              (server.repos, self.hostname))
+                imapobj.logout()
+                self.release()
+                continue
+            with self.lock:
+                if self.connections >= self.maxconnections:
+                    # Also poll, the servers do not notify when a
+                    # connection becomes idle.
+                    self.released.wait(1)
+
+    def release(self, count=1):
+        """Releases the slots of count connections which were closed.  A
+        count of 0 wakes up the servers waiting for a connection to become
+        idle."""
+
+        with self.lock:
+            self.connections -= count
+            self.released.notify_all()
+
+    def getaddrinfo(self, af):
+        """Same as socket.getaddrinfo() for the host, cached for
+        ADDRINFO_TTL seconds."""
+
+        now = time.monotonic()
+        with self.lock:
+            expires, addresses = self._addrinfo.get(af, (0, None))
+        if expires <= now:
+            addresses = socket.getaddrinfo(self.hostname, self.port, af,
+                                           socket.SOCK_STREAM)
+            with self.lock:
+                self._addrinfo[af] = (now + ADDRINFO_TTL, addresses)
+        return addresses
+
+    def forgetaddresses(self):
+        with self.lock:
+            self._addrinfo.clear()
+            self.family = None
+
+    def getssl(self, tls_level, ssl_version, ca_certs, certfile, keyfile):
+        """Returns (SSLContext, TLS session to resume or None) for the
+        settings."""
+
+        key = (tls_level, ssl_version, ca_certs, certfile, keyfile)
+        with self.lock:
+            ctx = self._sslcontexts.get(key)
+            if ctx is None:
+                ctx = imaplibutil.new_ssl_context(*key)
+                self._sslcontexts[key] = ctx
+            return ctx, self._sslsessions.get(ctx)
+
+    def savesslsession(self, imapobj):
+        """Keeps the TLS session of imapobj to be resumed by the next
+        connections.  Servers send the session tickets after the
+        handshake, so this is best done once logged in."""
+
+        session = getattr(imapobj.sock, 'session', None)
+        if session is not None:
+            with self.lock:
+                self._sslsessions[imapobj.sock.context] = session
+
 
 class IMAPServer:
     """Initializes all variables from an IMAPRepository() instance
@@ -118,6 +266,7 @@ class IMAPServer:
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        self.selectsavoided = 0
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
         self.reference = repos.getreference()
@@ -142,6 +291,22 @@ class IMAPServer:
         self.authproxied_socket = self._get_proxy('authproxy',
                                                   self.proxied_socket)
 
+        # Idle connections are handed over to the other servers of the host
+        # only with maxhostconnections set, and only to those with the same
+        # shareid: logged in as the same user, with the same settings.
+        self.sharesconnections = repos.getmaxhostconnections() > 0
+        self.shareid = (self.username, self.user_identity, self.usessl,
+                        self.starttls, self.tlslevel, self.sslversion,
+                        self.sslcacertfile, self.sslclientcert,
+                        self.sslclientkey, self.fingerprint, self.af,
+                        self.proxied_socket, self.reference,
+                        repos.getconfboolean('usecompression', False),
+                        repos.getconfboolean('readonly', False))
+        self.host = None
+        if self.hostname is not None:
+            self.host = gethost(self.hostname, self.port)
+            self.host.register(self, repos.getmaxhostconnections())
+
     def _get_proxy(self, proxysection, dfltsocket):
         _account_section = 'Account ' + self.repos.account.name
         if not self.config.has_option(_account_section, proxysection):
@@ -501,11 +666,15 @@ class IMAPServer:
 
         return '%s no matching domain name found in certificate' % errstr
 
-    def acquireconnection(self):
+    def acquireconnection(self, mailbox=None, readonly=False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param mailbox: the mailbox the caller will select, a connection on
+            which it is already selected in the readonly mode (any mode if
+            None) is preferred to save the SELECT."""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
@@ -517,15 +686,24 @@ class IMAPServer:
             imap_debug = 5
 
         if len(self.availableconnections):  # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
+            # Try to find one that has the mailbox selected already, or
+            # else one that previously belonged to this thread as an
+            # optimization.  Start from the back since that's where
             # they're popped on.
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == curThread.ident:
-                    imapobj = tryobj
-                    del (self.availableconnections[i])
-                    break
+            if mailbox is not None:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if tryobj.isselected(mailbox, readonly):
+                        imapobj = tryobj
+                        del (self.availableconnections[i])
+                        break
+            if not imapobj:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner[tryobj] == curThread.ident:
+                        imapobj = tryobj
+                        del (self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del (self.availableconnections[0])
@@ -539,7 +717,14 @@ class IMAPServer:
         # Must be careful here that if we fail we should bail out gracefully
         # and release locks / threads so that the next attempt can try...
         success = False
+        hostslot = False
+        reused = False
         try:
+            if self.host is not None:
+                imapobj = self.host.acquire(self)
+                hostslot = True
+                success = imapobj is not None
+                reused = success
             while success is not True:
                 # Generate a new connection.
                 if self.tunnel:
@@ -571,6 +756,7 @@ class IMAPServer:
                         use_socket=self.proxied_socket,
                         tls_level=self.tlslevel,
                         af=self.af,
+                        hoststate=self.host,
                     )
                 else:
                     self.ui.connecting(
@@ -581,6 +767,7 @@ class IMAPServer:
                         use_socket=self.proxied_socket,
                         debug=imap_debug,
                         af=self.af,
+                        hoststate=self.host,
                     )
 
                 # If 'ID' extension is used by the server, we should use it
@@ -596,17 +783,25 @@ class IMAPServer:
                     except OfflineImapError as e:
                         self.passworderror = str(e)
                         raise
-
-            # Enable compression
-            if self.repos.getconfboolean('usecompression', 0):
-                imapobj.enable_compression()
-
-            # update capabilities after login, e.g. gmail serves different ones
-            typ, dat = imapobj.capability()
-            if dat != [None]:
-                # Get the capabilities and convert them to string from bytes
-                s_dat = [x.decode('utf-8') for x in dat[-1].upper().split()]
-                imapobj.capabilities = tuple(s_dat)
+                reused = False
+
+            if not reused:
+                if self.host is not None and self.usessl:
+                    self.host.savesslsession(imapobj)
+
+                # Enable compression
+                if self.repos.getconfboolean('usecompression', 0):
+                    imapobj.enable_compression()
+
+                # update capabilities after login, e.g. gmail serves
+                # different ones
+                typ, dat = imapobj.capability()
+                if dat != [None]:
+                    # Get the capabilities and convert them to string from
+                    # bytes
+                    s_dat = [x.decode('utf-8')
+                             for x in dat[-1].upper().split()]
+                    imapobj.capabilities = tuple(s_dat)
 
             if self.delim is None:
                 listres = imapobj.list(self.reference, '""')[1]
@@ -637,6 +832,13 @@ class IMAPServer:
             error..."""
 
             self.semaphore.release()
+            if hostslot:
+                if imapobj is not None:
+                    try:
+                        imapobj.logout()
+                    except Exception:
+                        pass
+                self.host.release()
 
             severity = OfflineImapError.ERROR.REPO
             if type(e) == gaierror:
@@ -693,19 +895,6 @@ class IMAPServer:
             # re-raise all other errors
             raise
 
-    def connectionwait(self):
-        """Waits until there is a connection available.
-
-        Note that between the time that a connection becomes available and the
-        time it is requested, another thread may have grabbed it.  This function
-        is mainly present as a way to avoid spawning thousands of threads to
-        copy messages, then have them all wait for 3 available connections.
-        It's OK if we have maxconnections + 1 or 2 threads, which is what this
-        will help us do."""
-
-        self.semaphore.acquire()  # Blocking until maxconnections has free slots.
-        self.semaphore.release()
-
     def close(self):
         # Make sure I own all the semaphores.  Let the threads finish
         # their stuff.  This is a blocking method.
@@ -715,7 +904,8 @@ class IMAPServer:
             # requires the connectionlock, leading to a potential
             # deadlock! Audit & check!
             threadutil.semaphorereset(self.semaphore, self.maxconnections)
-            for imapobj in self.assignedconnections + self.availableconnections:
+            connections = self.assignedconnections + self.availableconnections
+            for imapobj in connections:
                 imapobj.logout()
             self.assignedconnections = []
             self.availableconnections = []
@@ -723,6 +913,29 @@ class IMAPServer:
             # reset GSSAPI state
             self.gss_vc = None
             self.gssapi = False
+        if self.host is not None and connections:
+            self.host.release(len(connections))
+
+    def popselectsavoided(self):
+        """Returns the number of SELECT commands skipped by the released
+        connections since the last call."""
+
+        with self.connectionlock:
+            count = self.selectsavoided
+            self.selectsavoided = 0
+        return count
+
+    def takeidleconnection(self):
+        """Removes an available connection from the pool and returns it, or
+        None if there is none.  Used by IMAPHost to hand it over to
+        another server."""
+
+        with self.connectionlock:
+            if not self.availableconnections:
+                return None
+            imapobj = self.availableconnections.pop(0)
+            del self.lastowner[imapobj]
+            return imapobj
 
     def keepalive(self, timeout, event):
         """Sends a NOOP to each connection recorded.
@@ -776,13 +989,18 @@ class IMAPServer:
 
         self.connectionlock.acquire()
         self.assignedconnections.remove(connection)
+        self.selectsavoided += connection.selectsavoided
+        connection.selectsavoided = 0
         # Don't reuse broken connections
-        if connection.Terminate or drop_conn:
+        dropped = connection.Terminate or drop_conn
+        if dropped:
             connection.logout()
         else:
             self.availableconnections.append(connection)
         self.connectionlock.release()
         self.semaphore.release()
+        if self.host is not None:
+            self.host.release(1 if dropped else 0)
 
 
 class IdleThread:
@@ -836,11 +1054,10 @@ class IdleThread:
         remoterepos = account.remoterepos
         remotefolder = remoterepos.getfolder(self.folder, decode=False)
 
-        hook = account.getconf('presynchook', '')
-        account.callhook(hook, "idle")
-        offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
-        hook = account.getconf('postsynchook', '')
-        account.callhook(hook, "idle")
+        account.synchook('presync', "idle")
+        offlineimap.accounts.syncfolder(account, remotefolder, quick=False,
+                                        syncmode="idle")
+        account.synchook('postsync', "idle")
 
         ui = getglobalui()
         ui.unregisterthread(current_thread())  # syncfolder registered the thread
@@ -18,6 +18,8 @@
 import re
 import binascii
 import codecs
+from calendar import timegm
+from functools import lru_cache
 from typing import Tuple
 from offlineimap.ui import getglobalui
 
@@ -29,6 +31,28 @@ SPACE_SEPARATED_LABEL_HEADERS = ('X-Label', 'Keywords')
 # Find the modified UTF-7 shifts of an international mailbox name.
 MUTF7_SHIFT_RE = re.compile(r'&[^-]*-|\+')
 
+# Month numbers of INTERNALDATE values, which are always in English.
+MONTHS = {b'Jan': 1, b'Feb': 2, b'Mar': 3, b'Apr': 4, b'May': 5, b'Jun': 6,
+          b'Jul': 7, b'Aug': 8, b'Sep': 9, b'Oct': 10, b'Nov': 11, b'Dec': 12}
+
+# A FETCH response with FLAGS, UID and INTERNALDATE items in any order,
+# other items are skipped.  A repeated group keeps its last match, so this
+# captures the three items in one pass.
+FETCH_FLAGS_RE = re.compile(rb'[0-9]+ \((?:(?:FLAGS \(([^)]*)\)|UID ([0-9]+)|'
+                            rb'INTERNALDATE "([^"]*)"|'
+                            rb'[^ ()]+ (?:\([^)]*\)|[^ ()]+)) ?)*\)')
+
+# Same items, searched one by one for responses FETCH_FLAGS_RE does not
+# match, e.g. with other items containing parentheses.
+FETCH_ITEM_RE = re.compile(rb'(?<=[ (])(?:FLAGS \(([^)]*)\)|UID ([0-9]+)|'
+                           rb'INTERNALDATE "([^"]*)")')
+
+# The MODSEQ item of a FETCH response (CONDSTORE, RFC 7162).
+FETCH_MODSEQ_RE = re.compile(rb'[ (]MODSEQ \(([0-9]+)\)')
+
+# The RFC822.SIZE item of a FETCH response.
+FETCH_SIZE_RE = re.compile(rb'[ (]RFC822\.SIZE ([0-9]+)')
+
 
 def __debug(*args):
     msg = []
@@ -189,6 +213,74 @@ def flagsmaildir2imap(maildirflaglist):
     return '(' + ' '.join(sorted(retval)) + ')'
 
 
+@lru_cache(maxsize=1024)
+def __parsedflags(flags):
+    # A folder has few distinct sets of flags, parse each of them once.
+    flagstring = '(%s)' % flags.decode('utf-8')
+    return (frozenset(flagsimap2maildir(flagstring)),
+            frozenset(flagsimap2keywords(flagstring)))
+
+
+@lru_cache(maxsize=4096)
+def __midnight(date):
+    # E.g. b'17-Jul-1996', many messages share the day.
+    day, mon, year = date.split(b'-')
+    return timegm((int(year), MONTHS[mon.capitalize()], int(day),
+                   0, 0, 0, -1, -1, -1))
+
+
+@lru_cache(maxsize=256)
+def __zone(zone):
+    # E.g. b'-0700'
+    seconds = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    return -seconds if zone[:1] == b'-' else seconds
+
+
+def internaldate2epoch(date):
+    """Converts an INTERNALDATE value, e.g. b'17-Jul-1996 02:44:25 -0700',
+    to seconds since the epoch.
+
+    :returns: the time, or None if date is not valid."""
+
+    try:
+        day, clock, zone = date.split()
+        # INTERNALDATE timezone must be subtracted to get UT
+        return __midnight(day) + int(clock[0:2]) * 3600 + \
+            int(clock[3:5]) * 60 + int(clock[6:8]) - __zone(zone)
+    except (ValueError, KeyError):
+        return None
+
+
+def parse_fetch_flags(response):
+    """Parses a response of FETCH (FLAGS UID INTERNALDATE) as returned by
+    imaplib2, e.g. b'1 (FLAGS (\\Seen Old) UID 4807 INTERNALDATE "...")'.
+
+    Same as flags2hash(), then flagsimap2maildir(), flagsimap2keywords()
+    and Internaldate2epoch() on the result, without the tokenizer.
+
+    :returns: (uid, maildir flags set, keywords set, time), uid and time
+        are None if missing."""
+
+    mo = FETCH_FLAGS_RE.match(response)
+    if mo is not None:
+        flags, uid, date = mo.groups()
+    else:
+        flags = uid = date = None
+        for mo in FETCH_ITEM_RE.finditer(response):
+            if mo.lastindex == 1:
+                flags = mo.group(1)
+            elif mo.lastindex == 2:
+                uid = mo.group(2)
+            else:
+                date = mo.group(3)
+    if flags is None:
+        flags = keywords = frozenset()
+    else:
+        flags, keywords = __parsedflags(flags)
+    return (None if uid is None else int(uid), set(flags), set(keywords),
+            None if date is None else internaldate2epoch(date))
+
+
 def uid_sequence(uidlist):
     """Collapse UID lists into shorter sequence sets
 
@@ -223,6 +315,51 @@ def uid_sequence(uidlist):
     return ",".join(retval)
 
 
+def uid_sequence_chunks(uidlist, maxlen):
+    """Like uid_sequence(), but splits the sequence set in several ones
+    of at most maxlen characters, to keep command lines short.
+
+    [1,2,3,7,9] with maxlen 5 will return [([1,2,3,7], "1:3,7"),
+    ([9], "9")].
+    :returns: list of (list of UIDs, sequence set as string)"""
+
+    ranges = []
+    for item in sorted(set(map(int, uidlist))):
+        if ranges and item == ranges[-1][1] + 1:
+            ranges[-1][1] = item
+        else:
+            ranges.append([item, item])
+
+    chunks = []
+    uids, parts, length = [], [], 0
+    for start, end in ranges:
+        part = str(start) if start == end else "%d:%d" % (start, end)
+        # A comma separates the part from the previous one.
+        if parts and length + 1 + len(part) > maxlen:
+            chunks.append((uids, ",".join(parts)))
+            uids, parts, length = [], [], 0
+        length += len(part) + (1 if parts else 0)
+        parts.append(part)
+        uids.extend(range(start, end + 1))
+    if parts:
+        chunks.append((uids, ",".join(parts)))
+    return chunks
+
+
+def uid_sequence_to_list(sequence):
+    """Expands a sequence set without '*', the reverse of uid_sequence()
+
+    "1:3,10" will return [1, 2, 3, 10]."""
+
+    uids = []
+    for part in sequence.split(','):
+        start, _, end = part.partition(':')
+        start = int(start)
+        end = int(end) if end else start
+        uids.extend(range(min(start, end), max(start, end) + 1))
+    return uids
+
+
 def __split_quoted(s):
     """Looks for the ending quote character in the string that starts
     with quote character, splitting out quoted component and the
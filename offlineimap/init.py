@@ -21,23 +21,23 @@ import threading
 import signal
 import socket
 import logging
+import platform
 import traceback
 import collections
 from optparse import OptionParser
 
 import offlineimap
-from offlineimap.utils.distro_utils import get_os_name
-import imaplib2 as imaplib
 
 # Ensure that `ui` gets loaded before `threadutil` in order to
 # break the circular dependency between `threadutil` and `Curses`.
+# The UIs, repositories and folders are imported on first use: only
+# those of the run are loaded, see test/bench_startup.py.
 from offlineimap.ui import UI_LIST, setglobalui, getglobalui
 from offlineimap import threadutil, accounts, folder, mbnames
 from offlineimap import globals as glob
 from offlineimap.CustomConfig import CustomConfigParser
 from offlineimap.utils import stacktrace
 from offlineimap.repository import Repository
-from offlineimap.folder.IMAP import MSGCOPY_NAMESPACE
 
 ACCOUNT_LIMITED_THREAD_NAME = 'MAX_ACCOUNTS'
 PYTHON_VERSION = sys.version.split(' ')[0]
@@ -56,6 +56,8 @@ def syncitall(list_accounts, config):
             name="Account sync %s" % accountname
         )
         thread.daemon = True
+        # Threads spawned by this account inherit the profile group.
+        thread.profile_group = accountname
         # The add() method expects a started thread.
         thread.start()
         threads.add(thread)
@@ -63,6 +65,37 @@ def syncitall(list_accounts, config):
     threads.wait()  # Blocks until all accounts are processed.
 
 
+def initlimits(config, options):
+    """Sets the socket timeout and the limits of the instance-limited
+    threads from the configuration."""
+
+    socktimeout = config.getdefaultint("general", "socktimeout", 0)
+    if socktimeout > 0:
+        socket.setdefaulttimeout(socktimeout)
+
+    from offlineimap.folder.IMAP import MSGCOPY_NAMESPACE
+
+    threadutil.initInstanceLimit(
+        ACCOUNT_LIMITED_THREAD_NAME,
+        config.getdefaultint('general', 'maxsyncaccounts', 1)
+    )
+
+    for reposname in config.getsectionlist('Repository'):
+        # Limit the number of threads. Limitation on usage is handled at the
+        # imapserver level.
+        for namespace in [accounts.FOLDER_NAMESPACE + reposname,
+                          MSGCOPY_NAMESPACE + reposname]:
+            if options.singlethreading:
+                threadutil.initInstanceLimit(namespace, 1)
+            else:
+                threadutil.initInstanceLimit(
+                    namespace,
+                    config.getdefaultint(
+                        'Repository ' + reposname,
+                        'maxconnections', 2)
+                )
+
+
 class OfflineImap:
     """The main class that encapsulates the high level use of OfflineImap.
 
@@ -72,7 +105,13 @@ class OfflineImap:
       oi.run()
     """
 
+    # The Supervisor running the worker processes, in supervisor mode.
+    supervisor = None
+    num_sigterm = 0
+
     def get_env_info(self):
+        import imaplib2 as imaplib
+
         # Transitional code between imaplib2 versions
         try:
             # imaplib2, previous versions, based on Python 2.x
@@ -137,7 +176,8 @@ class OfflineImap:
                           help="(the number one) disable all multithreading operations")
 
         parser.add_option("-P", dest="profiledir", metavar="DIR",
-                          help="sets OfflineIMAP into profile mode.")
+                          help="sets OfflineIMAP into profile mode (sampling profiler "
+                               "unless -1 is given).")
 
         parser.add_option("-a", dest="accounts",
                           metavar="account1[,account2[,...]]",
@@ -230,10 +270,6 @@ class OfflineImap:
 
         # Profile mode chosen?
         if options.profiledir:
-            if not options.singlethreading:
-                # TODO, make use of chosen ui for logging
-                logging.warning("Profile mode: Forcing to singlethreaded.")
-                options.singlethreading = True
             if os.path.exists(options.profiledir):
                 # TODO, make use of chosen ui for logging
                 logging.warning("Profile mode: Directory '%s' already exists!" %
@@ -337,29 +373,7 @@ class OfflineImap:
         if options.logfile:
             sys.stderr = self.ui.logfile
 
-        socktimeout = config.getdefaultint("general", "socktimeout", 0)
-        if socktimeout > 0:
-            socket.setdefaulttimeout(socktimeout)
-
-        threadutil.initInstanceLimit(
-            ACCOUNT_LIMITED_THREAD_NAME,
-            config.getdefaultint('general', 'maxsyncaccounts', 1)
-        )
-
-        for reposname in config.getsectionlist('Repository'):
-            # Limit the number of threads. Limitation on usage is handled at the
-            # imapserver level.
-            for namespace in [accounts.FOLDER_NAMESPACE + reposname,
-                              MSGCOPY_NAMESPACE + reposname]:
-                if options.singlethreading:
-                    threadutil.initInstanceLimit(namespace, 1)
-                else:
-                    threadutil.initInstanceLimit(
-                        namespace,
-                        config.getdefaultint(
-                            'Repository ' + reposname,
-                            'maxconnections', 2)
-                    )
+        initlimits(config, options)
         self.config = config
         return options, args
 
@@ -430,67 +444,32 @@ class OfflineImap:
         self.config is supposed to have been correctly initialized
         already."""
 
-        def sig_handler(sig, frame):
-            if sig == signal.SIGUSR1:
-                # tell each account to stop sleeping
-                accounts.Account.set_abort_event(self.config, 1)
-            elif sig in (signal.SIGUSR2, signal.SIGABRT):
-                # tell each account to stop looping
-                getglobalui().warn("Terminating after this sync...")
-                accounts.Account.set_abort_event(self.config, 2)
-            elif sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
-                # tell each account to ABORT ASAP (ctrl-c)
-                getglobalui().warn("Preparing to shutdown after sync (this may "
-                                   "take some time), press CTRL-C three "
-                                   "times to shutdown immediately")
-                accounts.Account.set_abort_event(self.config, 3)
-                if 'thread' in self.ui.debuglist:
-                    self.__dumpstacks(5)
-
-                # Abort after three Ctrl-C keystrokes
-                self.num_sigterm += 1
-                if self.num_sigterm >= 3:
-                    getglobalui().warn("Signaled thrice. Aborting!")
-                    sys.exit(1)
-            elif sig == signal.SIGQUIT:
-                stacktrace.dump(sys.stderr)
-                os.abort()
-
         try:
             self.num_sigterm = 0
-
-            # We cannot use signals in Windows
-            if get_os_name() != 'windows':
-                signal.signal(signal.SIGHUP, sig_handler)
-                signal.signal(signal.SIGUSR1, sig_handler)
-                signal.signal(signal.SIGUSR2, sig_handler)
-                signal.signal(signal.SIGABRT, sig_handler)
-                signal.signal(signal.SIGTERM, sig_handler)
-                signal.signal(signal.SIGINT, sig_handler)
-                signal.signal(signal.SIGQUIT, sig_handler)
+            self._set_signal_handlers()
 
             # Various initializations that need to be performed:
             activeaccounts = self._get_activeaccounts(options)
             mbnames.init(self.config, self.ui, options.dryrun)
 
+            exitstatus = 0
+            processes = self.config.getdefaultint('general',
+                                                  'syncprocesses', 0)
             if options.singlethreading:
                 # Singlethreaded.
                 self.__sync_singlethreaded(activeaccounts, options.profiledir)
+            elif processes > 1 and len(activeaccounts) > 1 and \
+                    not options.profiledir:
+                # Accounts sharded across worker processes.
+                exitstatus = self.__sync_sharded(activeaccounts, options,
+                                                 processes)
             else:
                 # Multithreaded.
-                t = threadutil.ExitNotifyThread(
-                    target=syncitall,
-                    name='Sync Runner',
-                    args=(activeaccounts, self.config,)
-                )
-                # Special exit message for the monitor to stop looping.
-                t.exit_message = threadutil.STOP_MONITOR
-                t.start()
-                threadutil.monitor()
+                self.__sync_multithreaded(activeaccounts, options.profiledir)
 
             # All sync are done.
             mbnames.write()
-            self.ui.terminate()
+            self.ui.terminate(exitstatus)
             return 0
         except SystemExit:
             raise
@@ -499,6 +478,89 @@ class OfflineImap:
             self.ui.terminate()
             return 1
 
+    def _signal_handler(self, sig, frame):
+        if self.supervisor is not None:
+            # The workers handle the signal too.
+            self.supervisor.forward(sig)
+        if sig == signal.SIGUSR1:
+            # tell each account to stop sleeping
+            accounts.Account.set_abort_event(self.config, 1)
+        elif sig in (signal.SIGUSR2, signal.SIGABRT):
+            # tell each account to stop looping
+            getglobalui().warn("Terminating after this sync...")
+            accounts.Account.set_abort_event(self.config, 2)
+        elif sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            # tell each account to ABORT ASAP (ctrl-c)
+            getglobalui().warn("Preparing to shutdown after sync (this may "
+                               "take some time), press CTRL-C three "
+                               "times to shutdown immediately")
+            accounts.Account.set_abort_event(self.config, 3)
+            if 'thread' in self.ui.debuglist:
+                self.__dumpstacks(5)
+
+            # Abort after three Ctrl-C keystrokes
+            self.num_sigterm += 1
+            if self.num_sigterm >= 3:
+                getglobalui().warn("Signaled thrice. Aborting!")
+                sys.exit(1)
+        elif sig == signal.SIGQUIT:
+            stacktrace.dump(sys.stderr)
+            os.abort()
+
+    def _set_signal_handlers(self):
+        # We cannot use signals in Windows
+        if platform.system().lower() != 'windows':
+            for sig in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2,
+                        signal.SIGABRT, signal.SIGTERM, signal.SIGINT,
+                        signal.SIGQUIT):
+                signal.signal(sig, self._signal_handler)
+
+    def __sync_sharded(self, list_accounts, options, processes):
+        """Executed in supervisor mode only: the accounts are synced by
+        worker processes.
+
+        :returns: the exit status of the workers"""
+
+        from offlineimap.supervisor import Supervisor
+
+        self.supervisor = Supervisor(self.config, options, processes)
+        try:
+            return self.supervisor.run(list_accounts)
+        finally:
+            self.supervisor = None
+
+    def __sync_multithreaded(self, list_accounts, profiledir):
+        """Executed in multithreaded mode only.
+
+        In profile mode, all account threads are sampled and the collapsed
+        stacks are written to profiledir, one file per account.
+
+        :param list_accounts: A list of accounts that should be synced
+        :param profiledir: Directory of the profiles, None outside of
+                           profile mode
+        """
+        sampler = None
+        if profiledir:
+            from offlineimap.utils.profiler import SamplingProfiler
+            sampler = SamplingProfiler(profiledir)
+            sampler.start()
+
+        try:
+            t = threadutil.ExitNotifyThread(
+                target=syncitall,
+                name='Sync Runner',
+                args=(list_accounts, self.config,)
+            )
+            # Special exit message for the monitor to stop looping.
+            t.exit_message = threadutil.STOP_MONITOR
+            t.start()
+            threadutil.monitor()
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                for filename in sampler.dump():
+                    self.ui.info("Profile mode: wrote %s" % filename)
+
     def __sync_singlethreaded(self, list_accounts, profiledir):
         """Executed in singlethreaded mode only.
 
@@ -527,6 +589,8 @@ class OfflineImap:
                     profiledir, "%s_%s.prof" % (dt, account.getname())))
 
     def __serverdiagnostics(self, options):
+        import imaplib2 as imaplib
+
         self.ui.info("  imaplib2: %s" % imaplib.__version__)
         for accountname in self._get_activeaccounts(options):
             account = accounts.Account(self.config, accountname)
@@ -24,6 +24,8 @@ class LocalEval:
 
     def __init__(self, path=None):
         self.namespace = {}
+        # The expressions of the configuration, compiled once.
+        self.code = {}
 
         if path is not None:
             # FIXME: limit opening files owned by current user with rights set
@@ -39,4 +41,9 @@ class LocalEval:
         names.update(self.namespace)
         if namespace is not None:
             names.update(namespace)
-        return eval(text, names)
+        if not isinstance(text, str):
+            return eval(text, names)
+        code = self.code.get(text)
+        if code is None:
+            code = self.code[text] = compile(text, '<string>', 'eval')
+        return eval(code, names)
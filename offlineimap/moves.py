@@ -0,0 +1,250 @@
+"""
+Detection of the messages moved between the folders of an account.
+
+With 'movedetection' set in the account section, the messages moved from
+a folder to another on one side since the last sync are moved the same way
+on the other side before the folders are synced, rather than copied to the
+new folder and deleted from the old one:
+
+- messages moved between local Maildir folders are moved on the server
+  with UID MOVE, or UID COPY then expunge,
+- messages moved between folders on the server are moved locally by
+  renaming their file.
+
+A moved message is a message gone from a folder since the last sync which
+has the same fingerprint as a new message in another folder: its
+Message-ID and the size of its body with CRLF line endings.  Messages
+without Message-ID, and fingerprints found more than once, are left to the
+sync.
+"""
+
+import re
+
+import offlineimap.accounts
+from offlineimap import OfflineImapError
+from offlineimap.ui import getglobalui
+
+MESSAGE_ID_RE = re.compile(rb'^message-id:\s*(\S+)',
+                           re.IGNORECASE | re.MULTILINE)
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
+def fingerprint(header, bodysize):
+    """Returns the fingerprint of a message from its headers and the size
+    of its body with CRLF line endings, None if it has no Message-ID."""
+
+    mo = MESSAGE_ID_RE.search(header)
+    if mo is None:
+        return None
+    return mo.group(1), bodysize
+
+
+def message_fingerprint(raw):
+    """Returns the fingerprint of the raw message, whatever its line
+    endings, see fingerprint()."""
+
+    mo = HEADER_END_RE.search(raw)
+    if mo is None:
+        return None
+    body = raw[mo.end():]
+    return fingerprint(raw[:mo.end()],
+                       len(body) + body.count(b'\n') - body.count(b'\r\n'))
+
+
+def supported(account):
+    """Whether moves can be detected for account: between a Maildir and
+    an IMAP server, with the whole folders synced."""
+
+    localrepos, remoterepos = account.localrepos, account.remoterepos
+    return (localrepos.getconf('type').strip() == 'Maildir' and
+            remoterepos.getconf('type').strip() == 'IMAP' and
+            not localrepos.getconfboolean('readonly', False) and
+            not remoterepos.getconfboolean('readonly', False) and
+            account.getconf('maxage', None) is None and
+            account.getconf('maxsize', None) is None and
+            localrepos.getconf('startdate', None) is None and
+            remoterepos.getconf('startdate', None) is None)
+
+
+def _matches(gone, new):
+    """Pairs the items of gone and new, lists of (fingerprint, folder,
+    item), which have a unique fingerprint on both sides and are in
+    different folders.
+
+    :returns: list of (gone folder, gone item, new folder, new item)"""
+
+    def index(items):
+        found = {}
+        for print_, folder, item in items:
+            if print_ is not None:
+                found.setdefault(print_, []).append((folder, item))
+        return found
+
+    goneindex, newindex = index(gone), index(new)
+    matches = []
+    for print_, gonefound in goneindex.items():
+        newfound = newindex.get(print_, ())
+        if len(gonefound) == 1 and len(newfound) == 1 and \
+                gonefound[0][0] is not newfound[0][0]:
+            matches.append(gonefound[0] + newfound[0])
+    return matches
+
+
+def _groupbyfolders(matches):
+    groups = {}
+    for gonefolder, goneitem, newfolder, newitem in matches:
+        groups.setdefault((gonefolder, newfolder), []).append(
+            (goneitem, newitem))
+    return groups
+
+
+class _SyncedFolder:
+    """The remote, local and status folders of a synced folder."""
+
+    def __init__(self, account, remotefolder):
+        self.remote = remotefolder
+        self.local = account.get_local_folder(remotefolder)
+        self.status = account.get_status_folder(remotefolder)
+
+    def statusuids(self):
+        return [uid for uid in self.status.getmessageuidlist() if uid > 0]
+
+
+class MoveDetector:
+    """Moves the messages moved on a side of an account on the other
+    side, see the module documentation."""
+
+    def __init__(self, account):
+        self.account = account
+        self.ui = getglobalui()
+
+    def run(self, remotefolders):
+        """Detects the moves between remotefolders, the folders about to be
+        synced, and their local counterparts.
+
+        Errors are reported, the folders are then synced as usual.  The
+        folders are locked as by syncfolder(), in the order of their local
+        names, so that an IDLE sync cannot run meanwhile."""
+
+        folders, locked = [], []
+        try:
+            synced = sorted((_SyncedFolder(self.account, remotefolder)
+                             for remotefolder in remotefolders),
+                            key=lambda folder: folder.local.getfullname())
+            for folder in synced:
+                mutex = offlineimap.accounts.getsyncmutex(self.account,
+                                                          folder.local)
+                mutex.acquire()
+                locked.append(mutex)
+            for folder in synced:
+                folder.status.openfiles()
+                folders.append(folder)
+                folder.status.cachemessagelist()
+                folder.local.cachemessagelist()
+            self.__localmoves(folders)
+            self.__remotemoves(folders)
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.FOLDER:
+                raise
+            self.ui.error(e, msg="Detecting moved messages [acc: %s]" %
+                                 self.account)
+        except OSError as e:
+            self.ui.error(e, msg="Detecting moved messages [acc: %s]" %
+                                 self.account)
+        finally:
+            for folder in folders:
+                folder.local.dropmessagelistcache()
+                folder.remote.dropmessagelistcache()
+                folder.status.dropmessagelistcache()
+                folder.status.closefiles()
+            for mutex in locked:
+                mutex.release()
+
+    def __localmoves(self, folders):
+        """Moves on the server the messages moved between local folders:
+        messages gone from a local folder while still in its status, and
+        local messages without UID yet."""
+
+        gone, new = {}, []
+        for folder in folders:
+            uids = [uid for uid in folder.statusuids()
+                    if not folder.local.uidexists(uid)]
+            if uids:
+                gone[folder] = uids
+            new.extend((folder, uid)
+                       for uid in folder.local.getmessageuidlist() if uid < 0)
+        if not gone or not new:
+            return
+
+        newprints = [(message_fingerprint(folder.local.getmessagebytes(uid)),
+                      folder, uid) for folder, uid in new]
+        goneprints = []
+        for folder, uids in gone.items():
+            for uid, (header, size, flags) in \
+                    folder.remote.fetchheaders(uids).items():
+                goneprints.append((fingerprint(header, size - len(header)),
+                                   folder, (uid, flags)))
+
+        groups = _groupbyfolders(_matches(goneprints, newprints))
+        for (src, dst), pairs in groups.items():
+            self.ui.movingmessages([uid for (uid, _), _ in pairs],
+                                   src.remote, dst.remote)
+            moved = src.remote.movemessagesto([uid for (uid, _), _ in pairs],
+                                              dst.remote)
+            for (uid, flags), localuid in pairs:
+                if uid not in moved:
+                    continue  # Left to the sync.
+                dst.local.change_message_uid(localuid, moved[uid])
+                # The local flags are synced to the server as changes.
+                dst.status.savemessage(moved[uid], None, flags,
+                                       dst.local.getmessagetime(moved[uid]))
+                src.status.deletemessage(uid)
+
+    def __remotemoves(self, folders):
+        """Moves locally the messages moved between folders on the
+        server.
+
+        The folders with messages gone on the server, or new ones, are
+        found by comparing their number of messages with the status."""
+
+        gonefolders, newfolders = [], []
+        for folder in folders:
+            count = folder.remote.countmessages()
+            known = len(folder.statusuids())
+            if count < known:
+                gonefolders.append(folder)
+            elif count > known:
+                newfolders.append(folder)
+        if not gonefolders or not newfolders:
+            return
+
+        goneprints = []
+        for folder in gonefolders:
+            remoteuids = folder.remote.searchuids()
+            for uid in folder.statusuids():
+                if uid not in remoteuids and folder.local.uidexists(uid):
+                    goneprints.append((message_fingerprint(
+                        folder.local.getmessagebytes(uid)), folder, uid))
+        newprints = []
+        for folder in newfolders:
+            statusuids = set(folder.statusuids())
+            uids = [uid for uid in folder.remote.searchuids()
+                    if uid not in statusuids]
+            if not uids:
+                continue
+            for uid, (header, size, _) in \
+                    folder.remote.fetchheaders(uids).items():
+                newprints.append((fingerprint(header, size - len(header)),
+                                  folder, uid))
+
+        groups = _groupbyfolders(_matches(goneprints, newprints))
+        for (src, dst), pairs in groups.items():
+            self.ui.movingmessages([uid for uid, _ in pairs],
+                                   src.local, dst.local)
+            for uid, newuid in pairs:
+                flags = src.local.getmessageflags(uid)
+                src.local.movemessageto(uid, dst.local, newuid)
+                # The server flags are synced locally as changes.
+                dst.status.savemessage(newuid, None, flags,
+                                       dst.local.getmessagetime(newuid))
+                src.status.deletemessage(uid)
@@ -20,6 +20,8 @@ Copyright (C) 2002-2019 John Goerzen & contributors
 import os
 import netrc
 import errno
+import time
+from functools import cmp_to_key
 from sys import exc_info
 from threading import Event
 from offlineimap import folder, imaputil, imapserver, OfflineImapError
@@ -42,6 +44,12 @@ class IMAPRepository(BaseRepository):
         self.oauth2_request_url = None
         self.imapserver = imapserver.IMAPServer(self)
         self.folders = None
+        # Folder objects by (name, decode), kept across syncs, the names
+        # last listed on the server, when, and the folders in sync order.
+        self._foldercache = {}
+        self._listednames = None
+        self._listedtime = 0.0
+        self._folderorder = None
         self.copy_ignore_eval = None
         # Keep alive.
         self.kaevent = None
@@ -76,12 +84,20 @@ class IMAPRepository(BaseRepository):
         self.kaevent = None
 
     def holdordropconnections(self):
+        self.__selectsavoided()
         if not self.getholdconnectionopen():
             self.dropconnections()
 
     def dropconnections(self):
+        self.__selectsavoided()
         self.imapserver.close()
 
+    def __selectsavoided(self):
+        # Called at the end of each sync.
+        count = self.imapserver.popselectsavoided()
+        if count:
+            self.ui.selectsavoided(self, count)
+
     def get_copy_ignore_UIDs(self, foldername):
         """Return a list of UIDs to not copy for this foldername."""
 
@@ -509,6 +525,26 @@ class IMAPRepository(BaseRepository):
         """
         return self.getconf('transporttunnel', None)
 
+    def isonsameserver(self, other):
+        """Whether the repository other logs in the same IMAP server as the
+        same user, so that its mailboxes can be used from the connections
+        of this repository.
+
+        Returns: True if other is an IMAP repository with the same tunnel,
+        or else the same host and port, and the same user."""
+
+        if not isinstance(other, IMAPRepository):
+            return False
+        tunnel = self.getpreauthtunnel() or self.gettransporttunnel()
+        othertunnel = other.getpreauthtunnel() or other.gettransporttunnel()
+        if tunnel or othertunnel:
+            if tunnel != othertunnel:
+                return False
+        elif self.gethost().lower() != other.gethost().lower() or \
+                self.getport() != other.getport():
+            return False
+        return self.getuser() == other.getuser()
+
     def getreference(self):
         """
         Get the reference value in the configuration. If the value is not found
@@ -555,6 +591,16 @@ class IMAPRepository(BaseRepository):
         num2 = self.getconfint('maxconnections', 1)
         return max(num1, num2)
 
+    def getmaxhostconnections(self):
+        """
+        Get the maxhostconnections configuration value from configuration.
+
+        Returns: Integer value of maxhostconnections configuration variable,
+        else 0 (no limit)
+
+        """
+        return self.getconfint('maxhostconnections', 0)
+
     def getexpunge(self):
         """
         Get the expunge configuration value from configuration.
@@ -670,14 +716,28 @@ class IMAPRepository(BaseRepository):
         self.imapserver.releaseconnection(imapobj)
 
     def forgetfolders(self):
+        """Forgets the list of folders.  The folder objects are kept, with
+        their state of the sync forgotten, and the names listed by the
+        server are reused for 'folderlistrefresh' minutes, see
+        getfolders()."""
+
         self.folders = None
+        for folder in self._foldercache.values():
+            folder.forgetsyncstate()
 
-    def getfolders(self):
-        """Return a list of instances of OfflineIMAP representative folder."""
+    def __forgetfoldernames(self):
+        """Forces the next getfolders() to list the folders on the server,
+        after a change of the folders made by us."""
 
-        if self.folders is not None:
-            return self.folders
-        retval = []
+        self.folders = None
+        self._listednames = None
+
+    def __listfoldernames(self):
+        """Lists the folders on the server, plus the folderincludes.
+
+        :returns: list of (name, whether the name is to be decoded)"""
+
+        names = []
         imapobj = self.imapserver.acquireconnection()
         # check whether to list all folders, or subscribed only
         listfunction = imapobj.list
@@ -709,8 +769,7 @@ class IMAPRepository(BaseRepository):
             flaglist = [x.lower() for x in imaputil.flagsplit(flags)]
             if '\\noselect' in flaglist:
                 continue
-            retval.append(self.getfoldertype()(self.imapserver, name,
-                                               self))
+            names.append((name, True))
         # Add all folderincludes
         if len(self.folderincludes):
             imapobj = self.imapserver.acquireconnection()
@@ -726,56 +785,51 @@ class IMAPRepository(BaseRepository):
                         self.ui.error(exc, exc_info()[2],
                                       'Invalid folderinclude:')
                         continue
-                    retval.append(self.getfoldertype()(
-                        self.imapserver, foldername, self, decode=False))
+                    names.append((foldername, False))
             finally:
                 self.imapserver.releaseconnection(imapobj)
+        return names
 
-        if self.foldersort is None:
-            # default sorting by case insensitive transposed name
-            retval.sort(key=lambda x: str.lower(x.getvisiblename()))
-        else:
-            # do foldersort in a python3-compatible way
-            # http://bytes.com/topic/python/answers/ \
-            # 844614-python-3-sorting-comparison-function
-            def cmp2key(mycmp):
-                """Converts a cmp= function into a key= function
-                We need to keep cmp functions for backward compatibility"""
-
-                class K:
-                    """
-                    Class to compare getvisiblename() between two objects.
-                    """
-                    def __init__(self, obj, *args):
-                        self.obj = obj
-
-                    def __cmp__(self, other):
-                        return mycmp(self.obj.getvisiblename(),
-                                     other.obj.getvisiblename())
-
-                    def __lt__(self, other):
-                        return self.__cmp__(other) < 0
-
-                    def __le__(self, other):
-                        return self.__cmp__(other) <= 0
-
-                    def __gt__(self, other):
-                        return self.__cmp__(other) > 0
-
-                    def __ge__(self, other):
-                        return self.__cmp__(other) >= 0
-
-                    def __eq__(self, other):
-                        return self.__cmp__(other) == 0
-
-                    def __ne__(self, other):
-                        return self.__cmp__(other) != 0
-
-                return K
+    def getfolders(self):
+        """Return a list of instances of OfflineIMAP representative folder.
 
-            retval.sort(key=cmp2key(self.foldersort))
+        The folders are listed on the server at most every
+        'folderlistrefresh' minutes, on each call after forgetfolders() by
+        default.  The folder objects of the names already listed are
+        reused, their nametrans and folderfilter are not evaluated again."""
 
-        self.folders = retval
+        if self.folders is not None:
+            return self.folders
+        refresh = self.getconffloat('folderlistrefresh', 0.0) * 60
+        if self._listednames is None or \
+                time.monotonic() - self._listedtime >= refresh:
+            self._listednames = self.__listfoldernames()
+            self._listedtime = time.monotonic()
+
+        foldercache = {}
+        for name, decode in self._listednames:
+            folder = self._foldercache.get((name, decode))
+            if folder is None:
+                folder = self.getfoldertype()(self.imapserver, name, self,
+                                              decode=decode)
+            foldercache[(name, decode)] = folder
+        # Folders gone from the server are dropped.
+        self._foldercache = foldercache
+
+        if self._folderorder is None or \
+                self._folderorder[0] != self._listednames:
+            retval = list(foldercache.values())
+            if self.foldersort is None:
+                # default sorting by case insensitive transposed name
+                retval.sort(key=lambda x: str.lower(x.getvisiblename()))
+            else:
+                # foldersort is a cmp function, kept for backward
+                # compatibility.
+                retval.sort(key=cmp_to_key(
+                    lambda x, y: self.foldersort(x.getvisiblename(),
+                                                 y.getvisiblename())))
+            self._folderorder = (self._listednames, retval)
+        self.folders = list(self._folderorder[1])
         return self.folders
 
     def deletefolder(self, foldername):
@@ -792,6 +846,7 @@ class IMAPRepository(BaseRepository):
                 raise OfflineImapError(msg, OfflineImapError.ERROR.FOLDER)
         finally:
             self.imapserver.releaseconnection(imapobj)
+        self.__forgetfoldernames()
 
     def makefolder(self, foldername):
         """
@@ -852,6 +907,7 @@ class IMAPRepository(BaseRepository):
                 raise OfflineImapError(msg, OfflineImapError.ERROR.FOLDER)
         finally:
             self.imapserver.releaseconnection(imapobj)
+        self.__forgetfoldernames()
 
 
 class MappedIMAPRepository(IMAPRepository):
@@ -18,7 +18,10 @@ Copyright (C) 2002-2015 John Goerzen & contributors
    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 """
 import os
-from offlineimap import folder
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from offlineimap import folder, globals
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 from offlineimap.repository.Base import BaseRepository
@@ -40,6 +43,13 @@ class MaildirRepository(BaseRepository):
         self.debug("MaildirRepository initialized, sep is %s" %
                    repr(self.getsep()))
         self.folder_atimes = []
+        # See _getfolders_scandir().
+        self._scancache = {}
+        self._watcher = None
+        self._watcherlock = Lock()
+        # Watching only pays off when the repository outlives one sync.
+        self._usewatcher = (self.getconfboolean('inotify', False) and
+                            account.refreshperiod > 0)
 
         # Create the top-level folder if it doesn't exist
         if not os.path.isdir(self.root):
@@ -166,61 +176,107 @@ class MaildirRepository(BaseRepository):
                                "folder '%s'." % foldername,
                                OfflineImapError.ERROR.FOLDER)
 
-    def _getfolders_scandir(self, root, extension=None):
+    def __scandirectory(self, relpath):
+        """Lists the directory relpath of the repository.
+
+        The result is taken from the cache if the directory did not change
+        since it was cached.
+        :returns: (mtime_ns, whether it is a Maildir folder, list of the
+            names of its sub-directories other than cur, new and tmp)"""
+
+        fullname = os.path.join(self.root, relpath)
+        mtime_ns = os.stat(fullname).st_mtime_ns
+        cached = self._scancache.get(relpath)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached
+
+        special = set()
+        subdirs = []
+        with os.scandir(fullname) as entries:
+            for entry in entries:
+                try:
+                    # is_dir() needs no further system call on most
+                    # filesystems, and its result is cached.
+                    if not entry.is_dir():
+                        continue
+                except OSError:
+                    continue  # E.g. vanished in the meantime.
+                if entry.name in ('cur', 'new', 'tmp'):
+                    special.add(entry.name)
+                else:
+                    subdirs.append(entry.name)
+        return mtime_ns, len(special) == 3, subdirs
+
+    def _getfolders_scandir(self, root):
         """Recursively scan folder 'root'; return a list of MailDirFolder
 
-        :param root: (absolute) path to Maildir root
-        :param extension: (relative) subfolder to examine within root"""
+        Directories are listed level by level, by 'scanthreads' threads at
+        once. This helps a lot on network filesystems, where each listing
+        waits for the server. The listings are cached with the mtime of
+        the directories, so that unchanged directories are not listed again
+        on the next scan.
+
+        :param root: (absolute) path to Maildir root"""
+
+        self.debug("_GETFOLDERS_SCANDIR STARTING. root = %s" % root)
+        assert root == self.root
+        recursive = self.getsep() == '/'
+        nthreads = self.getconfint('scanthreads', 1)
+
+        tree = {}  # relative path -> (mtime_ns, is maildir, subdirs)
+        level = ['']
+        executor = None
+        if nthreads > 1 and not globals.options.singlethreading:
+            executor = ThreadPoolExecutor(max_workers=nthreads)
+        try:
+            while level:
+                if executor is None or len(level) < 2:
+                    listings = map(self.__scandirectory, level)
+                else:
+                    listings = executor.map(self.__scandirectory, level)
+                nextlevel = []
+                for relpath, listing in zip(level, listings):
+                    tree[relpath] = listing
+                    if relpath == '' or recursive:
+                        nextlevel.extend(os.path.join(relpath, subdir)
+                                         for subdir in listing[2])
+                level = nextlevel
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # Only cache listings old enough for any later change to be seen
+        # as a new mtime, even on filesystems with a coarse granularity.
+        maxmtime_ns = time.time_ns() - 2 * 10 ** 9
+        self._scancache = dict((relpath, listing)
+                               for relpath, listing in tree.items()
+                               if listing[0] < maxmtime_ns)
 
-        self.debug("_GETFOLDERS_SCANDIR STARTING. root = %s, extension = %s" %
-                   (root, extension))
         retval = []
 
-        # Configure the full path to this repository -- "toppath"
-        if extension:
-            toppath = os.path.join(root, extension)
-        else:
-            toppath = root
-        self.debug("  toppath = %s" % toppath)
-
-        # Iterate over directories in top & top itself.
-        for dirname in os.listdir(toppath) + ['']:
-            self.debug("  dirname = %s" % dirname)
-            if dirname == '' and extension is not None:
-                self.debug('  skip this entry (already scanned)')
-                continue
-            if dirname in ['cur', 'new', 'tmp']:
-                self.debug("  skip this entry (Maildir special)")
-                # Bypass special files.
-                continue
-            fullname = os.path.join(toppath, dirname)
-            if not os.path.isdir(fullname):
-                self.debug("  skip this entry (not a directory)")
-                # Not a directory -- not a folder.
-                continue
-            # extension can be None.
-            if extension:
-                foldername = os.path.join(extension, dirname)
-            else:
-                foldername = dirname
-
-            if (os.path.isdir(os.path.join(fullname, 'cur')) and
-                    os.path.isdir(os.path.join(fullname, 'new')) and
-                    os.path.isdir(os.path.join(fullname, 'tmp'))):
-                # This directory has maildir stuff -- process
-                self.debug("  This is maildir folder '%s'." % foldername)
-                if self.getconfboolean('restoreatime', False):
-                    self._append_folder_atimes(foldername)
-                file_desc = self.getfoldertype()(self.root, foldername,
-                                                 self.getsep(), self)
-                retval.append(file_desc)
-
-            if self.getsep() == '/' and dirname != '':
-                # Recursively check sub-directories for folders too.
-                retval.extend(self._getfolders_scandir(root, foldername))
-        self.debug("_GETFOLDERS_SCANDIR RETURNING %s" %
-                   repr([x.getname() for x in retval]))
-        return retval
+        def addfolders(relpath):
+            for subdir in tree[relpath][2]:
+                foldername = os.path.join(relpath, subdir)
+                if tree[foldername][1]:
+                    # This directory has maildir stuff -- process
+                    self.debug("  This is maildir folder '%s'." % foldername)
+                    retval.append(foldername)
+                if recursive:
+                    # Sub-directories may be folders too.
+                    addfolders(foldername)
+
+        addfolders('')
+        if tree[''][1]:
+            retval.append('')  # The root is a folder itself.
+
+        folders = []
+        for foldername in retval:
+            if self.getconfboolean('restoreatime', False):
+                self._append_folder_atimes(foldername)
+            folders.append(self.getfoldertype()(self.root, foldername,
+                                                self.getsep(), self))
+        self.debug("_GETFOLDERS_SCANDIR RETURNING %s" % repr(retval))
+        return folders
 
     def getfolders(self):
         if self.folders is None:
@@ -236,6 +292,24 @@ class MaildirRepository(BaseRepository):
         """
         return folder.Maildir.MaildirFolder
 
+    def getwatcher(self):
+        """Returns the MaildirWatcher tracking local changes, or None if
+        local changes are not watched."""
+
+        if not self._usewatcher:
+            return None
+        with self._watcherlock:
+            if self._watcher is None:
+                from offlineimap.utils.inotify import MaildirWatcher
+                try:
+                    self._watcher = MaildirWatcher()
+                except (OSError, AttributeError) as e:
+                    # AttributeError: the C library has no inotify.
+                    self.ui.warn("Cannot watch local changes of repository "
+                                 "%s, disabling inotify: %s" % (self, e))
+                    self._usewatcher = False
+            return self._watcher
+
     def forgetfolders(self):
         """Forgets the cached list of folders, if any.  Useful to run
         after a sync run."""
@@ -17,14 +17,19 @@ Copyright (C) 2002-2016 John Goerzen & contributors.
 """
 from sys import exc_info
 from configparser import NoSectionError
-from offlineimap.repository.IMAP import IMAPRepository, MappedIMAPRepository
-from offlineimap.repository.Gmail import GmailRepository
-from offlineimap.repository.Maildir import MaildirRepository
-from offlineimap.repository.GmailMaildir import GmailMaildirRepository
-from offlineimap.repository.LocalStatus import LocalStatusRepository
+from importlib import import_module
 from offlineimap.error import OfflineImapError
 
 
+def _getclass(path):
+    """Returns the class of path, 'module.Class' in this package.  The
+    repository modules are imported on first use, so that a run only
+    loads the repository types it uses."""
+
+    modulename, classname = path.rsplit('.', 1)
+    return getattr(import_module('.' + modulename, __name__), classname)
+
+
 class Repository:
     """Abstract class that returns the correct Repository type
     instance based on 'account' and 'reqtype', e.g.  a
@@ -38,19 +43,20 @@ class Repository:
         if reqtype == 'remote':
             name = account.getconf('remoterepository')
             # We don't support Maildirs on the remote side.
-            typemap = {'IMAP': IMAPRepository,
-                       'Gmail': GmailRepository}
+            typemap = {'IMAP': 'IMAP.IMAPRepository',
+                       'Gmail': 'Gmail.GmailRepository'}
 
         elif reqtype == 'local':
             name = account.getconf('localrepository')
-            typemap = {'IMAP': MappedIMAPRepository,
-                       'Maildir': MaildirRepository,
-                       'GmailMaildir': GmailMaildirRepository}
+            typemap = {'IMAP': 'IMAP.MappedIMAPRepository',
+                       'Maildir': 'Maildir.MaildirRepository',
+                       'GmailMaildir': 'GmailMaildir.GmailMaildirRepository'}
 
         elif reqtype == 'status':
             # create and return a LocalStatusRepository.
             name = account.getconf('localrepository')
-            return LocalStatusRepository(name, account)
+            return _getclass('LocalStatus.LocalStatusRepository')(name,
+                                                                  account)
 
         else:
             errstr = "Repository type %s not supported" % reqtype
@@ -67,7 +73,7 @@ class Repository:
                                    exc_info()[2]) from exc
 
         try:
-            repo = typemap[repostype]
+            repo = _getclass(typemap[repostype])
         except KeyError as exc:
             errstr = "'%s' repository not supported for '%s' repositories." % \
                      (repostype, reqtype)
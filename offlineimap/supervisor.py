@@ -0,0 +1,389 @@
+"""
+Supervisor mode: accounts sharded across worker processes.
+
+With 'syncprocesses' set in the [general] section, the accounts are
+sharded across that many worker processes, each of them running the
+account threads of its shard.  The parent process supervises them:
+
+- the log records of the workers are handled by its UI,
+- the signals it gets are forwarded to the workers, which handle them as
+  usual,
+- the exit status is the highest of the workers,
+- accounts looping on autorefresh are moved from a worker to another to
+  even out the time spent syncing by each of them.
+
+The sync time of each account is stored in the metadata directory, so
+that the next run starts with balanced shards.
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import time
+from logging.handlers import QueueHandler
+from queue import Empty
+from threading import Lock
+
+from offlineimap import accounts, init, mbnames, threadutil
+from offlineimap import globals as glob
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.ui import getglobalui, setglobalui
+from offlineimap.ui.UIBase import UIBase
+
+# Weight of the last sync time in the moving average of an account.
+TIMING_SMOOTHING = 0.3
+# Minimum time between two moves of an account, in seconds.
+REBALANCE_INTERVAL = 300
+# Shards are not rebalanced unless the busiest one has this much more
+# sync time than the least busy one, relatively to the average.
+REBALANCE_THRESHOLD = 0.25
+
+
+def assign(accountnames, weights, count):
+    """Splits accountnames into count shards of about the same total
+    weight, the heaviest accounts first.
+
+    :param weights: dict of account name -> weight, accounts without
+        weight get the average one."""
+
+    known = [weights[name] for name in accountnames if name in weights]
+    default = sum(known) / len(known) if known else 1.0
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for name in sorted(accountnames,
+                       key=lambda name: weights.get(name, default),
+                       reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(name)
+        loads[lightest] += weights.get(name, default)
+    return shards
+
+
+class _EventHandler(QueueHandler):
+    """Sends the log records to the supervisor."""
+
+    def enqueue(self, record):
+        self.queue.put(('log', record))
+
+
+class WorkerUI(UIBase):
+    """UI of the worker processes: the supervisor does the output."""
+
+    asynclogging = False
+
+    def __init__(self, config, events, loglevel):
+        self._events = events
+        super(WorkerUI, self).__init__(config, loglevel)
+
+    def setup_consolehandler(self):
+        ch = _EventHandler(self._events)
+        self.logger.addHandler(ch)
+        return ch
+
+    def acctdone(self, account):
+        sec = time.time() - self.acct_startimes[account]
+        super(WorkerUI, self).acctdone(account)
+        self._events.put(('synced', account.getname(), sec))
+
+
+class Shard:
+    """The accounts synced by a worker process.
+
+    Accounts are started and stopped on request of the supervisor, which
+    gets notified when their thread ends."""
+
+    def __init__(self, config, events, commands):
+        self.config = config
+        self.events = events
+        self.commands = commands
+        self.accounts = {}
+        self.lock = Lock()
+        self.threads = threadutil.accountThreads()
+
+    def start(self, accountname):
+        account = accounts.SyncableAccount(self.config, accountname)
+        with self.lock:
+            self.accounts[accountname] = account
+        thread = threadutil.InstanceLimitedThread(
+            init.ACCOUNT_LIMITED_THREAD_NAME,
+            target=self.__syncrunner,
+            args=(account,),
+            name="Account sync %s" % accountname
+        )
+        thread.daemon = True
+        thread.profile_group = accountname
+        thread.start()
+        self.threads.add(thread)
+
+    def __syncrunner(self, account):
+        try:
+            account.syncrunner()
+        finally:
+            with self.lock:
+                del self.accounts[account.getname()]
+            self.events.put(('stopped', account.getname()))
+
+    def stop(self, accountname):
+        with self.lock:
+            account = self.accounts.get(accountname)
+        if account is not None:
+            account.stop()
+
+    def run(self, accountnames):
+        """Syncs accountnames, then the accounts the supervisor asks for
+        until it asks to quit."""
+
+        for accountname in accountnames:
+            self.start(accountname)
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                command, *args = self.commands.get(True, 5)
+            except Empty:
+                if parent is not None and not parent.is_alive():
+                    # Orphaned: finish the current syncs and leave.
+                    accounts.Account.set_abort_event(self.config, 2)
+                    break
+                continue
+            if command == 'start':
+                self.start(*args)
+            elif command == 'stop':
+                self.stop(*args)
+            elif command == 'quit':
+                break
+        self.threads.wait()
+
+
+def runworker(options, configtext, loglevel, accountnames, events, commands):
+    """Target of the worker processes, syncs the shard accountnames."""
+
+    # Signals from the terminal go to the supervisor, which forwards them.
+    os.setpgrp()
+    config = CustomConfigParser()
+    config.read_string(configtext)
+    glob.set_options(options)
+    ui = WorkerUI(config, events, loglevel)
+    setglobalui(ui)
+    if options.debugtype:
+        for dtype in options.debugtype.split(','):
+            ui.add_debug(dtype.strip())
+    init.initlimits(config, options)
+
+    oi = init.OfflineImap()
+    oi.config = config
+    oi.ui = ui
+    oi._set_signal_handlers()
+    try:
+        mbnames.init(config, ui, options.dryrun)
+        shard = Shard(config, events, commands)
+        t = threadutil.ExitNotifyThread(
+            target=shard.run,
+            name='Sync Runner',
+            args=(accountnames,)
+        )
+        # Special exit message for the monitor to stop looping.
+        t.exit_message = threadutil.STOP_MONITOR
+        t.start()
+        threadutil.monitor()
+    except SystemExit:
+        raise
+    except Exception as e:
+        ui.error(e)
+    ui.terminate()
+
+
+class _Worker:
+    def __init__(self, context, index):
+        self.index = index
+        self.commands = context.Queue()
+        self.process = None
+        self.accounts = set()
+
+
+class Supervisor:
+    """Runs the worker processes of the supervisor mode."""
+
+    def __init__(self, config, options, processes):
+        self.config = config
+        self.options = options
+        self.processes = processes
+        self.ui = getglobalui()
+        self.workers = []
+        self._timingspath = os.path.join(config.getmetadatadir(),
+                                         'shards.json')
+        self._timings = {}
+        self._lastrebalance = time.monotonic()
+        self._moving = {}  # Account name -> destination worker.
+
+    def __loadtimings(self):
+        try:
+            with open(self._timingspath) as timingsfile:
+                self._timings = json.load(timingsfile)
+        except (OSError, ValueError):
+            self._timings = {}
+
+    def __savetimings(self):
+        if self.config.getboolean('general', 'dry-run'):
+            return
+        try:
+            with open(self._timingspath + '.tmp', 'w') as timingsfile:
+                json.dump(self._timings, timingsfile)
+            os.rename(self._timingspath + '.tmp', self._timingspath)
+        except OSError as e:
+            self.ui.warn("Could not save the sync times to '%s': %s" %
+                         (self._timingspath, e))
+
+    def forward(self, sig):
+        """Sends signal sig to the workers."""
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                try:
+                    os.kill(worker.process.pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def __findworker(self, accountname):
+        for worker in self.workers:
+            if accountname in worker.accounts:
+                return worker
+        return None
+
+    def __loopingaccount(self, accountname):
+        refresh = self.config.getdefaultfloat('Account ' + accountname,
+                                              'autorefresh', 0.0)
+        return refresh > 0 and not self.options.runonce
+
+    def __aborting(self):
+        return accounts.Account.abort_soon_signal.is_set() or \
+               accounts.Account.abort_NOW_signal.is_set()
+
+    def __rebalance(self):
+        """Moves an account from the busiest worker to the least busy one if
+        it evens out their sync time."""
+
+        if self._moving or self.__aborting() or \
+                time.monotonic() - self._lastrebalance < REBALANCE_INTERVAL:
+            return
+        self._lastrebalance = time.monotonic()
+        workers = [w for w in self.workers if w.process.is_alive()]
+        if len(workers) < 2:
+            return
+        load = {w: sum(self._timings.get(name, 0.0) for name in w.accounts)
+                for w in workers}
+        busiest = max(workers, key=load.get)
+        idlest = min(workers, key=load.get)
+        gap = load[busiest] - load[idlest]
+        average = sum(load.values()) / len(workers)
+        if average <= 0 or gap < REBALANCE_THRESHOLD * average:
+            return
+        # Moving an account of weight w leaves a gap of |gap - 2w|, only
+        # worth it if that is much less than gap.
+        candidates = [name for name in busiest.accounts
+                      if self.__loopingaccount(name) and
+                      abs(gap - 2 * self._timings.get(name, 0.0)) <=
+                      (1 - REBALANCE_THRESHOLD) * gap]
+        if not candidates:
+            return
+        name = min(candidates,
+                   key=lambda name: abs(gap - 2 * self._timings[name]))
+        self.ui.info("Moving account %s to sync process %d to balance "
+                     "the sync times" % (name, idlest.index))
+        self._moving[name] = idlest
+        busiest.commands.put(('stop', name))
+
+    def __handle(self, event, running):
+        kind = event[0]
+        if kind == 'log':
+            self.ui.logger.handle(event[1])
+        elif kind == 'synced':
+            name, seconds = event[1:]
+            previous = self._timings.get(name)
+            if previous is None:
+                self._timings[name] = seconds
+            else:
+                self._timings[name] = (TIMING_SMOOTHING * seconds +
+                                       (1 - TIMING_SMOOTHING) * previous)
+            self.__rebalance()
+        elif kind == 'stopped':
+            name = event[1]
+            source = self.__findworker(name)
+            if source is not None:
+                source.accounts.discard(name)
+            destination = self._moving.pop(name, None)
+            if destination is not None and not self.__aborting() and \
+                    destination.process.is_alive():
+                destination.accounts.add(name)
+                destination.commands.put(('start', name))
+            else:
+                running.discard(name)
+
+    def run(self, accountnames):
+        """Syncs accountnames in the worker processes.
+
+        :returns: the highest exit status of the workers"""
+
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        self.__loadtimings()
+        shards = assign(accountnames, self._timings,
+                        min(self.processes, len(accountnames)))
+        configtext = io.StringIO()
+        self.config.write(configtext)
+        loglevel = self.ui.logger.getEffectiveLevel()
+        events = context.Queue()
+
+        for index, shard in enumerate(shards):
+            worker = _Worker(context, index)
+            worker.accounts.update(shard)
+            worker.process = context.Process(
+                target=runworker,
+                name="Sync process %d" % index,
+                args=(self.options, configtext.getvalue(), loglevel, shard,
+                      events, worker.commands),
+            )
+            self.workers.append(worker)
+        for worker in self.workers:
+            worker.process.start()
+            self.ui.debug('thread', "Sync process %d (pid %d): %s" %
+                          (worker.index, worker.process.pid,
+                           ', '.join(sorted(worker.accounts))))
+
+        running = set(accountnames)
+        try:
+            while running:
+                try:
+                    self.__handle(events.get(True, 1), running)
+                except Empty:
+                    # Accounts of dead workers will never be reported.
+                    for worker in self.workers:
+                        if not worker.process.is_alive():
+                            running -= worker.accounts
+                            worker.accounts.clear()
+            for worker in self.workers:
+                worker.commands.put(('quit',))
+            # Workers log until they exit.
+            while any(w.process.is_alive() for w in self.workers):
+                try:
+                    self.__handle(events.get(True, 0.2), running)
+                except Empty:
+                    pass
+            while True:
+                try:
+                    self.__handle(events.get_nowait(), running)
+                except Empty:
+                    break
+        finally:
+            self.__savetimings()
+
+        exitstatus = 0
+        for worker in self.workers:
+            worker.process.join()
+            code = worker.process.exitcode
+            if code is None or code < 0:
+                code = 1  # Killed by a signal.
+            exitstatus = max(exitstatus, code)
+        return exitstatus
@@ -15,7 +15,8 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from threading import Lock, Thread, BoundedSemaphore
+from threading import Lock, Thread, BoundedSemaphore, Condition, \
+    current_thread
 from queue import Queue, Empty
 import traceback
 from offlineimap.ui import getglobalui
@@ -126,6 +127,9 @@ class ExitNotifyThread(Thread):
     The thread can set instance variables self.exit_message for a human
     readable reason of the thread exit.
 
+    self.profile_group is inherited from the creating thread and tells the
+    sampling profiler which account the thread is working for.
+
     There is one instance of this class at runtime. The main thread waits for
     the monitor to end."""
 
@@ -137,6 +141,7 @@ class ExitNotifyThread(Thread):
         self.exit_message = None
         self._exit_exc = None
         self._exit_stacktrace = None
+        self.profile_group = getattr(current_thread(), 'profile_group', None)
 
     def run(self):
         """Allow profiling of a run and store exceptions."""
@@ -178,6 +183,7 @@ class ExitNotifyThread(Thread):
 ######################################################################
 
 limitedNamespaces = {}
+limitedMax = {}
 
 
 def initInstanceLimit(limitNamespace, instancemax):
@@ -190,6 +196,7 @@ def initInstanceLimit(limitNamespace, instancemax):
 
     if limitNamespace not in limitedNamespaces:
         limitedNamespaces[limitNamespace] = BoundedSemaphore(instancemax)
+        limitedMax[limitNamespace] = instancemax
 
 
 class InstanceLimitedThread(ExitNotifyThread):
@@ -212,3 +219,104 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if limitedNamespaces and limitedNamespaces[self.limitNamespace]:
                 limitedNamespaces[self.limitNamespace].release()
+
+
+######################################################################
+# Worker pools
+######################################################################
+
+workerPools = {}
+workerPoolsLock = Lock()
+
+
+class JobGroup:
+    """Jobs submitted to a WorkerPool, to wait until they are all done."""
+
+    def __init__(self):
+        self._cond = Condition()
+        self._pending = 0
+
+    def add(self):
+        with self._cond:
+            self._pending += 1
+
+    def done(self):
+        with self._cond:
+            self._pending -= 1
+            if self._pending == 0:
+                self._cond.notify_all()
+
+    def wait(self):
+        """Blocks until all the jobs of the group are done."""
+
+        with self._cond:
+            while self._pending > 0:
+                self._cond.wait()
+
+
+class WorkerPool:
+    """Long-lived threads running the jobs of an instance limit namespace.
+
+    Up to the namespace limit of ExitNotifyThread workers are started as
+    jobs come, and then wait for the next ones.  Submitting a job blocks
+    while as many jobs are queued as there are workers, so that the
+    submitter does not get ahead of them.
+
+    A job raising an exception ends its worker, which the monitor reports
+    like any other thread, and a new worker takes its place."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._jobs = Queue(size)
+        self._lock = Lock()
+        self._workers = 0
+        self._idle = 0
+        self._count = 0
+
+    def submit(self, group, target, *args):
+        """Runs target(*args) in a worker, as part of the JobGroup group."""
+
+        group.add()
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1  # That one will get the job.
+            elif self._workers < self.size:
+                self._workers += 1
+                self.__startworker()
+        self._jobs.put((group, target, args,
+                        getattr(current_thread(), 'profile_group', None)))
+
+    def __startworker(self):
+        self._count += 1
+        ExitNotifyThread(target=self.__work,
+                         name="%s worker %d" % (self.name, self._count)
+                         ).start()
+
+    def __work(self):
+        worker = current_thread()
+        while True:
+            group, target, args, profile_group = self._jobs.get()
+            worker.profile_group = profile_group
+            try:
+                target(*args)
+            except BaseException:
+                # Queued jobs may be waiting for this worker.
+                with self._lock:
+                    self.__startworker()
+                raise
+            finally:
+                group.done()
+            with self._lock:
+                self._idle += 1
+
+
+def getworkerpool(limitNamespace):
+    """Returns the WorkerPool of limitNamespace, with as many workers as
+    its instance limit."""
+
+    with workerPoolsLock:
+        if limitNamespace not in workerPools:
+            workerPools[limitNamespace] = WorkerPool(
+                limitNamespace, limitedMax.get(limitNamespace, 1))
+        return workerPools[limitNamespace]
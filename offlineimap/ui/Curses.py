@@ -37,6 +37,8 @@ class CursesUtil:
         # only happen from 1 thread.
         self.colormap = {}
         """dict, translating color string to curses color pair number"""
+        self.renderer = None
+        """The CursesRenderer() drawing the changes, once started."""
 
     def curses_colorpair(self, col_name):
         """Return the curses color pair, that corresponds to the color."""
@@ -105,6 +107,47 @@ class CursesUtil:
     def isactive(self):
         return hasattr(self, 'stdscr')
 
+    def changed(self):
+        """Request the changes to be drawn with the next frame."""
+
+        if self.renderer is not None:
+            self.renderer.changed.set()
+
+
+class CursesRenderer(ExitNotifyThread):
+    """Draws the changes of the UI, at most framerate times per second.
+
+    The other threads only record their changes (log lines, colors of the
+    thread symbols, account status): all the windows changed during a
+    frame are drawn at once, with a single curses.doupdate()."""
+
+    def __init__(self, ui, framerate):
+        super(CursesRenderer, self).__init__(name='Curses renderer')
+        self.ui = ui
+        self.interval = 1.0 / framerate
+        self.changed = Event()
+        self.stopped = False
+        self.start()  # automatically start the thread
+
+    def stop(self):
+        """Draw the last frame: no frame is drawn once stop() returns."""
+
+        with self.ui.iolock:
+            if not self.stopped:
+                self.ui.drawframe()
+            self.stopped = True
+        self.changed.set()
+
+    def run(self):
+        while not self.stopped:
+            self.changed.wait()
+            self.changed.clear()
+            with self.ui.iolock:
+                if self.stopped:
+                    break
+                self.ui.drawframe()
+            time.sleep(self.interval)
+
 
 class CursesAccountFrame:
     """Notable instance variables:
@@ -129,24 +172,45 @@ class CursesAccountFrame:
         # Account number (& hotkey) associated with this acc.
         self.location = 0
         # length of the account prefix string
+        self.leadstr = ''
+        # account status string
+        self.dirty = False
+        # whether the account status string is to be drawn
 
     def drawleadstr(self, secs=0):
-        """Draw the account status string.
+        """Draw the account status string with the next frame.
 
         secs tells us how long we are going to sleep."""
 
         sleepstr = '%3d:%02d' % (secs // 60, secs % 60) if secs else 'active'
-        accstr = '%s: [%s] %12.12s: ' % (self.acc_num, sleepstr, self.account)
+        self.leadstr = '%s: [%s] %12.12s: ' % (self.acc_num, sleepstr,
+                                                self.account)
+        self.location = len(self.leadstr)
+        self.dirty = True
+        self.ui.changed()
+
+    def draw(self):
+        """Draw the account status string and the thread symbols which
+        changed since the last frame.
+
+        Called by the renderer with the curses lock held."""
 
-        def addstr():
+        if self.window is None:
+            return
+        drawn = False
+        if self.dirty:
+            self.dirty = False
+            drawn = True
             try:
-                self.window.addstr(0, 0, accstr)
+                self.window.addstr(0, 0, self.leadstr)
             except curses.error:  # Occurs when the terminal is very small
                 pass
-
-        self.ui.exec_locked(addstr)
-
-        self.location = len(accstr)
+        for child in list(self.children):
+            if child.dirty:
+                child.draw()
+                drawn = True
+        if drawn:
+            self.window.noutrefresh()
 
     def setwindow(self, curses_win, acc_num):
         """Register an curses win and a hotkey as Account window.
@@ -157,7 +221,6 @@ class CursesAccountFrame:
         self.window = curses_win
         self.acc_num = acc_num
         self.drawleadstr()
-        self.ui.exec_locked(self.window.noutrefresh)
         # Update the child ThreadFrames
         for child in self.children:
             child.update(curses_win, self.location, 0)
@@ -179,7 +242,6 @@ class CursesAccountFrame:
         :returns: Boolean, whether we want to abort the sleep"""
 
         self.drawleadstr(remainingsecs)
-        self.ui.exec_locked(self.window.refresh)
         time.sleep(sleepsecs)
         return self.account.get_abort_event()
 
@@ -207,6 +269,8 @@ class CursesThreadFrame:
         self.x = x
         self.y = y
         self.curses_color = curses.color_pair(0)  # default color
+        self.dirty = False
+        # whether the thread symbol is to be drawn
 
     def setcolor(self, color, modifier=0):
         """Draw the thread symbol '@' in the specified color
@@ -215,20 +279,26 @@ class CursesThreadFrame:
         :param modifier: Curses modified, such as curses.A_BOLD
         """
 
-        self.curses_color = modifier | self.ui.curses_colorpair(color)
+        curses_color = modifier | self.ui.curses_colorpair(color)
         self.colorname = color
-        self.display()
+        if curses_color != self.curses_color:
+            self.curses_color = curses_color
+            self.display()
 
     def display(self):
-        def locked_display():
-            try:
-                self.window.addch(self.y, self.x, '@', self.curses_color)
-            except curses.error:  # Occurs when the terminal is very small
-                pass
-            self.window.refresh()
+        """Draw the thread symbol with the next frame."""
 
-        # lock the curses IO while fudging stuff
-        self.ui.exec_locked(locked_display)
+        self.dirty = True
+        self.ui.changed()
+
+    def draw(self):
+        """Called by the renderer with the curses lock held."""
+
+        self.dirty = False
+        try:
+            self.window.addch(self.y, self.x, '@', self.curses_color)
+        except curses.error:  # Occurs when the terminal is very small
+            pass
 
     def update(self, acc_win, x, y):
         """Update the xy position of the '.' (and possibly the aframe)."""
@@ -314,29 +384,16 @@ class InputHandler(ExitNotifyThread):
 
 
 class CursesLogHandler(logging.StreamHandler):
-    """self.ui has been set to the UI class before anything is invoked"""
+    """self.ui has been set to the UI class before anything is invoked
+
+    The lines are drawn by the renderer, in the color of the thread
+    logging them."""
 
     def emit(self, record):
         log_str = logging.StreamHandler.format(self, record)
         color = self.ui.gettf().curses_color
-        # We must acquire both locks.  Otherwise, deadlock can result.
-        # This can happen if one thread calls _msg (locking curses, then
-        # tf) and another tries to set the color (locking tf, then curses)
-        #
-        # By locking both up-front here, in this order, we prevent deadlock.
-        self.ui.tframe_lock.acquire()
-        self.ui.lock()
-        try:
-            y, x = self.ui.logwin.getyx()
-            if y or x:
-                self.ui.logwin.addch(10)  # no \n before 1st item
-
-            self.ui.logwin.addstr(log_str, color)
-            self.ui.logwin.noutrefresh()
-            self.ui.stdscr.refresh()
-        finally:
-            self.ui.unlock()
-            self.ui.tframe_lock.release()
+        self.ui.loglines.append((log_str, color))
+        self.ui.changed()
 
 
 class Blinkenlights(UIBase, CursesUtil):
@@ -350,7 +407,13 @@ class Blinkenlights(UIBase, CursesUtil):
        - logheight: Available height for the logging part
        - log_con_handler: The CursesLogHandler()
        - threadframes:
-       - accframes[account]: 'Accountframe'"""
+       - accframes[account]: 'Accountframe'
+       - loglines: the log lines to be drawn with the next frame"""
+
+    # The log handler gets the color of the logging thread.
+    asynclogging = False
+    # Maximum number of frames drawn per second.
+    framerate = 20
 
     def __init__(self, *args, **kwargs):
         super(Blinkenlights, self).__init__(*args, **kwargs)
@@ -400,6 +463,7 @@ class Blinkenlights(UIBase, CursesUtil):
         self.threadframes = {}
         self.accframes = {}
         self.aflock = Lock()
+        self.loglines = deque()
 
         self.stdscr = curses.initscr()
         # turn off automatic echoing of keys to the screen
@@ -424,6 +488,7 @@ class Blinkenlights(UIBase, CursesUtil):
         # set log handlers ui to ourself
         self._log_con_handler.ui = self
         self.setupwindows()
+        self.renderer = CursesRenderer(self, self.framerate)
         # Settup keyboard handler
         self.inputhandler = InputHandler(self)
         self.inputhandler.set_char_hdlr(self.on_keypressed)
@@ -578,6 +643,7 @@ class Blinkenlights(UIBase, CursesUtil):
             self.warn(" *** Input Required")
             self.warn(" *** Please enter password for user '%s': " %
                       username)
+            self.drawframe()
             self.logwin.refresh()
             password = self.logwin.getstr()
         finally:
@@ -643,6 +709,26 @@ class Blinkenlights(UIBase, CursesUtil):
         self.bannerwin.addnstr(0, 0, string, self.width - 1, color)
         self.bannerwin.noutrefresh()
 
+    def drawframe(self):
+        """Draw the changes since the last frame.
+
+        This function should be invoked with CursesUtils.locked()."""
+
+        lines = []
+        while self.loglines:
+            lines.append(self.loglines.popleft())
+        # Older lines would be scrolled out of the window.
+        for log_str, color in lines[-self.logheight:]:
+            y, x = self.logwin.getyx()
+            if y or x:
+                self.logwin.addch(10)  # no \n before 1st item
+            self.logwin.addstr(log_str, color)
+        if lines:
+            self.logwin.noutrefresh()
+        for accframe in list(self.accframes.values()):
+            accframe.draw()
+        curses.doupdate()
+
     def draw_logwin(self):
         """(Re)draw the current logwindow."""
 
@@ -667,10 +753,12 @@ class Blinkenlights(UIBase, CursesUtil):
 
             self.accframes[acc_name] = CursesAccountFrame(self, acc_name)
             # update the window layout
-            self.setupwindows(resize=True)
+            self.exec_locked(self.setupwindows, resize=True)
         return self.accframes[acc_name]
 
     def terminate(self, *args, **kwargs):
+        if self.renderer is not None:
+            self.renderer.stop()
         curses.nocbreak()
         self.stdscr.keypad(0)
         curses.echo()
@@ -43,7 +43,7 @@ class MachineLogFormatter(logging.Formatter):
             whoami = record.machineui["id"]
         else:
             command = ""
-            whoami = currentThread().getName()
+            whoami = record.threadName
 
         prefix = "%s:%s" % (command, urlencode([('', whoami)])[1:])
         return "%s:%s:%s" % (severity, prefix, urlencode([('', line)])[1:])
@@ -121,6 +121,10 @@ class MachineUI(UIBase):
         self._printData(self.logger.info, 'messagelistloaded', "%s\n%s\n%d" %
                         (self.getnicename(repos), folder.getname(), count))
 
+    def selectsavoided(self, repository, count):
+        self._printData(self.logger.info, 'selectsavoided', "%s\n%d" %
+                        (self.getnicename(repository), count))
+
     def syncingmessages(self, sr, sf, dr, df):
         self._printData(self.logger.info, 'syncingmessages', "%s\n%s\n%s\n%s\n" %
                         (self.getnicename(sr), sf.getname(), self.getnicename(dr),
@@ -142,6 +146,16 @@ class MachineUI(UIBase):
     def uidlist(self, ulist):
         return "\f".join([str(u) for u in ulist])
 
+    def copyingmessagesonserver(self, uidlist, src, dst):
+        self._printData(self.logger.info, 'copyingmessagesonserver', "%s\n%s\n%s\n%s\n%s" %
+                        (self.uidlist(uidlist), self.getnicename(src.repository),
+                         src.getname(), self.getnicename(dst.repository), dst.getname()))
+
+    def movingmessages(self, uidlist, src, dst):
+        self._printData(self.logger.info, 'movingmessages', "%s\n%s\n%s\n%s" %
+                        (self.uidlist(uidlist), self.getnicename(src.repository),
+                         src.getname(), dst.getname()))
+
     def deletingmessages(self, uidlist, destlist):
         ds = self.folderlist(destlist)
         self._printData(self.logger.info, 'deletingmessages', "%s\n%s" % (self.uidlist(uidlist), ds))
@@ -164,6 +178,7 @@ class MachineUI(UIBase):
 
     def terminate(self, exitstatus=0, errortitle='', errormsg=''):
         self._printData(self.logger.info, 'terminate', "%d\n%s\n%s" % (exitstatus, errortitle, errormsg))
+        self.stoplogwriter()
         sys.exit(exitstatus)
 
     def mainException(self):
@@ -185,9 +200,10 @@ class MachineUI(UIBase):
                             'getpasserror', "%s\n%s" % (username, errmsg),
                             False)
 
+        self._printData(self.logger.info, 'getpass', username)
+        self.flushlog()
         self._log_con_handler.acquire()  # lock the console output
         try:
-            self._printData(self.logger.info, 'getpass', username)
             return sys.stdin.readline()[:-1]
         finally:
             self._log_con_handler.release()
@@ -81,6 +81,7 @@ class TTYUI(UIBase):
 
         if errmsg:
             self.warn("%s: %s" % (username, errmsg))
+        self.flushlog()
         self._log_con_handler.acquire()  # lock the console output
         try:
             return getpass("Enter password for user '%s': " % username)
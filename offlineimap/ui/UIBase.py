@@ -15,6 +15,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+import atexit
 import logging
 import logging.handlers
 import re
@@ -50,7 +51,19 @@ def getglobalui():
     return globalui
 
 
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues the log records as they are: their message is formatted by
+    the writer thread."""
+
+    def prepare(self, record):
+        return record
+
+
 class UIBase:
+    # Whether the log records are output by a writer thread, see
+    # startlogwriter().
+    asynclogging = True
+
     def __init__(self, config, loglevel=logging.INFO):
         self.config = config
         # Is this a 'dryrun'?
@@ -74,6 +87,17 @@ class UIBase:
         self.logger.setLevel(loglevel)
         self._log_con_handler = self.setup_consolehandler()
         """The console handler (we need access to be able to lock it)."""
+        self._logwriter = None
+        self._logqueuehandler = None
+        if self.asynclogging:
+            self.startlogwriter()
+        # Seconds between two logs of the progress of the copy of the
+        # messages of a folder, 0 to log each message.
+        self.progressinterval = config.getdefaultfloat(
+            'general', 'progressinterval', 0)
+        # Time of the last progress log (v) per (source, destination)
+        # folder ids (k).
+        self._progress = {}
 
     # UTILS
     def setup_consolehandler(self):
@@ -93,6 +117,58 @@ class UIBase:
         self.logger.info(offlineimap.banner)
         return ch
 
+    def startlogwriter(self):
+        """Moves the handlers of the logger to a writer thread.
+
+        The log records are queued as they are, then formatted and output
+        by the writer thread: the sync threads do not wait for the console
+        or the log file, nor for each other on the handler locks."""
+
+        queue = Queue()
+        handlers = [handler for handler in self.logger.handlers
+                    if not isinstance(handler, _DeferredQueueHandler)]
+        for handler in handlers:
+            self.logger.removeHandler(handler)
+        self._logwriter = logging.handlers.QueueListener(
+            queue, *handlers, respect_handler_level=True)
+        self._logqueuehandler = _DeferredQueueHandler(queue)
+        self.logger.addHandler(self._logqueuehandler)
+        self._logwriter.start()
+        atexit.register(self.stoplogwriter)
+
+    def stoplogwriter(self):
+        """Outputs the queued log records and gives the handlers back to
+        the logger, which then outputs the records synchronously."""
+
+        writer, self._logwriter = self._logwriter, None
+        if writer is None:
+            return
+        # Blocks the threads logging meanwhile.
+        self._logqueuehandler.acquire()
+        try:
+            writer.stop()
+            for handler in writer.handlers:
+                self.logger.addHandler(handler)
+            self.logger.removeHandler(self._logqueuehandler)
+        finally:
+            self._logqueuehandler.release()
+        # Records queued by the threads blocked above.
+        while not writer.queue.empty():
+            writer.handle(writer.queue.get_nowait())
+
+    def flushlog(self):
+        """Waits for the log records queued so far to be output."""
+
+        writer = self._logwriter
+        if writer is not None:
+            writer.queue.join()
+
+    def _addhandler(self, handler):
+        if self._logwriter is not None:
+            self._logwriter.handlers += (handler,)
+        else:
+            self.logger.addHandler(handler)
+
     def setup_sysloghandler(self):
         """Backend specific syslog handler."""
 
@@ -102,7 +178,7 @@ class UIBase:
         self.formatter = logging.Formatter("offlineimap[%(process)d]: %(message)s")
         ch.setFormatter(self.formatter)
         # add the handlers to the logger
-        self.logger.addHandler(ch)
+        self._addhandler(ch)
 
     def setlogfile(self, logfile):
         """Create file handler which logs to file."""
@@ -112,7 +188,6 @@ class UIBase:
         file_formatter = logging.Formatter("%(asctime)s %(levelname)s: "
                                            "%(message)s", '%Y-%m-%d %H:%M:%S')
         fh.setFormatter(file_formatter)
-        self.logger.addHandler(fh)
         # write out more verbose initial info blurb on the log file
         p_ver = ".".join([str(x) for x in sys.version_info[0:3]])
         msg = "OfflineImap %s starting...\n  Python: %s Platform: %s\n  " \
@@ -121,6 +196,7 @@ class UIBase:
         record = logging.LogRecord('OfflineImap', logging.INFO, __file__,
                                    None, msg, None, None)
         fh.emit(record)
+        self._addhandler(fh)
 
     def _msg(self, msg):
         """Display a message."""
@@ -206,21 +282,29 @@ class UIBase:
             return self.threadaccounts[thr]
         return None
 
-    def debug(self, debugtype, msg):
+    def debug(self, debugtype, msg, *args):
+        """Log a debug message, msg % args if args are given.
+
+        The message is only formatted when it is output, or when the last
+        messages of the thread are reported with an exception."""
+
         cur_thread = threading.current_thread()
         if cur_thread not in self.debugmessages:
             # deque(..., self.debugmsglen) would be handy but was
             # introduced in p2.6 only, so we'll need to work around and
             # shorten our debugmsg list manually :-(
             self.debugmessages[cur_thread] = deque()
-        self.debugmessages[cur_thread].append("%s: %s" % (debugtype, msg))
+        self.debugmessages[cur_thread].append((debugtype, msg, args))
 
         # Shorten queue if needed
         if len(self.debugmessages[cur_thread]) > self.debugmsglen:
             self.debugmessages[cur_thread].popleft()
 
         if debugtype in self.debuglist:  # log if we are supposed to do so
-            self.logger.debug("[%s]: %s" % (debugtype, msg))
+            if args:
+                self.logger.debug("[%s]: " + msg, debugtype, *args)
+            else:
+                self.logger.debug("[%s]: %s", debugtype, msg)
 
     def add_debug(self, debugtype):
         global debugtypes
@@ -287,6 +371,13 @@ class UIBase:
                   "for that message." % (
                       str(uidlist), self.getnicename(destfolder), destfolder))
 
+    def flagsconflict(self, destfolder, uidlist):
+        self.info("Flags of messages %s in folder %s[%s] changed on the "
+                  "server during the sync, they were not modified and will "
+                  "be synced next time." % (
+                      offlineimap.imaputil.uid_sequence(uidlist),
+                      self.getnicename(destfolder), destfolder))
+
     def labelstoreadonly(self, destfolder, uidlist, labels):
         if self.config.has_option('general', 'ignore-readonly') and \
                 self.config.getboolean('general', 'ignore-readonly'):
@@ -349,6 +440,12 @@ class UIBase:
             self.debug('', "Copying folder structure from %s to %s" %
                        (src_repo, dst_repo))
 
+    def selectsavoided(self, repository, count):
+        """Log the number of SELECT commands saved during a sync."""
+
+        self.logger.debug("%s: %d SELECT commands avoided" % (
+            self.getnicename(repository), count))
+
     # Folder syncing
     def makefolder(self, repo, foldername):
         """Called when a folder is created."""
@@ -399,11 +496,45 @@ class UIBase:
             uid, src.repository, src, destfolder.repository))
 
     def copyingmessage(self, uid, num, num_to_copy, src, destfolder):
-        """Output a log line stating which message we copy."""
+        """Output a log line stating which message we copy.
+
+        With 'progressinterval' set, the progress of the copy is logged
+        instead, for the first and the last message and at most once per
+        interval."""
+
+        if not self.progressinterval:
+            self.logger.info("Copy message UID %s (%d/%d) %s:%s -> %s:%s",
+                             uid, num, num_to_copy, src.repository, src,
+                             destfolder.repository, destfolder)
+            return
+        key = (id(src), id(destfolder))
+        now = time.monotonic()
+        if num == num_to_copy:
+            self._progress.pop(key, None)
+        elif key in self._progress and \
+                now - self._progress[key] < self.progressinterval:
+            return
+        else:
+            self._progress[key] = now
+        self.logger.info("Copy messages (%d/%d) %s:%s -> %s:%s",
+                         num, num_to_copy, src.repository, src,
+                         destfolder.repository, destfolder)
+
+    def copyingmessagesonserver(self, uidlist, src, dst):
+        """Output a log line stating which messages we copy on the
+        server."""
+
+        self.logger.info("Copy %d messages (%s) on the server %s:%s -> %s:%s"
+                         % (len(uidlist),
+                            offlineimap.imaputil.uid_sequence(uidlist),
+                            src.repository, src, dst.repository, dst))
+
+    def movingmessages(self, uidlist, src, dst):
+        """Output a log line stating which messages we move."""
 
-        self.logger.info("Copy message UID %s (%d/%d) %s:%s -> %s:%s" % (
-            uid, num, num_to_copy, src.repository, src,
-            destfolder.repository, destfolder))
+        self.logger.info("Move %d messages (%s) %s:%s -> %s" % (
+            len(uidlist), offlineimap.imaputil.uid_sequence(uidlist),
+            src.repository, src, dst))
 
     def deletingmessages(self, uidlist, destlist):
         ds = self.folderlist(destlist)
@@ -413,12 +544,12 @@ class UIBase:
             offlineimap.imaputil.uid_sequence(uidlist), ds))
 
     def addingflags(self, uidlist, flags, dest):
-        self.logger.info("Adding flag %s to %d messages on %s" % (
-            ", ".join(flags), len(uidlist), dest))
+        self.logger.info("Adding flag %s to %d messages on %s",
+                         ", ".join(flags), len(uidlist), dest)
 
     def deletingflags(self, uidlist, flags, dest):
-        self.logger.info("Deleting flag %s from %d messages on %s" % (
-            ", ".join(flags), len(uidlist), dest))
+        self.logger.info("Deleting flag %s from %d messages on %s",
+                         ", ".join(flags), len(uidlist), dest)
 
     def addinglabels(self, uidlist, label, dest):
         self.logger.info("Adding label %s to %d messages on %s" % (
@@ -495,8 +626,8 @@ class UIBase:
     def savemessage(self, debugtype, uid, flags, folder):
         """Output a log line stating that we save a msg."""
 
-        self.debug(debugtype, "Write mail '%s:%d' with flags %s" %
-                   (folder, uid, repr(flags)))
+        self.debug(debugtype, "Write mail '%s:%d' with flags %r",
+                   folder, uid, set(flags))
 
     # Threads
 
@@ -504,7 +635,9 @@ class UIBase:
         if thread in self.debugmessages:
             message = "\nLast %d debug messages logged for %s prior to exception:\n" \
                       % (len(self.debugmessages[thread]), thread.name)
-            message += "\n".join(self.debugmessages[thread])
+            message += "\n".join(
+                "%s: %s" % (debugtype, msg % args if args else msg)
+                for debugtype, msg, args in self.debugmessages[thread])
         else:
             message = "\nNo debug messages were logged for %s." % \
                       thread.name
@@ -555,6 +688,7 @@ class UIBase:
             self.warn('At least one folder skipped due to UID validity problem')
             if exitstatus == 0:
                 exitstatus = 2
+        self.stoplogwriter()
         sys.exit(exitstatus)
 
     def threadExited(self, thread):
@@ -15,18 +15,43 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+from collections.abc import Mapping
+from importlib import import_module
+from importlib.util import find_spec
+
 from offlineimap.ui.UIBase import getglobalui, setglobalui
-from offlineimap.ui import TTY, Noninteractive, Machine
-
-UI_LIST = {'ttyui': TTY.TTYUI,
-           'basic': Noninteractive.Basic,
-           'quiet': Noninteractive.Quiet,
-           'syslog': Noninteractive.Syslog,
-           'machineui': Machine.MachineUI}
-
-# add Blinkenlights UI if it imports correctly (curses installed)
-try:
-    from offlineimap.ui import Curses
-    UI_LIST['blinkenlights'] = Curses.Blinkenlights
-except ImportError:
-    pass
+
+
+class _UIList(Mapping):
+    """Maps the UI names to their class.  The module of a UI is imported
+    when it is looked up, so that a run only loads the UI it uses."""
+
+    def __init__(self, uis):
+        self._uis = uis
+
+    def __getitem__(self, name):
+        modulename, classname = self._uis[name]
+        try:
+            module = import_module('offlineimap.ui.' + modulename)
+        except ImportError as exc:
+            raise KeyError(name) from exc
+        return getattr(module, classname)
+
+    def __iter__(self):
+        return iter(self._uis)
+
+    def __len__(self):
+        return len(self._uis)
+
+
+_UIS = {'ttyui': ('TTY', 'TTYUI'),
+        'basic': ('Noninteractive', 'Basic'),
+        'quiet': ('Noninteractive', 'Quiet'),
+        'syslog': ('Noninteractive', 'Syslog'),
+        'machineui': ('Machine', 'MachineUI')}
+
+# add Blinkenlights UI if curses is installed
+if find_spec('_curses') is not None:
+    _UIS['blinkenlights'] = ('Curses', 'Blinkenlights')
+
+UI_LIST = _UIList(_UIS)
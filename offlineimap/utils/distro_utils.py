@@ -6,8 +6,6 @@ Module that supports distribution-specific functions.
 import platform
 import os
 
-import distro
-
 # For the former we will just return the value, for an iterable
 # we will walk through the values and will return the first
 # one that corresponds to the existing file.
@@ -46,6 +44,8 @@ def get_os_name():
     os_name = platform.system().lower()
 
     if os_name.startswith('linux'):
+        import distro
+
         distro_name = distro.id()
         if distro_name:
             os_name = os_name + "-%s" % distro_name
@@ -0,0 +1,195 @@
+"""
+Linux inotify support to track local changes of Maildir folders.
+
+Python does not wrap inotify, so this talks to the C library through
+ctypes.  The watcher is polled (non-blocking reads), there is no thread
+waiting for events: the sync engine drains the queue whenever it is about
+to look at a folder.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+from threading import Lock
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Messages are identified by their filename in a Maildir, so we only need
+# to know about entries appearing and disappearing.
+MAILDIR_EVENTS = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Minimal non-blocking inotify instance."""
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """Watch path, returns the watch descriptor."""
+
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns the list of pending (wd, mask, name) events, without
+        blocking."""
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MaildirWatcher:
+    """Tracks the entries changed in the new/ and cur/ directories of
+    Maildir folders.
+
+    Besides the per-folder set of changed entries (the dirty set), the
+    watcher keeps the message list each folder had at the end of its last
+    sync, so that the next sync can apply the changes to it instead of
+    listing the whole folder again."""
+
+    def __init__(self):
+        self._inotify = Inotify()
+        self._lock = Lock()
+        self._wds = {}  # wd -> (folder path, 'new' or 'cur')
+        self._watched = {}  # folder path -> list of wds
+        self._changes = {}  # folder path -> set of 'new/...' or 'cur/...'
+        self._messagelists = {}  # folder path -> messagelist
+        # Number of queue overflows so far, and the one at the checkout of
+        # each folder being synced: a list checked out before an overflow
+        # missed events, it is not stored back.
+        self._overflows = 0
+        self._checkedout = {}  # folder path -> overflows at checkout
+
+    def watch(self, path):
+        """Starts watching the Maildir folder at path, if not already.
+
+        Must be called before listing the folder, so that no change can
+        be missed."""
+
+        with self._lock:
+            if path in self._watched:
+                return
+            wds = []
+            try:
+                for subdir in ('new', 'cur'):
+                    wd = self._inotify.add_watch(os.path.join(path, subdir),
+                                                 MAILDIR_EVENTS)
+                    self._wds[wd] = (path, subdir)
+                    wds.append(wd)
+            except OSError:
+                for wd in wds:
+                    self._inotify.rm_watch(wd)
+                    del self._wds[wd]
+                raise
+            self._watched[path] = wds
+            self._changes[path] = set()
+
+    def __forget(self, path):
+        self._messagelists.pop(path, None)
+        self._checkedout.pop(path, None)
+
+    def __drain(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, nothing can be trusted anymore,
+                # including the lists of the folders being synced.
+                self._messagelists.clear()
+                self._overflows += 1
+                continue
+            if wd not in self._wds:
+                continue
+            path, subdir = self._wds[wd]
+            if mask & IN_IGNORED:
+                # The directory is gone, or was unwatched.
+                del self._wds[wd]
+                for other in self._watched.pop(path, []):
+                    if other != wd and other in self._wds:
+                        self._inotify.rm_watch(other)
+                        del self._wds[other]
+                self._changes.pop(path, None)
+                self.__forget(path)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.__forget(path)
+            elif name:
+                self._changes[path].add(os.path.join(subdir, name))
+
+    def checkout(self, path):
+        """Returns (messagelist, changed entries) for the folder at path,
+        or None if the folder has to be listed again.
+
+        The stored message list is handed over to the caller, it has to be
+        stored back with checkin() once the sync is done."""
+
+        with self._lock:
+            self.__drain()
+            # Whether it is listed again or not, all changes so far are
+            # accounted for.
+            changes = self._changes.get(path, set())
+            if path in self._changes:
+                self._changes[path] = set()
+            self._checkedout[path] = self._overflows
+            if path not in self._messagelists:
+                return None
+            return self._messagelists.pop(path), changes
+
+    def checkin(self, path, messagelist):
+        """Stores the message list of the watched folder at path, as it is
+        on disk once synced.
+
+        The list is dropped if the folder is no longer watched, or if
+        events were lost since its checkout()."""
+
+        with self._lock:
+            self.__drain()
+            if path in self._watched and \
+                    self._checkedout.pop(path, None) == self._overflows:
+                self._messagelists[path] = messagelist
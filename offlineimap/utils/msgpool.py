@@ -0,0 +1,202 @@
+"""
+Process pool to parse and serialize messages out of the sync threads.
+
+Parsing a message with the email package, checking it for defects and
+serializing it again for the destination is pure Python work: with many
+accounts and folders synced at once, the threads doing it take turns on
+the GIL and a single core is used.  With 'parseprocesses' set in the
+[general] section, this work is handed to a pool of processes instead.
+
+The raw message goes to a worker which returns the message serialized
+for the destination folder.  Large messages are exchanged through shared
+memory, only the name of the segment is pickled.
+"""
+
+import multiprocessing
+from email.errors import NoBoundaryInMultipartDefect
+from email.message import EmailMessage
+from email.parser import BytesParser
+from multiprocessing import shared_memory
+from threading import Lock
+
+# Messages smaller than this are pickled, the others go through shared
+# memory.
+SHM_THRESHOLD = 64 * 1024
+
+_pool = None
+_pooldisabled = False
+_poollock = Lock()
+
+
+def _store(data):
+    """Returns a reference to data, to be passed to another process."""
+
+    if len(data) < SHM_THRESHOLD:
+        return data
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    ref = (shm.name, len(data))
+    shm.close()
+    return ref
+
+
+def _load(ref, unlink=False):
+    """Returns the data referenced by ref, see _store()."""
+
+    if isinstance(ref, bytes):
+        return ref
+    name, size = ref
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _unlink(ref):
+    if not isinstance(ref, bytes):
+        shm = shared_memory.SharedMemory(name=ref[0])
+        shm.close()
+        shm.unlink()
+
+
+def prepare_message(raw, inpolicy, outpolicy):
+    """Parses the raw message with inpolicy and serializes it with
+    outpolicy, as folders do when copying a message.
+
+    Like the folders' getmessage(), the multipart boundary is fixed if it
+    is not quoted properly.
+
+    :returns: (serialized message or None on error, defects as a string or
+        None if there is none, error as a string or None)"""
+
+    from offlineimap.folder.Base import BaseFolder
+
+    try:
+        msg = BytesParser(policy=inpolicy).parsebytes(raw)
+    except Exception as e:
+        return None, None, "%s: %s" % (type(e).__name__, e)
+    defects = None
+    if len(msg.defects) > 0:
+        defects = "%s" % msg.defects
+        if any(isinstance(defect, NoBoundaryInMultipartDefect)
+               for defect in msg.defects):
+            msg = BytesParser(policy=inpolicy).parsebytes(
+                BaseFolder._quote_boundary_fix(raw))
+    try:
+        return msg.as_bytes(policy=outpolicy), defects, None
+    except UnicodeEncodeError as e:
+        return None, defects, "%s: %s" % (type(e).__name__, e)
+
+
+def _prepare_message(inref, inpolicy, outpolicy):
+    # Runs in the workers.
+    out, defects, error = prepare_message(_load(inref), inpolicy, outpolicy)
+    if out is not None:
+        out = _store(out)
+    return out, defects, error
+
+
+class PreparedMessage(EmailMessage):
+    """Message as returned by prepare_message(): only the headers are
+    parsed, so that they can be read and modified, the body is kept as
+    serialized."""
+
+    def __init__(self, policy=None):
+        super(PreparedMessage, self).__init__(policy)
+        self._body = b''
+
+    @classmethod
+    def from_bytes(cls, data, policy):
+        """Returns the message serialized as data with policy."""
+
+        linesep = policy.linesep.encode('ascii')
+        if data.startswith(linesep):
+            end = 0  # No header.
+        else:
+            end = data.find(linesep * 2)
+            end = len(data) if end < 0 else end + len(linesep)
+        msg = BytesParser(_class=cls, policy=policy).parsebytes(
+            data[:end], headersonly=True)
+        msg._body = data[end + len(linesep):]
+        return msg
+
+    def as_bytes(self, unixfrom=False, policy=None):
+        # Same as what BytesGenerator does for the headers.
+        if policy is None:
+            policy = self.policy
+        body = self._body
+        if policy.linesep != self.policy.linesep:
+            body = body.replace(b'\r\n', b'\n')
+            if policy.linesep != '\n':
+                body = body.replace(b'\n', policy.linesep.encode('ascii'))
+        headers = [policy.fold_binary(name, value)
+                   for name, value in self.raw_items()]
+        return b''.join(headers) + policy.linesep.encode('ascii') + body
+
+    def as_string(self, unixfrom=False, maxheaderlen=0, policy=None):
+        return self.as_bytes(policy=policy).decode('utf-8', 'replace')
+
+    __bytes__ = as_bytes
+    __str__ = as_string
+
+
+class MessagePool:
+    """Pool of processes running prepare_message()."""
+
+    def __init__(self, processes):
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Forking a process running threads is not safe, have a clean
+        # process start the workers.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(max_workers=processes,
+                                             mp_context=context)
+
+    def prepare(self, raw, inpolicy, outpolicy):
+        """Same as prepare_message(), in a worker.
+
+        Raises concurrent.futures.process.BrokenProcessPool if a worker
+        died."""
+
+        inref = _store(raw)
+        try:
+            outref, defects, error = self._executor.submit(
+                _prepare_message, inref, inpolicy, outpolicy).result()
+        finally:
+            _unlink(inref)
+        if outref is None:
+            return None, defects, error
+        return _load(outref, unlink=True), defects, None
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def getmessagepool(config):
+    """Returns the process-wide MessagePool, or None if it is disabled."""
+
+    global _pool
+    processes = config.getdefaultint('general', 'parseprocesses', 0)
+    if processes < 1:
+        return None
+    with _poollock:
+        if _pool is None and not _pooldisabled:
+            _pool = MessagePool(processes)
+        return _pool
+
+
+def disablemessagepool():
+    """Stops using the MessagePool, e.g. after a worker died."""
+
+    global _pool, _pooldisabled
+    with _poollock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
+        _pooldisabled = True
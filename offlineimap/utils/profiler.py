@@ -0,0 +1,102 @@
+"""
+Wall-clock sampling profiler for the multithreaded sync engine.
+
+cProfile only sees the thread it was enabled in, which makes it useless
+for the threaded engine where most of the time is spent waiting on
+connections, locks and semaphores.  This profiler periodically samples
+the stacks of all threads via sys._current_frames() and accumulates them
+per account, so contention shows up as time spent in the waiting frames.
+
+Results are written as collapsed stacks (one "frame;frame;frame count"
+line per distinct stack) which can be fed directly to flamegraph.pl,
+speedscope or similar tools.
+"""
+
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+
+# Default delay between two samples, in seconds.
+DEFAULT_INTERVAL = 0.005
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name,
+                           os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def collapse_stack(frame):
+    """Return the collapsed representation of the stack ending in frame,
+    outermost frame first."""
+
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class SamplingProfiler(threading.Thread):
+    """Sample the stacks of all profiled threads at a fixed interval.
+
+    Threads are attributed to a group by their 'profile_group' attribute
+    (see threadutil.ExitNotifyThread); threads without a group, like the
+    main thread running the monitor loop, are not sampled."""
+
+    def __init__(self, profiledir, interval=DEFAULT_INTERVAL):
+        super(SamplingProfiler, self).__init__(name="Sampling profiler")
+        self.daemon = True
+        self.profiledir = profiledir
+        self.interval = interval
+        self.samples = {}  # group -> Counter(collapsed stack -> count)
+        self.nsamples = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """Take one sample of all grouped threads."""
+
+        groups = {}
+        for thread in threading.enumerate():
+            group = getattr(thread, 'profile_group', None)
+            if group is not None:
+                groups[thread.ident] = group
+
+        for ident, frame in list(sys._current_frames().items()):
+            group = groups.get(ident)
+            if group is None:
+                continue
+            self.samples.setdefault(group, Counter())[
+                collapse_stack(frame)] += 1
+        self.nsamples += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler to finish."""
+
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def dump(self):
+        """Write one collapsed-stack file per group into profiledir.
+
+        :returns: the list of written filenames."""
+
+        dt = datetime.now().strftime('%Y%m%d%H%M%S')
+        filenames = []
+        for group, stacks in sorted(self.samples.items()):
+            filename = os.path.join(self.profiledir,
+                                    "%s_%s.folded" % (dt, group))
+            with open(filename, 'w') as folded:
+                for stack, count in stacks.most_common():
+                    folded.write("%s %d\n" % (stack, count))
+            filenames.append(filename)
+        return filenames
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+"""Microbenchmark of the parsing of FETCH (FLAGS UID INTERNALDATE)
+responses, as done when loading the message list of an IMAP folder.
+
+The tokenizer path (flags2hash, flagsimap2maildir, flagsimap2keywords and
+Internaldate2epoch on each line) is compared with parse_fetch_flags(), on
+synthetic responses with a realistic mix of flags.
+
+Example:
+    python3 test/bench_fetch.py --messages 100000
+"""
+
+import sys
+import os
+import argparse
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from offlineimap import imaputil, imaplibutil
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.ui import UI_LIST, setglobalui
+
+FLAG_SETS = [b'', b'\\Seen', b'\\Seen', b'\\Seen', b'\\Seen \\Answered',
+             b'\\Seen \\Flagged', b'\\Deleted \\Seen', b'\\Seen $Junk',
+             b'\\Seen NonJunk $label1']
+MONTHS = [b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun', b'Jul', b'Aug',
+          b'Sep', b'Oct', b'Nov', b'Dec']
+
+
+def responses(count):
+    rand = random.Random(0)
+    for num in range(1, count + 1):
+        date = b'%2d-%s-%d %02d:%02d:%02d %s%02d00' % (
+            rand.randint(1, 28), rand.choice(MONTHS), rand.randint(2000, 2024),
+            rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59),
+            rand.choice([b'+', b'-']), rand.randint(0, 12))
+        yield b'%d (FLAGS (%s) UID %d INTERNALDATE "%s")' % (
+            num, rand.choice(FLAG_SETS), num * 3, date)
+
+
+def tokenizer(response):
+    # What IMAPFolder.cachemessagelist() used to do.
+    result = {}
+    for messagestr in response:
+        messagestr = messagestr.decode('utf-8').split(' ', 1)[1]
+        options = imaputil.flags2hash(messagestr)
+        uid = int(options['UID'])
+        result[uid] = (imaputil.flagsimap2maildir(options['FLAGS']),
+                       imaputil.flagsimap2keywords(options['FLAGS']),
+                       imaplibutil.Internaldate2epoch(
+                           messagestr.encode('utf-8')))
+    return result
+
+
+def parser(response):
+    result = {}
+    for messagestr in response:
+        uid, flags, keywords, rtime = imaputil.parse_fetch_flags(messagestr)
+        result[uid] = (flags, keywords, rtime)
+    return result
+
+
+def bench(function, response, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(response)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--messages', type=int, default=100000,
+                           help="number of FETCH responses")
+    argparser.add_argument('--repeat', type=int, default=3,
+                           help="best of this many runs is reported")
+    args = argparser.parse_args()
+    # The tokenizer logs debug messages.
+    setglobalui(UI_LIST['quiet'](CustomConfigParser()))
+
+    response = list(responses(args.messages))
+    old, expected = bench(tokenizer, response, args.repeat)
+    new, result = bench(parser, response, args.repeat)
+    if result != expected:
+        print("parse_fetch_flags() results differ from the tokenizer ones")
+        return 1
+    print("%d messages: tokenizer %.3fs, parse_fetch_flags %.3fs (x%.1f)" %
+          (args.messages, old, new, old / new))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+"""Startup benchmark: import time and wall time of short runs, as done by
+cron jobs running IMAPMirror every minute.
+
+Two runs are measured:
+- version: 'offlineimap.py --version',
+- noop: 'offlineimap.py -o -u quiet' on an account already in sync, with
+  the test IMAP server.
+
+The import time is the sum of the top-level imports reported by
+'python -X importtime'.  The exit status is 1 if the best import time of a
+run is over its budget.
+
+Example:
+    python3 test/bench_startup.py --repeat 5 --top 10
+"""
+
+import sys
+import os
+import argparse
+import json
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from test import helper
+
+# Import time budgets, in milliseconds, with room for noisy machines.  Both
+# runs took 140ms before the UIs and backends were imported on demand.
+BUDGETS = {'version': 80, 'noop': 130}
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+CONF = """
+[general]
+accounts = Test
+metadata = {tmpdir}/metadata
+
+[Account Test]
+localrepository = TestLocal
+remoterepository = TestRemote
+
+[Repository TestLocal]
+type = Maildir
+localfolders = {tmpdir}/maildir
+
+[Repository TestRemote]
+type = IMAP
+remoteuser = test
+remotepass = password
+transporttunnel = python3 '{server}' --initial_mboxes_content '{tmpdir}/mboxes.json' --encode_str_as utf7m --dump_mbox_filename '{tmpdir}/final.json'
+"""
+
+
+def importtimes(stderr):
+    """Returns the total import time and the self time of each module, in
+    microseconds, from the output of -X importtime."""
+
+    total = 0
+    modules = {}
+    for line in stderr.splitlines():
+        mo = IMPORTTIME_RE.match(line)
+        if mo is None:
+            continue
+        selftime, cumulative, indent, name = mo.groups()
+        modules[name] = int(selftime)
+        if len(indent) == 1:
+            total += int(cumulative)
+    return total, modules
+
+
+def run(args, repeat):
+    """Returns the best wall time and import time of args, in seconds, and
+    the module self times of the run with the best import time."""
+
+    best_wall = best_import = None
+    best_modules = {}
+    command = [sys.executable, '-X', 'importtime',
+               os.path.join(SRC_DIR, 'offlineimap.py')] + args
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(command, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, text=True, env=dict(
+                                  os.environ, PYTHONUNBUFFERED=''))
+        wall = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError("%s failed:\n%s" % (' '.join(command),
+                                                   proc.stderr[-2000:]))
+        total, modules = importtimes(proc.stderr)
+        if best_wall is None or wall < best_wall:
+            best_wall = wall
+        if best_import is None or total < best_import:
+            best_import, best_modules = total, modules
+    return best_wall, best_import / 1e6, best_modules
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--repeat', type=int, default=5,
+                           help="best of this many runs is reported")
+    argparser.add_argument('--top', type=int, default=0,
+                           help="list the modules with the highest self "
+                                "import time")
+    args = argparser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='imapmirror_bench_')
+    try:
+        with open(os.path.join(tmpdir, 'mboxes.json'), 'w') as f:
+            json.dump(helper.get_sample_imap_data(), f)
+        os.mkdir(os.path.join(tmpdir, 'maildir'))
+        os.mkdir(os.path.join(tmpdir, 'metadata'))
+        conffile = os.path.join(tmpdir, 'imapmirror.conf')
+        with open(conffile, 'w') as f:
+            f.write(CONF.format(tmpdir=tmpdir, server=os.path.join(
+                SRC_DIR, 'test', 'test_imap_server.py')))
+        noop = ['-o', '-u', 'quiet', '-c', conffile]
+        run(noop, 1)  # Initial sync.
+
+        results = [('version', run(['--version'], args.repeat)),
+                   ('noop', run(noop, args.repeat))]
+    finally:
+        shutil.rmtree(tmpdir)
+
+    status = 0
+    for name, (wall, imports, modules) in results:
+        over = imports * 1000 > BUDGETS[name]
+        status |= over
+        loaded = sorted(m for m in modules if m.startswith('offlineimap'))
+        print("%-8s wall %6.1fms  imports %6.1fms (budget %dms%s)  "
+              "%d IMAPMirror modules" % (name, wall * 1000, imports * 1000,
+                                         BUDGETS[name],
+                                         ", OVER" if over else "",
+                                         len(loaded)))
+        if args.top:
+            for module in sorted(modules, key=modules.get,
+                                 reverse=True)[:args.top]:
+                print("    %7.1fms %s" % (modules[module] / 1000, module))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
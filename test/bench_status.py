@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+"""Microbenchmark of the plain text LocalStatus backend during an initial
+sync: one savemessage() per copied message, then the end of the folder.
+
+The status file is saved after each change (the former behaviour) and with
+the autosave policy of LocalStatusFolder.  The bytes written are those
+reported by /proc/self/io, or computed from the file size where it is not
+available.
+
+Example:
+    python3 test/bench_status.py --messages 5000
+"""
+
+import sys
+import os
+import argparse
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.accounts import Account
+from offlineimap.folder.LocalStatus import LocalStatusFolder
+from offlineimap.repository.LocalStatus import LocalStatusRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+
+def written_bytes():
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class CountingFolder(LocalStatusFolder):
+    """Counts the saves and the bytes they write."""
+
+    saves = 0
+    saved_bytes = 0
+
+    def saveall(self):
+        super(CountingFolder, self).saveall()
+        self.saves += 1
+        self.saved_bytes += os.path.getsize(self.filename)
+
+
+class EachChangeFolder(CountingFolder):
+    """Saves after each change, as the backend used to."""
+
+    def _changed(self, count=1):
+        self.saveall()
+
+
+def run(config, messages, folderclass):
+    account = Account(config, 'Bench')
+    os.makedirs(account.getaccountmeta(), exist_ok=True)
+    repository = LocalStatusRepository('Bench', account)
+    repository.setup_backend('plain')
+    os.makedirs(repository.root, exist_ok=True)
+    folder = folderclass('INBOX', repository)
+    folder.purge()
+    folder.cachemessagelist()
+
+    before = written_bytes()
+    start = time.perf_counter()
+    for uid in range(1, messages + 1):
+        folder.savemessage(uid, None, set('S'), 0)
+    folder.save()
+    folder.dropmessagelistcache()
+    elapsed = time.perf_counter() - start
+    after = written_bytes()
+    if before is None or after is None:
+        written = folder.saved_bytes
+    else:
+        written = after - before
+    return elapsed, folder.saves, written
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--messages', type=int, default=5000,
+                           help="number of messages copied")
+    args = argparser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='imapmirror_bench_')
+    try:
+        config = CustomConfigParser()
+        config.read_string("[general]\nmetadata = %s\naccounts = Bench\n"
+                           "fsync = false\ndry-run = false\n"
+                           "[Account Bench]\n" % tmpdir)
+        setglobalui(UI_LIST['quiet'](config))
+
+        results = [("each change", run(config, args.messages,
+                                       EachChangeFolder)),
+                   ("autosave", run(config, args.messages, CountingFolder))]
+    finally:
+        shutil.rmtree(tmpdir)
+    for name, (elapsed, saves, written) in results:
+        print("%-12s %8.3fs %8d saves %14d bytes written" %
+              (name, elapsed, saves, written))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
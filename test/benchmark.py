@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# Copyright (C) 2024 Etienne Buira & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+"""Offline benchmarks of IMAPMirror against the bundled test IMAP server.
+
+Synthetic mailboxes are generated and served by test_imap_server.py over a
+transport tunnel, then a sequence of scenarios is timed:
+
+ - full: initial sync into an empty Maildir
+ - quick: quick sync (-q) without any change on either side
+ - flags: full resync after flag churn on the server side
+ - pushflags: sync of flag changes made on the local side
+ - upload: sync of new messages added on the local side
+ - delete: sync of messages deleted on the local side
+
+The local side is either a Maildir or a second test IMAP server (--target).
+Each result also records the number of commands the remote server got, so
+that round trips can be compared, not just time.
+
+The link to the server can be slowed down with --latency_ms, --jitter_ms
+and --bandwidth to benchmark round-trip bound code paths, and made
+unreliable with --drop_rate; failed runs are recorded as such.
+
+Results are written as JSON. With --compare, results are checked against a
+previous JSON result and the exit status is non-zero when a scenario got
+slower than allowed by --tolerance, which makes it usable from CI.
+
+Example:
+    python3 test/benchmark.py --messages 10000 --output bench.json
+    python3 test/benchmark.py --messages 10000 --compare bench.json
+"""
+
+import sys
+import os
+import argparse
+import json
+import platform
+import random
+import time
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from test import helper
+
+_CRLF = "\r\n"
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_FLAGS = ('\\Seen', '\\Answered', '\\Flagged', '\\Draft')
+
+
+def message_size(rnd, args):
+    """Draw a message body size (in bytes) according to --size_distribution"""
+    if args.size_distribution == 'fixed':
+        return args.size
+    elif args.size_distribution == 'uniform':
+        return rnd.randint(1, 2 * args.size)
+    # Log-normal, median args.size: a few large messages among small ones
+    # as found in real mailboxes.
+    return max(1, int(rnd.lognormvariate(0, args.size_sigma) * args.size))
+
+
+def make_message(rnd, uid, mbox_name, body_size):
+    headers = ['From: <source%d@origin.com>' % rnd.randint(0, 99),
+               'To: <recipient@destination.com>',
+               'Subject: Benchmark message %d' % uid,
+               'Message-Id: <%d.%s@benchmark.origin.com>' % (uid, mbox_name)]
+    line = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit sed do.'
+    body = []
+    remaining = body_size
+    while remaining > 0:
+        body.append(line[:remaining])
+        remaining -= len(line) + len(_CRLF)
+    flags = [f for f in _FLAGS if rnd.random() < 0.3]
+    return {'uid': uid, 'flags': flags,
+            'date': '%2d-%s-2024' % (rnd.randint(1, 28), rnd.choice(_MONTHS)),
+            'content': _CRLF.join(headers) + 2 * _CRLF + _CRLF.join(body)}
+
+
+def generate_mailboxes(args):
+    """Synthetic mailboxes in the test server's JSON format"""
+    rnd = random.Random(args.seed)
+    res = dict()
+    per_mbox = args.messages // args.folders
+    for idx in range(args.folders):
+        mbox_name = 'INBOX' if idx == 0 else 'Folder%d' % idx
+        count = per_mbox + (args.messages % args.folders if idx == 0 else 0)
+        messages = [make_message(rnd, uid, mbox_name, message_size(rnd, args))
+                    for uid in range(1, count + 1)]
+        res[mbox_name] = {'uid_validity': 1, 'uid_next': count + 1,
+                          'messages': messages}
+    return res
+
+
+def churn_flags(mailboxes, args):
+    """Toggle one flag on --flag_churn of the messages, returns the count of
+    modified messages"""
+    rnd = random.Random(args.seed + 1)
+    changed = 0
+    for mbox in mailboxes.values():
+        for msg in mbox['messages']:
+            if rnd.random() >= args.flag_churn:
+                continue
+            flag = rnd.choice(_FLAGS)
+            if flag in msg['flags']:
+                msg['flags'].remove(flag)
+            else:
+                msg['flags'].append(flag)
+            changed += 1
+    return changed
+
+
+def maildir_messages(maildir):
+    """(folder path, subdir, filename) of all messages in a Maildir tree"""
+    res = []
+    for box in sorted(os.listdir(maildir)):
+        for subdir in ('cur', 'new'):
+            path = os.path.join(maildir, box, subdir)
+            for fname in sorted(os.listdir(path)):
+                res.append((os.path.join(maildir, box), subdir, fname))
+    return res
+
+
+class MaildirTarget(object):
+    """Local side of the benchmark stored as Maildir"""
+
+    name = 'maildir'
+
+    def __init__(self, imth):
+        self.__imth = imth
+
+    def configure(self):
+        pass
+
+    def before_run(self):
+        pass
+
+    def after_run(self):
+        pass
+
+    def add_messages(self, rnd, args, count):
+        inbox_new = self.__imth.get_tmp_filename('maildir', 'INBOX', 'new')
+        nbytes = 0
+        for idx in range(count):
+            msg = make_message(rnd, idx, 'upload', message_size(rnd, args))
+            fname = '%d_%d.benchmark:2,' % (time.time(), idx)
+            with open(os.path.join(inbox_new, fname), 'w', newline='') as f:
+                f.write(msg['content'].replace(_CRLF, os.linesep))
+            nbytes += len(msg['content'])
+        return nbytes
+
+    def toggle_flags(self, rnd, ratio):
+        changed = 0
+        for box_path, subdir, fname in maildir_messages(self.__imth.get_tmp_filename('maildir')):
+            if rnd.random() >= ratio:
+                continue
+            base, _, flags = fname.partition(':2,')
+            flags = set(flags) ^ set('F')
+            os.rename(os.path.join(box_path, subdir, fname),
+                      os.path.join(box_path, 'cur', base + ':2,' + ''.join(sorted(flags))))
+            changed += 1
+        return changed
+
+    def delete_messages(self, rnd, ratio):
+        deleted = 0
+        for box_path, subdir, fname in maildir_messages(self.__imth.get_tmp_filename('maildir')):
+            if rnd.random() < ratio:
+                os.unlink(os.path.join(box_path, subdir, fname))
+                deleted += 1
+        return deleted
+
+
+class IMAPTarget(object):
+    """Local side of the benchmark stored on a second test IMAP server"""
+
+    name = 'imap'
+
+    def __init__(self, imth, mailboxes):
+        self.__imth = imth
+        self.__initial_fn = imth.get_tmp_filename('imap_local_initial.json')
+        self.__final_fn = imth.get_tmp_filename('imap_local_final.json')
+        # Same folders as on the remote side, but empty.
+        self.__state = dict((name, {'uid_validity': 1, 'uid_next': 1, 'messages': []})
+                            for name in mailboxes)
+
+    def configure(self):
+        server_script_name = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          'test_imap_server.py')
+        self.__imth.update_conf({'Repository TestLocal': {
+            'type': 'IMAP',
+            'remoteuser': 'test',
+            'remotepass': 'password',
+            'transporttunnel': "python3 '%s' --initial_mboxes_content '%s' "
+                               "--encode_str_as utf7m --dump_mbox_filename '%s'" % (
+                                   server_script_name, self.__initial_fn,
+                                   self.__final_fn)}})
+
+    def before_run(self):
+        with open(self.__initial_fn, "w") as f:
+            json.dump(self.__state, f)
+
+    def after_run(self):
+        with open(self.__final_fn, "r") as f:
+            self.__state = json.load(f)
+
+    def add_messages(self, rnd, args, count):
+        inbox = self.__state['INBOX']
+        nbytes = 0
+        for idx in range(count):
+            msg = make_message(rnd, inbox['uid_next'], 'upload', message_size(rnd, args))
+            inbox['messages'].append(msg)
+            inbox['uid_next'] += 1
+            nbytes += len(msg['content'])
+        return nbytes
+
+    def toggle_flags(self, rnd, ratio):
+        changed = 0
+        for mbox in self.__state.values():
+            for msg in mbox['messages']:
+                if rnd.random() < ratio:
+                    if '\\Flagged' in msg['flags']:
+                        msg['flags'].remove('\\Flagged')
+                    else:
+                        msg['flags'].append('\\Flagged')
+                    changed += 1
+        return changed
+
+    def delete_messages(self, rnd, ratio):
+        deleted = 0
+        for mbox in self.__state.values():
+            kept = []
+            for msg in mbox['messages']:
+                if rnd.random() < ratio:
+                    deleted += 1
+                else:
+                    kept.append(msg)
+            mbox['messages'] = kept
+        return deleted
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.__args = args
+        self.__imth = helper.IMTestHelper()
+        self.__imth.load_default_conf()
+        self.__imth.update_conf({'general': {'ui': 'quiet'},
+                                 'Repository TestRemote': {
+                                     'maxconnections': str(args.maxconnections)}})
+        self.__stats_fn = self.__imth.get_tmp_filename('imap_side', 'stats.json')
+        self.results = dict()
+
+    def __get_stats(self):
+        """Sums the per-command counters of all the server connections"""
+        commands = dict()
+        connections = 0
+        if os.path.exists(self.__stats_fn):
+            with open(self.__stats_fn, "r") as f:
+                for line in f:
+                    connections += 1
+                    for cmd, count in json.loads(line)['commands'].items():
+                        commands[cmd] = commands.get(cmd, 0) + count
+            os.unlink(self.__stats_fn)
+        return {'connections': connections, 'commands': commands,
+                'round_trips': sum(commands.values())}
+
+    def __run(self, name, messages, nbytes, extra_args=()):
+        args = list(extra_args)
+        server_args = ['--seed', str(self.__args.seed), '--stats_filename', self.__stats_fn]
+        if self.__args.no_uidplus:
+            server_args.append('--no_uidplus')
+        if self.__args.condstore:
+            server_args.append('--condstore')
+        for opt in ('latency_ms', 'jitter_ms', 'bandwidth', 'drop_rate'):
+            if getattr(self.__args, opt):
+                server_args += ['--' + opt, str(getattr(self.__args, opt))]
+        failed = False
+        self.__target.before_run()
+        start = time.perf_counter()
+        try:
+            self.__imth.run_offlineimap('utf7m', extra_args=args, server_args=server_args,
+                                        single_thread=self.__args.single_thread)
+        except subprocess.CalledProcessError:
+            failed = True
+        elapsed = time.perf_counter() - start
+        self.__target.after_run()
+        self.results[name] = {
+            'failed': failed,
+            'seconds': elapsed,
+            'messages': messages,
+            'bytes': nbytes,
+            'messages_per_second': messages / elapsed if elapsed else None,
+            'server': self.__get_stats(),
+        }
+        print("%-9s %10.3fs %8d msgs %12d bytes %8d round trips%s" % (
+            name, elapsed, messages, nbytes, self.results[name]['server']['round_trips'],
+            " FAILED" if failed else ""))
+        # Feed the server with the state it had at the end of the run, as a
+        # real server would keep it.
+        return self.__imth.get_final_imap_mailbox()
+
+    def run(self):
+        mailboxes = generate_mailboxes(self.__args)
+        total = sum(len(m['messages']) for m in mailboxes.values())
+        nbytes = sum(len(msg['content']) for m in mailboxes.values()
+                     for msg in m['messages'])
+        if self.__args.target == 'imap':
+            self.__target = IMAPTarget(self.__imth, mailboxes)
+        else:
+            self.__target = MaildirTarget(self.__imth)
+        self.__target.configure()
+        rnd = random.Random(self.__args.seed + 2)
+        scenarios = self.__args.scenarios
+        self.__imth.set_initial_imap_mailbox(mailboxes)
+        try:
+            if 'full' in scenarios:
+                mailboxes = self.__run('full', total, nbytes)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+            if 'quick' in scenarios:
+                mailboxes = self.__run('quick', total, 0, ['-q'])
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+            if 'flags' in scenarios:
+                changed = churn_flags(mailboxes, self.__args)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+                mailboxes = self.__run('flags', changed, 0)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+            if 'pushflags' in scenarios:
+                changed = self.__target.toggle_flags(rnd, self.__args.flag_churn)
+                mailboxes = self.__run('pushflags', changed, 0)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+            if 'upload' in scenarios:
+                count = max(1, int(total * self.__args.upload_ratio))
+                upload_bytes = self.__target.add_messages(rnd, self.__args, count)
+                mailboxes = self.__run('upload', count, upload_bytes)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+            if 'delete' in scenarios:
+                deleted = self.__target.delete_messages(rnd, self.__args.flag_churn)
+                mailboxes = self.__run('delete', deleted, 0)
+                self.__imth.set_initial_imap_mailbox(mailboxes)
+        finally:
+            self.__imth.cleanup()
+        return self.results
+
+
+def get_metadata(args):
+    try:
+        rev = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             text=True).stdout.strip() or None
+    except OSError:
+        rev = None
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'revision': rev,
+        'parameters': {k: v for k, v in vars(args).items()
+                       if k not in ('output', 'compare', 'tolerance')},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of scenarios slower than baseline by more than
+    tolerance (a ratio)"""
+    regressions = []
+    for name, res in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['seconds']
+        after = res['seconds']
+        if res.get('failed') and not baseline['results'][name].get('failed'):
+            print("%-9s FAILED" % name)
+            regressions.append(name)
+            continue
+        ratio = after / before if before else 1.0
+        status = 'REGRESSION' if ratio > 1 + tolerance else 'ok'
+        print("%-9s %10.3fs -> %10.3fs (%+6.1f%%) %s" %
+              (name, before, after, (ratio - 1) * 100, status))
+        if status != 'ok':
+            regressions.append(name)
+    return regressions
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description="IMAPMirror offline benchmarks")
+    parser.add_argument('--messages', type=int, default=10000,
+                        help="total number of messages (default: %(default)s)")
+    parser.add_argument('--folders', type=int, default=1,
+                        help="number of folders to spread messages over")
+    parser.add_argument('--size', type=int, default=4096,
+                        help="median message body size in bytes")
+    parser.add_argument('--size_distribution', choices=['lognormal', 'uniform', 'fixed'],
+                        default='lognormal')
+    parser.add_argument('--size_sigma', type=float, default=1.0,
+                        help="sigma of the lognormal size distribution")
+    parser.add_argument('--flag_churn', type=float, default=0.1,
+                        help="ratio of messages whose flags change before the flags scenario")
+    parser.add_argument('--upload_ratio', type=float, default=0.1,
+                        help="messages to upload in the upload scenario, as a ratio of --messages")
+    parser.add_argument('--scenarios', nargs='+',
+                        default=['full', 'quick', 'flags', 'pushflags', 'upload', 'delete'],
+                        choices=['full', 'quick', 'flags', 'pushflags', 'upload', 'delete'])
+    parser.add_argument('--target', choices=['maildir', 'imap'], default='maildir',
+                        help="local repository type")
+    parser.add_argument('--no_uidplus', action='store_true',
+                        help="the remote server does not advertise UIDPLUS")
+    parser.add_argument('--condstore', action='store_true',
+                        help="the remote server advertises CONDSTORE")
+    parser.add_argument('--maxconnections', type=int, default=1)
+    parser.add_argument('--single_thread', action='store_true',
+                        help="run IMAPMirror with -1")
+    parser.add_argument('--latency_ms', type=float, default=0.0,
+                        help="round trip time added by the server to each command")
+    parser.add_argument('--jitter_ms', type=float, default=0.0,
+                        help="random variation of the round trip time")
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help="link bandwidth in bytes per second")
+    parser.add_argument('--drop_rate', type=float, default=0.0,
+                        help="probability for each command to drop the connection")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write JSON results to this file")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="compare against JSON results of a previous run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown ratio in compare mode (default: %(default)s)")
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    results = Benchmark(args).run()
+    report = {'metadata': get_metadata(args), 'results': results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
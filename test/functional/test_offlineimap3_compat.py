@@ -15,6 +15,7 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 
+import os
 import unittest
 import re
 import json
@@ -86,3 +87,206 @@ class OfflineImapCompat(unittest.TestCase):
             imth.run_offlineimap('utf7m')
         imth.cleanup()
 
+
+    def test_local_changes_pushed_to_imap(self):
+        imth = helper.IMTestHelper()
+        imth.load_default_conf()
+        imth.set_initial_imap_mailbox(helper.get_sample_imap_data())
+        imth.run_offlineimap('utf7m')
+        imth.set_initial_imap_mailbox(imth.get_final_imap_mailbox())
+        inbox = imth.get_tmp_filename('maildir', 'INBOX')
+        # New local message, flag change and deletion.
+        with open(os.path.join(inbox, 'new', '1_1.local:2,'), 'w') as f:
+            f.write('From: <local@destination.com>\nSubject: Local\n\nLocal mail.\n')
+        for fname in os.listdir(os.path.join(inbox, 'cur')) + os.listdir(os.path.join(inbox, 'new')):
+            subdir = 'cur' if os.path.exists(os.path.join(inbox, 'cur', fname)) else 'new'
+            if ',U=5,' in fname:
+                os.rename(os.path.join(inbox, subdir, fname), os.path.join(inbox, 'cur', fname + 'F'))
+            elif ',U=3,' in fname:
+                os.unlink(os.path.join(inbox, subdir, fname))
+        imth.run_offlineimap('utf7m')
+        messages = dict((msg['uid'], msg) for msg in imth.get_final_imap_mailbox()['INBOX']['messages'])
+        self.assertEqual(set(messages.keys()), {5, 100})
+        self.assertEqual(set(messages[5]['flags']), {'\\Seen', '\\Flagged'})
+        self.assertIn('Subject: Local', messages[100]['content'])
+        imth.cleanup()
+
+    def test_moves_detected(self):
+        imth = helper.IMTestHelper()
+        imth.load_default_conf()
+        imth.update_conf({'Account Test': {'movedetection': 'yes'}})
+        imth.set_initial_imap_mailbox(helper.get_sample_imap_data())
+        stats_fn = imth.get_tmp_filename('imap_side', 'stats.json')
+        server_args = ('--move', '--stats_filename', stats_fn)
+        imth.run_offlineimap('utf7m', server_args=server_args)
+        imth.set_initial_imap_mailbox(imth.get_final_imap_mailbox())
+        inbox = imth.get_tmp_filename('maildir', 'INBOX')
+        other_name = 'Internationalised &- specials &AOkA4ADo-'
+        other = imth.get_tmp_filename('maildir', other_name)
+
+        def find(folder, uid):
+            for subdir in ('cur', 'new'):
+                for fname in os.listdir(os.path.join(folder, subdir)):
+                    if ',U=%d,' % uid in fname:
+                        return os.path.join(folder, subdir, fname)
+            return None
+
+        # The links keep the inodes from being reused by new files.
+        links = imth.get_tmp_filename('links')
+        os.mkdir(links)
+
+        # Moved locally: the message is moved on the server.
+        path = find(inbox, 5)
+        inode = os.stat(path).st_ino
+        os.link(path, os.path.join(links, '5'))
+        os.rename(path, os.path.join(other, 'cur', '1_1.moved:2,S'))
+        os.unlink(stats_fn)
+        imth.run_offlineimap('utf7m', server_args=server_args)
+        with open(stats_fn) as f:
+            commands = json.loads(f.readline())['commands']
+        self.assertEqual(commands.get('uid move'), 1)
+        self.assertNotIn('append', commands)
+        final = imth.get_final_imap_mailbox()
+        self.assertEqual([msg['uid'] for msg in final['INBOX']['messages']], [3])
+        moved = dict((msg['uid'], msg) for msg in final['Internationalised & specials éàè']['messages'])
+        self.assertEqual(set(moved.keys()), {25, 50})
+        self.assertIn('Subject: Just a simple mail', moved[50]['content'])
+        self.assertEqual(os.stat(find(other, 50)).st_ino, inode)
+
+        # Moved on the server: the message file is moved locally.
+        messages = final['INBOX'].pop('messages')
+        for msg in messages:
+            msg['uid'] = final['Internationalised & specials éàè']['uid_next']
+            final['Internationalised & specials éàè']['uid_next'] += 1
+            final['Internationalised & specials éàè']['messages'].append(msg)
+        final['INBOX']['messages'] = []
+        imth.set_initial_imap_mailbox(final)
+        inode = os.stat(find(inbox, 3)).st_ino
+        os.link(find(inbox, 3), os.path.join(links, '3'))
+        imth.run_offlineimap('utf7m', server_args=server_args)
+        self.assertIsNone(find(inbox, 3))
+        self.assertEqual(os.stat(find(other, 51)).st_ino, inode)
+        self.assertEqual(imth.get_maildir()[other_name][51]['flags'], set())
+        imth.cleanup()
+
+    def test_hook_process(self):
+        imth = helper.IMTestHelper()
+        imth.load_default_conf()
+        events_fn = imth.get_tmp_filename('events')
+        hook_fn = imth.get_tmp_filename('hook.py')
+        with open(hook_fn, 'w') as f:
+            f.write("import json, os, sys\n"
+                    "for line in sys.stdin:\n"
+                    "    event = json.loads(line)\n"
+                    "    event['pid'] = os.getpid()\n"
+                    "    with open(%r, 'a') as f:\n"
+                    "        f.write(json.dumps(event) + '\\n')\n"
+                    "    print('handled', event['event'], flush=True)\n"
+                    % events_fn)
+        imth.update_conf({'Account Test': {
+            'hookprocess': "python3 '%s'" % hook_fn}})
+        imth.set_initial_imap_mailbox(helper.get_sample_imap_data())
+        imth.run_offlineimap('utf7m', single_thread=False)
+        imth.set_initial_imap_mailbox(imth.get_final_imap_mailbox())
+        inbox = imth.get_tmp_filename('maildir', 'INBOX')
+        for subdir in ('cur', 'new'):
+            for fname in os.listdir(os.path.join(inbox, subdir)):
+                if ',U=5,' in fname:
+                    os.rename(os.path.join(inbox, subdir, fname),
+                              os.path.join(inbox, 'cur', fname + 'F'))
+                elif ',U=3,' in fname:
+                    os.unlink(os.path.join(inbox, subdir, fname))
+        os.unlink(events_fn)
+        imth.run_offlineimap('utf7m', single_thread=False)
+        with open(events_fn) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(len(set(event.pop('pid') for event in events)), 1)
+        self.assertEqual(events[0], {'event': 'presync', 'account': 'Test',
+                                     'syncmode': 'full'})
+        self.assertEqual(events[-1], {'event': 'postsync', 'account': 'Test',
+                                      'syncmode': 'full'})
+        folders = sorted(events[1:-1], key=lambda event: event['folder'])
+        self.assertEqual(folders, [
+            {'event': 'folder', 'account': 'Test', 'syncmode': 'full',
+             'folder': 'INBOX', 'new': 0, 'deleted': 1, 'flagged': 1},
+            {'event': 'folder', 'account': 'Test', 'syncmode': 'full',
+             'folder': 'Internationalised &- specials &AOkA4ADo-',
+             'new': 0, 'deleted': 0, 'flagged': 0}])
+        imth.cleanup()
+
+    def test_imap_to_imap_server_side_copy(self):
+        imth = helper.IMTestHelper()
+        imth.load_default_conf()
+        # Both repositories are on the same server: INBOX is synced with
+        # Backup.INBOX.
+        imth.update_conf({
+            'Repository TestLocal': {
+                'type': 'IMAP', 'remoteuser': 'test', 'remotepass': 'password',
+                'folderfilter': "lambda f: f.startswith('Backup.')",
+                'nametrans': "lambda f: f[len('Backup.'):]"},
+            'Repository TestRemote': {
+                'folderfilter': "lambda f: f == 'INBOX'",
+                'nametrans': "lambda f: 'Backup.' + f"}})
+        mailboxes = helper.get_sample_imap_data()
+        mailboxes['Backup.INBOX'] = {'uid_validity': 7, 'uid_next': 1,
+                                     'messages': []}
+        imth.set_initial_imap_mailbox(mailboxes)
+        stats_fn = imth.get_tmp_filename('imap_side', 'stats.json')
+        state_fn = imth.get_tmp_filename('imap_side', 'state.json')
+        server_args = ('--stats_filename', stats_fn,
+                       '--state_filename', state_fn)
+        map_fn = imth.get_tmp_filename('metadata', 'Repository-TestLocal',
+                                       'UIDMapping', 'Backup.INBOX')
+
+        def commands():
+            counts = {}
+            with open(stats_fn) as f:
+                for line in f:
+                    for cmd, count in json.loads(line)['commands'].items():
+                        counts[cmd] = counts.get(cmd, 0) + count
+            os.unlink(stats_fn)
+            return counts
+
+        def uidmap():
+            with open(map_fn) as f:
+                return dict(tuple(map(int, line.split(':'))) for line in f)
+
+        def status():
+            return set(uid for uid, _, _, _ in imth.get_metadata()[
+                'Account-Test']['content']['Backup.INBOX'])
+
+        # Remote to local: the local UIDs come from COPYUID.
+        imth.run_offlineimap('utf7m', server_args=server_args, shared_server=True)
+        counts = commands()
+        self.assertEqual(counts.get('uid copy'), 1)
+        self.assertNotIn('append', counts)
+        final = imth.get_final_imap_mailbox()
+        self.assertEqual([(msg['uid'], msg['flags'])
+                          for msg in final['Backup.INBOX']['messages']],
+                         [(1, []), (2, ['\\Seen'])])
+        self.assertEqual(uidmap(), {1: 3, 2: 5})
+        self.assertEqual(status(), {3, 5})
+
+        # Local to remote: the new local message gets its remote UID from
+        # COPYUID.
+        with helper.edit_shared_mailboxes(state_fn) as state:
+            state['Backup.INBOX']['messages'].append(
+                dict(final['INBOX']['messages'][0], uid=3, flags=['\\Flagged']))
+            state['Backup.INBOX']['uid_next'] = 4
+        imth.run_offlineimap('utf7m', server_args=server_args, shared_server=True)
+        counts = commands()
+        self.assertEqual(counts.get('uid copy'), 1)
+        self.assertNotIn('append', counts)
+        final = imth.get_final_imap_mailbox()
+        self.assertEqual([(msg['uid'], msg['flags'])
+                          for msg in final['INBOX']['messages']],
+                         [(5, ['\\Seen']), (3, []), (100, ['\\Flagged'])])
+        self.assertEqual(uidmap(), {1: 3, 2: 5, 3: 100})
+        self.assertEqual(status(), {3, 5, 100})
+
+        # Nothing left to copy.
+        imth.run_offlineimap('utf7m', server_args=server_args, shared_server=True)
+        counts = commands()
+        self.assertNotIn('uid copy', counts)
+        self.assertNotIn('append', counts)
+        imth.cleanup()
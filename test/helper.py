@@ -22,6 +22,8 @@ import copy
 import subprocess
 import shutil
 import re
+import fcntl
+from contextlib import contextmanager
 from hashlib import md5
 
 import sqlite3
@@ -122,6 +124,18 @@ def imap_data_to_maildir(imap_data):
                             'content': msg['content'].replace('\r\n', os.linesep) }
     return res
 
+@contextmanager
+def edit_shared_mailboxes(state_filename):
+    """Yields the mailboxes shared by the test servers started with
+    --state_filename, and saves them back, under the lock of the servers."""
+    with open(state_filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(state_filename, "r") as f:
+            mailboxes = json.load(f)
+        yield mailboxes
+        with open(state_filename, "w") as f:
+            json.dump(mailboxes, f)
+
 class IMTestHelper(object):
     def __init__(self):
         self.__config = None
@@ -161,7 +175,10 @@ class IMTestHelper(object):
         if not os.path.exists(imapside_dir):
             os.mkdir(imapside_dir)
 
-    def run_offlineimap(self, str_encoding):
+    def run_offlineimap(self, str_encoding, extra_args=(), server_args=(), single_thread=True,
+                        shared_server=False):
+        """With shared_server, all the IMAP repositories log in the test
+        server of TestRemote, otherwise only TestRemote does."""
         src_dir = os.path.join(os.path.dirname(__file__), '../')
         if "'" in src_dir:
             raise ValueError("Checkout directory name must not contain \"'\"")
@@ -173,17 +190,32 @@ class IMTestHelper(object):
             json.dump(self.__initial_imap_mailbox, f)
         imap_final_mbox_fn = os.path.join(self.__tmpdir, 'imap_side', 'final_mbox.json')
         imap_wire_tap_fn = os.path.join(self.__tmpdir, 'imap_side', 'wire_tap.dump')
-        self.update_conf({'Repository TestRemote': { 'transporttunnel':
+        imap_sections = ['Repository TestRemote']
+        if shared_server:
+            imap_sections = [section for section in self.__config.sections()
+                             if section.startswith('Repository ') and
+                             self.__config.get(section, 'type') == 'IMAP']
+        self.update_conf(dict((section, { 'transporttunnel':
             "python3 '{server_script_name}' --initial_mboxes_content '{initial_mailbox_content_fn}' "
             "--wire_tap_filename '{wire_tap_fn}' --encode_str_as {str_encoding} "
             "--dump_mbox_filename '{dump_mbox}'".format(
                 server_script_name = server_script_name, initial_mailbox_content_fn = imap_initial_mboxes_fn,
                 wire_tap_fn = imap_wire_tap_fn, str_encoding = str_encoding,
-                dump_mbox = imap_final_mbox_fn) } })
+                dump_mbox = imap_final_mbox_fn) + ''.join(
+                    " '%s'" % arg for arg in server_args) }) for section in imap_sections))
         conf_fn = os.path.join(self.__tmpdir, 'imapmirror.conf')
         with open(conf_fn, "w") as f:
             self.__config.write(f)
-        subprocess.run([script_name, '-1', '-c', conf_fn]).check_returncode()
+        args = [script_name, '-c', conf_fn] + list(extra_args)
+        if single_thread:
+            args.insert(1, '-1')
+        subprocess.run(args).check_returncode()
+
+    def get_final_imap_mailbox(self):
+        """Mailboxes content as dumped by the test server at the end of the
+        last run, suitable for set_initial_imap_mailbox()"""
+        with open(os.path.join(self.__tmpdir, 'imap_side', 'final_mbox.json'), "r") as f:
+            return json.load(f)
 
     def get_maildir(self, dirname='maildir'):
         res = dict()
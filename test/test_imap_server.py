@@ -20,6 +20,10 @@ import os
 import argparse
 import json
 import re
+import random
+import time
+import fcntl
+from contextlib import contextmanager
 
 # Might be started standalone
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -41,6 +45,36 @@ def encode_literal(subject):
         subject = subject.encode('utf-8')
     return ("{%d}" % len(subject)).encode('ascii') + _CRLF + subject
 
+class LinkShaper(object):
+    """Emulates a slow and unreliable network link on top of the pipe
+
+    - latency/jitter: delay (in seconds) applied once per command, before
+      its response, to emulate a round trip
+    - bandwidth: bytes per second in each direction, None for unlimited
+    - drop_rate: probability for the connection to be dropped on a
+      command"""
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, drop_rate=0.0, seed=None):
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__bandwidth = bandwidth
+        self.__drop_rate = drop_rate
+        self.__random = random.Random(seed)
+
+    def round_trip(self):
+        delay = self.__latency
+        if self.__jitter:
+            delay += self.__random.uniform(-self.__jitter, self.__jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def transfer(self, byte_count):
+        if self.__bandwidth:
+            time.sleep(byte_count / self.__bandwidth)
+
+    def should_drop(self):
+        return self.__drop_rate > 0 and self.__random.random() < self.__drop_rate
+
 class TestImapServer(object):
     def __encode(self, item):
         if item is None:
@@ -98,7 +132,14 @@ class TestImapServer(object):
     def __handle_cmd_capability(self, tag, uid_cmd):
         assert not uid_cmd
         self.__iobuf.eat_chars(_CRLF)
-        self.__send_response('*', b'', [], b'CAPABILITY IMAP4rev1 AUTH=LOGIN')
+        capabilities = b'CAPABILITY IMAP4rev1 AUTH=LOGIN'
+        if self.__uidplus:
+            capabilities += b' UIDPLUS'
+        if self.__condstore:
+            capabilities += b' CONDSTORE'
+        if self.__move:
+            capabilities += b' MOVE'
+        self.__send_response('*', b'', [], capabilities)
         self.__send_response(tag, b'OK', [], b'CAPABILITY completed')
 
     def __handle_cmd_noop(self, tag, uid_cmd):
@@ -164,6 +205,8 @@ class TestImapServer(object):
         self.__send_response('*', b'OK', [ ('[UNSEEN %d]' % unseen_count).encode('ascii') ], b'')
         self.__send_response('*', b'OK', [ ('[UIDNEXT %d]' % mbox['uid_next']).encode('ascii') ], b'')
         self.__send_response('*', b'OK', [ ('[UIDVALIDITY %d]' % mbox['uid_validity']).encode('ascii') ], b'')
+        if self.__condstore:
+            self.__send_response('*', b'OK', [ ('[HIGHESTMODSEQ %d]' % self.__highest_modseq(mbox)).encode('ascii') ], b'')
         self.__send_response(tag, b'OK', [ rw_mode ], b'command complete')
 
     def __handle_cmd_select(self, tag, uid_cmd):
@@ -181,34 +224,36 @@ class TestImapServer(object):
         self.__send_response(tag, b'OK', [], b'logout completed')
         return True
 
-    __msg_set_part_re = re.compile(r'(?P<start>[0-9]+)(:(?P<end>([0-9]+)|\*))?(?P<coma>,?)')
+    __msg_set_part_re = re.compile(r'(?P<start>[0-9]+|\*)(:(?P<end>([0-9]+)|\*))?(?P<coma>,?)')
     def __select_messages(self, msg_list, uid_cmd):
-        def add_to_set(msg_idxs, mbox, imap_idx, uid_cmd):
-            if uid_cmd:
-                for idx in range(len(mbox['messages'])):
-                    if mbox['messages'][idx]['uid'] == imap_idx:
-                        msg_idxs.add(idx)
-                        return
-            else:
-                if imap_idx <= len(mbox['messages']):
-                    msg_idxs.add(imap_idx-1)
+        """Indexes (0 based) of the messages of the selected mailbox matching
+        the sequence set msg_list, in increasing order"""
+        mbox = self.__mailboxes[self.__selected_mailbox]
+        if uid_cmd:
+            uid_to_idx = dict((msg['uid'], idx) for idx, msg in enumerate(mbox['messages']))
+            last = max(uid_to_idx.keys()) if uid_to_idx else 0
+        else:
+            last = len(mbox['messages'])
 
         msg_idxs = set()
-        mbox = self.__mailboxes[self.__selected_mailbox]
         for match in self.__class__.__msg_set_part_re.finditer(msg_list):
+            start = last if match.group('start') == '*' else int(match.group('start'))
             if match.group('end') is None:
-                imap_idx = int(match.group('start'))
-                add_to_set(msg_idxs, mbox, imap_idx, uid_cmd)
+                end = start
+            elif match.group('end') == '*':
+                end = last
             else:
-                imap_idx_begin = int(match.group('start'))
-                if match.group('end') == '*':
-                    imap_idx_end = len(mbox['messages'])
+                end = int(match.group('end'))
+            if start > end:
+                start, end = end, start
+            if uid_cmd:
+                if end - start > len(uid_to_idx):
+                    msg_idxs.update(idx for uid, idx in uid_to_idx.items() if start <= uid <= end)
                 else:
-                    imap_idx_end = int(match.group('end'))
-                for imap_idx in range(imap_idx_begin, imap_idx_end+1):
-                    add_to_set(msg_idxs, mbox, imap_idx, uid_cmd)
-        return msg_idxs
-            
+                    msg_idxs.update(uid_to_idx[uid] for uid in range(start, end+1) if uid in uid_to_idx)
+            else:
+                msg_idxs.update(range(max(start, 1)-1, min(end, last)))
+        return sorted(msg_idxs)
 
     def __handle_cmd_fetch(self, tag, uid_cmd):
         assert self.__is_selected()
@@ -241,6 +286,20 @@ class TestImapServer(object):
                         cur_item.append(b'UID')
                         cur_item.append(msg['uid'])
                         uid_set = True
+                elif data_item == 'MODSEQ' and self.__condstore:
+                    cur_item.append(b'MODSEQ')
+                    cur_item.append(('(%d)' % msg.get('modseq', 1)).encode('ascii'))
+                elif data_item == 'RFC822.SIZE':
+                    cur_item.append(b'RFC822.SIZE')
+                    # Size with CRLF line endings, as reported by servers
+                    # storing the messages with bare LFs.
+                    content = msg['content'].encode('utf-8', errors='surrogateescape')
+                    cur_item.append(len(content) + content.count(b'\n') - content.count(_CRLF))
+                elif data_item == 'BODY.PEEK[HEADER]':
+                    content = msg['content'].encode('utf-8', errors='surrogateescape')
+                    header_end = re.search(rb'\r?\n\r?\n', content)
+                    cur_item.append(b'BODY[HEADER]')
+                    cur_item.append(encode_literal(content[:header_end.end()] if header_end else content))
                 elif data_item == 'BODY.PEEK[]':
                     cur_item.append(b'BODY[]')
                     #cur_item.append(msg['content'])    # FIXME: client should work with any encoding
@@ -250,15 +309,346 @@ class TestImapServer(object):
             self.__send_response('*', ("%d FETCH" % (msg_idx+1)).encode('ascii'), [cur_item], b'')
         self.__send_response(tag, b'OK', [], b'FETCH complete')
 
+    def __handle_cmd_store(self, tag, uid_cmd):
+        assert self.__is_selected()
+        self.__iobuf.eat_chars(b' ')
+        msg_list = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(b' ')
+        unchanged_since = None
+        item_name = self.__iobuf.read_list_or_string()
+        if isinstance(item_name, list):
+            # Modifiers, only (UNCHANGEDSINCE <mod-sequence>) is supported.
+            if not self.__condstore or len(item_name) != 2 or item_name[0].upper() != 'UNCHANGEDSINCE':
+                raise ValueError("Unsupported STORE modifiers: %s" % item_name)
+            unchanged_since = int(item_name[1])
+            self.__iobuf.eat_chars(b' ')
+            item_name = self.__iobuf.read_string(True)
+        item_name = item_name.upper()
+        self.__iobuf.eat_chars(b' ')
+        flags = self.__iobuf.read_list_or_string()
+        self.__iobuf.eat_chars(_CRLF)
+        if not isinstance(flags, list):
+            flags = [flags]
+        silent = item_name.endswith('.SILENT')
+        if silent:
+            item_name = item_name[:-len('.SILENT')]
+        if item_name not in ('FLAGS', '+FLAGS', '-FLAGS'):
+            self.__send_response(tag, b'BAD', [], b'Unknown STORE data item')
+            return
+        if not self.__writable:
+            self.__send_response(tag, b'NO', [], b'Mailbox is read-only')
+            return
+        mbox = self.__mailboxes[self.__selected_mailbox]
+        modified = []
+        for msg_idx in self.__select_messages(msg_list, uid_cmd):
+            msg = mbox['messages'][msg_idx]
+            if unchanged_since is not None and msg.get('modseq', 1) > unchanged_since:
+                modified.append(msg['uid'] if uid_cmd else msg_idx+1)
+                continue
+            old_flags = list(msg['flags'])
+            if item_name == 'FLAGS':
+                msg['flags'] = list(flags)
+            elif item_name == '+FLAGS':
+                msg['flags'] += [f for f in flags if f not in msg['flags']]
+            else:
+                msg['flags'] = [f for f in msg['flags'] if f not in flags]
+            if msg['flags'] != old_flags:
+                mbox['highest_modseq'] = msg['modseq'] = self.__highest_modseq(mbox) + 1
+            # A conditional STORE reports the new MODSEQ even when silent
+            # (RFC 7162, 3.1.3).
+            if silent and unchanged_since is None:
+                continue
+            cur_item = []
+            if uid_cmd:
+                cur_item += [b'UID', msg['uid']]
+            if not silent:
+                cur_item += [b'FLAGS', ("(%s)" % " ".join(msg['flags'])).encode('ascii')]
+            if self.__condstore:
+                cur_item += [b'MODSEQ', ('(%d)' % msg.get('modseq', 1)).encode('ascii')]
+            self.__send_response('*', ("%d FETCH" % (msg_idx+1)).encode('ascii'), [cur_item], b'')
+        if modified:
+            self.__send_response(tag, b'OK', [ ('[MODIFIED %s]' % imaputil.uid_sequence(modified)).encode('ascii') ],
+                                 b'Conditional STORE failed')
+        else:
+            self.__send_response(tag, b'OK', [], b'STORE completed')
+
+    @staticmethod
+    def __highest_modseq(mbox):
+        return max([msg.get('modseq', 1) for msg in mbox['messages']] + [mbox.get('highest_modseq', 1)])
+
+    def __handle_cmd_append(self, tag, uid_cmd):
+        assert self.__is_authenticated()
+        assert not uid_cmd
+        self.__iobuf.eat_chars(b' ')
+        mbox_name = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(b' ')
+        flags = []
+        date = None
+        content = self.__iobuf.read_list_or_string()
+        if isinstance(content, list):
+            flags = content
+            self.__iobuf.eat_chars(b' ')
+            content = self.__iobuf.read_string(False)
+        if not isinstance(content, bytes):
+            date = content
+            self.__iobuf.eat_chars(b' ')
+            content = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(_CRLF)
+        if mbox_name not in self.__mailboxes:
+            self.__send_response(tag, b'NO', [], b'[TRYCREATE] No such mailbox')
+            return
+        mbox = self.__mailboxes[mbox_name]
+        uid = mbox['uid_next']
+        mbox['uid_next'] += 1
+        mbox['messages'].append({
+            'uid': uid, 'flags': flags,
+            'date': date if date is not None else time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime()),
+            'content': content.decode('utf-8', errors='surrogateescape'),
+        })
+        if mbox_name == self.__selected_mailbox:
+            self.__send_response('*', b'', [ ('%d EXISTS' % len(mbox['messages'])).encode('ascii') ], b'')
+        if self.__uidplus:
+            self.__send_response(tag, b'OK', [ ('[APPENDUID %d %d]' % (mbox['uid_validity'], uid)).encode('ascii') ],
+                                 b'APPEND completed')
+        else:
+            self.__send_response(tag, b'OK', [], b'APPEND completed')
+
+    def __handle_cmd_check(self, tag, uid_cmd):
+        assert self.__is_selected()
+        assert not uid_cmd
+        self.__iobuf.eat_chars(_CRLF)
+        self.__send_response(tag, b'OK', [], b'CHECK completed')
+
+    __search_flags = {
+        'ANSWERED': ('\\Answered', True), 'UNANSWERED': ('\\Answered', False),
+        'DELETED': ('\\Deleted', True), 'UNDELETED': ('\\Deleted', False),
+        'DRAFT': ('\\Draft', True), 'UNDRAFT': ('\\Draft', False),
+        'FLAGGED': ('\\Flagged', True), 'UNFLAGGED': ('\\Flagged', False),
+        'SEEN': ('\\Seen', True), 'UNSEEN': ('\\Seen', False),
+    }
+
+    @staticmethod
+    def __msg_date(date_str):
+        return time.strptime(date_str.strip().split(' ')[0], '%d-%b-%Y')[:3]
+
+    @staticmethod
+    def __msg_header_values(msg, name):
+        headers = re.split(r'\r?\n\r?\n', msg['content'], maxsplit=1)[0]
+        headers = re.sub(r'\r?\n[ \t]+', ' ', headers)
+        values = []
+        for line in re.split(r'\r?\n', headers):
+            hname, sep, value = line.partition(':')
+            if sep and hname.strip().lower() == name.lower():
+                values.append(value.strip())
+        return values
+
+    def __search_matcher(self, keys, uid_cmd):
+        """Builds a predicate f(msg_idx, msg) from the list of search keys,
+        consuming keys as it goes"""
+        key = keys.pop(0)
+        if isinstance(key, list):
+            keys_copy = list(key)
+            matchers = []
+            while keys_copy:
+                matchers.append(self.__search_matcher(keys_copy, uid_cmd))
+            return lambda idx, msg: all(m(idx, msg) for m in matchers)
+        ukey = key.upper()
+        if ukey == 'ALL':
+            return lambda idx, msg: True
+        if ukey in self.__class__.__search_flags:
+            flag, expected = self.__class__.__search_flags[ukey]
+            return lambda idx, msg: (flag in msg['flags']) == expected
+        if ukey == 'NOT':
+            sub = self.__search_matcher(keys, uid_cmd)
+            return lambda idx, msg: not sub(idx, msg)
+        if ukey == 'OR':
+            sub1 = self.__search_matcher(keys, uid_cmd)
+            sub2 = self.__search_matcher(keys, uid_cmd)
+            return lambda idx, msg: sub1(idx, msg) or sub2(idx, msg)
+        if ukey == 'UID':
+            idxs = set(self.__select_messages(keys.pop(0), True))
+            return lambda idx, msg: idx in idxs
+        if ukey in ('SMALLER', 'LARGER'):
+            size = int(keys.pop(0))
+            if ukey == 'SMALLER':
+                return lambda idx, msg: len(msg['content'].encode('utf-8', errors='surrogateescape')) < size
+            return lambda idx, msg: len(msg['content'].encode('utf-8', errors='surrogateescape')) > size
+        if ukey in ('SINCE', 'BEFORE', 'ON'):
+            ref = self.__class__.__msg_date(keys.pop(0))
+            if ukey == 'SINCE':
+                return lambda idx, msg: self.__class__.__msg_date(msg['date']) >= ref
+            if ukey == 'BEFORE':
+                return lambda idx, msg: self.__class__.__msg_date(msg['date']) < ref
+            return lambda idx, msg: self.__class__.__msg_date(msg['date']) == ref
+        if ukey == 'HEADER':
+            name = keys.pop(0)
+            value = keys.pop(0).lower()
+            return lambda idx, msg: any(value in v.lower()
+                                        for v in self.__class__.__msg_header_values(msg, name))
+        if re.fullmatch(r'[0-9*:,]+', key):
+            idxs = set(self.__select_messages(key, False))
+            return lambda idx, msg: idx in idxs
+        raise ValueError("Unsupported search key: %s" % key)
+
+    def __handle_cmd_search(self, tag, uid_cmd):
+        assert self.__is_selected()
+        keys = []
+        while True:
+            self.__iobuf.ensure_read(2)
+            if self.__iobuf.get_buffer()[0:2] == _CRLF:
+                break
+            self.__iobuf.eat_chars(b' ')
+            keys.append(self.__iobuf.read_list_or_string())
+        self.__iobuf.eat_chars(_CRLF)
+        if keys and isinstance(keys[0], str) and keys[0].upper() == 'CHARSET':
+            keys = keys[2:]
+        matchers = []
+        while keys:
+            matchers.append(self.__search_matcher(keys, uid_cmd))
+        mbox = self.__mailboxes[self.__selected_mailbox]
+        found = []
+        for idx, msg in enumerate(mbox['messages']):
+            if all(m(idx, msg) for m in matchers):
+                found.append(msg['uid'] if uid_cmd else idx+1)
+        self.__send_response('*', b'SEARCH', found, b'')
+        self.__send_response(tag, b'OK', [], b'SEARCH completed')
+
+    def __expunge(self, tag, msg_idxs):
+        if not self.__writable:
+            self.__send_response(tag, b'NO', [], b'Mailbox is read-only')
+            return
+        mbox = self.__mailboxes[self.__selected_mailbox]
+        kept = []
+        expunged = 0
+        for idx, msg in enumerate(mbox['messages']):
+            if idx in msg_idxs and '\\Deleted' in msg['flags']:
+                # Sequence numbers shift down after each EXPUNGE response.
+                self.__send_response('*', ("%d EXPUNGE" % (idx+1-expunged)).encode('ascii'), [], b'')
+                expunged += 1
+            else:
+                kept.append(msg)
+        mbox['messages'] = kept
+        self.__send_response(tag, b'OK', [], b'EXPUNGE completed')
+
+    def __handle_cmd_expunge(self, tag, uid_cmd):
+        assert self.__is_selected()
+        if uid_cmd:
+            assert self.__uidplus
+            self.__iobuf.eat_chars(b' ')
+            msg_idxs = set(self.__select_messages(self.__iobuf.read_string(False), True))
+        else:
+            msg_idxs = set(range(len(self.__mailboxes[self.__selected_mailbox]['messages'])))
+        self.__iobuf.eat_chars(_CRLF)
+        self.__expunge(tag, msg_idxs)
+
+    def __handle_cmd_status(self, tag, uid_cmd):
+        assert self.__is_authenticated()
+        assert not uid_cmd
+        self.__iobuf.eat_chars(b' ')
+        mbox_name = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(b' ')
+        status_items = self.__iobuf.read_list_or_string()
+        self.__iobuf.eat_chars(_CRLF)
+        if not isinstance(status_items, list):
+            status_items = [status_items]
+        if mbox_name not in self.__mailboxes:
+            self.__send_response(tag, b'NO', [], b'No such mailbox')
+            return
+        mbox = self.__mailboxes[mbox_name]
+        values = {
+            'MESSAGES': len(mbox['messages']),
+            'RECENT': 0,
+            'UIDNEXT': mbox['uid_next'],
+            'UIDVALIDITY': mbox['uid_validity'],
+            'UNSEEN': len([msg for msg in mbox['messages'] if '\\Seen' not in msg['flags']]),
+        }
+        result = []
+        for status_item in status_items:
+            result += [status_item.upper().encode('ascii'), values[status_item.upper()]]
+        self.__send_response('*', b'STATUS', [mbox_name, result], b'')
+        self.__send_response(tag, b'OK', [], b'STATUS completed')
+
+    def __read_copy_args(self):
+        self.__iobuf.eat_chars(b' ')
+        msg_list = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(b' ')
+        mbox_name = self.__iobuf.read_string(False)
+        self.__iobuf.eat_chars(_CRLF)
+        return msg_list, mbox_name
+
+    def __copy_messages(self, tag, uid_cmd, msg_list, mbox_name):
+        """Copies the messages of msg_list to the mailbox mbox_name, returns
+        the indexes of the source messages and the COPYUID response code,
+        None on error"""
+        if mbox_name not in self.__mailboxes:
+            self.__send_response(tag, b'NO', [], b'[TRYCREATE] No such mailbox')
+            return None
+        src = self.__mailboxes[self.__selected_mailbox]
+        dst = self.__mailboxes[mbox_name]
+        msg_idxs = self.__select_messages(msg_list, uid_cmd)
+        src_uids, dst_uids = [], []
+        # The copies get their UIDs in the order of the source UIDs, as
+        # COPYUID tells.
+        for msg_idx in sorted(msg_idxs, key=lambda idx: src['messages'][idx]['uid']):
+            msg = dict(src['messages'][msg_idx])
+            msg['flags'] = list(msg['flags'])
+            src_uids.append(msg['uid'])
+            msg['uid'] = dst['uid_next']
+            msg.pop('modseq', None)
+            dst['uid_next'] += 1
+            dst_uids.append(msg['uid'])
+            dst['messages'].append(msg)
+        if not self.__uidplus or not msg_idxs:
+            return msg_idxs, b''
+        return msg_idxs, ('[COPYUID %d %s %s]' % (dst['uid_validity'],
+                                                  imaputil.uid_sequence(src_uids),
+                                                  imaputil.uid_sequence(dst_uids))).encode('ascii')
+
+    def __handle_cmd_copy(self, tag, uid_cmd):
+        assert self.__is_selected()
+        copied = self.__copy_messages(tag, uid_cmd, *self.__read_copy_args())
+        if copied is None:
+            return
+        self.__send_response(tag, b'OK', [copied[1]] if copied[1] else [], b'COPY completed')
+
+    def __handle_cmd_move(self, tag, uid_cmd):
+        assert self.__is_selected()
+        assert self.__move
+        copy_args = self.__read_copy_args()
+        if not self.__writable:
+            self.__send_response(tag, b'NO', [], b'Mailbox is read-only')
+            return
+        copied = self.__copy_messages(tag, uid_cmd, *copy_args)
+        if copied is None:
+            return
+        msg_idxs, copyuid = copied
+        if copyuid:
+            self.__send_response('*', b'OK', [copyuid], b'Moved')
+        mbox = self.__mailboxes[self.__selected_mailbox]
+        # Sequence numbers shift down after each EXPUNGE response.
+        for expunged, idx in enumerate(msg_idxs):
+            self.__send_response('*', ("%d EXPUNGE" % (idx+1-expunged)).encode('ascii'), [], b'')
+        mbox['messages'] = [msg for idx, msg in enumerate(mbox['messages'])
+                            if idx not in set(msg_idxs)]
+        self.__send_response(tag, b'OK', [], b'MOVE completed')
+
     __command_handlers = {
+        'append': __handle_cmd_append,
         'capability': __handle_cmd_capability,
+        'check': __handle_cmd_check,
+        'copy': __handle_cmd_copy,
         'examine': __handle_cmd_examine,
+        'expunge': __handle_cmd_expunge,
         'fetch': __handle_cmd_fetch,
         'list': __handle_cmd_list,
         'login': __handle_cmd_login,
         'logout': __handle_cmd_logout,
+        'move': __handle_cmd_move,
         'noop': __handle_cmd_noop,
+        'search': __handle_cmd_search,
         'select': __handle_cmd_select,
+        'status': __handle_cmd_status,
+        'store': __handle_cmd_store,
     }
 
     def __try_process_command(self):
@@ -272,11 +662,33 @@ class TestImapServer(object):
         else:
             uid_cmd = False
 
+        self.__iobuf.command_received()
+        counter_name = ('uid ' if uid_cmd else '') + cmd.lower()
+        self.__counters[counter_name] = self.__counters.get(counter_name, 0) + 1
         if cmd.lower() in self.__class__.__command_handlers.keys():
-            return self.__class__.__command_handlers[cmd.lower()](self, tag, uid_cmd)
+            with self.__shared_mailboxes():
+                return self.__class__.__command_handlers[cmd.lower()](self, tag, uid_cmd)
         self.__send_response(tag, b'BAD', [], b'Command not implemented')
         raise ValueError("Unsupported command: %s, uid=%s" % (cmd, uid_cmd))
 
+    @contextmanager
+    def __shared_mailboxes(self, save=True):
+        """With --state_filename, loads the mailboxes shared by the servers
+        of all the connections, and saves them back, under a lock."""
+        if self.__state_filename is None:
+            yield
+            return
+        with open(self.__state_filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.__state_filename):
+                with open(self.__state_filename, "r") as f:
+                    self.__mailboxes = json.load(f)
+            yield
+            if save:
+                with open(self.__state_filename + '.tmp', "w") as f:
+                    json.dump(self.__mailboxes, f)
+                os.rename(self.__state_filename + '.tmp', self.__state_filename)
+
     def __process_commands(self):
         should_quit = False
         while not should_quit:
@@ -289,23 +701,37 @@ class TestImapServer(object):
         return self.__selected_mailbox is not None
 
     def run(self, args, in_stream, out_stream):
-        self.__iobuf = IMAPIOBuffer(in_stream, out_stream, args.wire_tap_filename)
+        link = LinkShaper(args.latency_ms / 1000.0, args.jitter_ms / 1000.0,
+                          args.bandwidth, args.drop_rate, args.seed)
+        self.__iobuf = IMAPIOBuffer(in_stream, out_stream, args.wire_tap_filename, link)
         self.__expected_min_size = 0
         self.__current_command = None
         self.__login = None
         self.__encode_str_as = args.encode_str_as
         with open(args.initial_mboxes_content, "r") as f:
             self.__mailboxes = json.load(f)
+        self.__state_filename = args.state_filename
         self.__selected_mailbox = None
         self.__writable = None
+        self.__uidplus = not args.no_uidplus
+        self.__condstore = args.condstore
+        self.__move = args.move
+        self.__counters = dict()
         self.__send_response('*', b'OK', [], b'IMAP4rev1 Server Ready')
         try:
             self.__process_commands()
             self.__iobuf.close()
         except ConnectionClosedException:
             pass
-        with open(args.dump_mbox_filename, "w") as f:
-            json.dump(self.__mailboxes, f)
+        stats = {'commands': self.__counters, 'literals': self.__iobuf.literal_count}
+        self.__iobuf.tap(b'STATS', json.dumps(stats, sort_keys=True).encode('ascii'))
+        if args.stats_filename:
+            # One line per connection, several servers may share the file.
+            with open(args.stats_filename, "a") as f:
+                f.write(json.dumps(stats) + "\n")
+        with self.__shared_mailboxes(save=False):
+            with open(args.dump_mbox_filename, "w") as f:
+                json.dump(self.__mailboxes, f)
 
     def get_arg_parser(self):
         parser = argparse.ArgumentParser()
@@ -313,13 +739,36 @@ class TestImapServer(object):
         parser.add_argument('--wire_tap_filename')
         parser.add_argument('--encode_str_as', choices=['utf7m', 'utf8', 'literal'], required=True)
         parser.add_argument('--dump_mbox_filename')
+        parser.add_argument('--state_filename',
+                            help="mailboxes shared by the servers of all the connections, "
+                                 "initialized with the initial content if missing")
+        parser.add_argument('--stats_filename',
+                            help="append per-command counters of the connection as a JSON line to this file")
+        parser.add_argument('--no_uidplus', action='store_true',
+                            help="do not advertise the UIDPLUS extension")
+        parser.add_argument('--condstore', action='store_true',
+                            help="advertise the CONDSTORE extension (RFC 7162)")
+        parser.add_argument('--move', action='store_true',
+                            help="advertise the MOVE extension (RFC 6851)")
+        parser.add_argument('--latency_ms', type=float, default=0.0,
+                            help="round trip time added to each command")
+        parser.add_argument('--jitter_ms', type=float, default=0.0,
+                            help="random variation of the round trip time")
+        parser.add_argument('--bandwidth', type=int, default=None,
+                            help="link bandwidth in bytes per second")
+        parser.add_argument('--drop_rate', type=float, default=0.0,
+                            help="probability for each command to drop the connection")
+        parser.add_argument('--seed', type=int, default=None,
+                            help="seed for jitter and drops, for reproducible runs")
         return parser
 
 class IMAPIOBuffer(object):
-    def __init__(self, in_stream, out_stream, wire_tap_filename):
+    def __init__(self, in_stream, out_stream, wire_tap_filename, link=None):
         self.__in_stream = in_stream
         self.__out_stream = out_stream
         self.__buffer = b''
+        self.__link = link if link is not None else LinkShaper()
+        self.literal_count = 0
         if wire_tap_filename is None:
             self.__wire_tap = None
         else:
@@ -338,10 +787,14 @@ class IMAPIOBuffer(object):
         if len(new_dat) == 0:
             self.close()
             raise ConnectionClosedException()
+        self.__link.transfer(len(new_dat))
         self.__buffer += new_dat
+        self.tap(('RECV(%d)' % len(new_dat)).encode('ascii'), new_dat)
+
+    def tap(self, label, data=b''):
         if self.__wire_tap is not None:
-            self.__wire_tap.write( ('RECV(%d):' % len(new_dat)).encode('ascii') )
-            self.__wire_tap.write(new_dat)
+            self.__wire_tap.write(label + b':')
+            self.__wire_tap.write(data)
 
     def ensure_read(self, count):
         while len(self.__buffer) < count:
@@ -350,24 +803,35 @@ class IMAPIOBuffer(object):
     def eat_data(self, count):
         self.__buffer = self.__buffer[count:]
 
+    def command_received(self):
+        if self.__link.should_drop():
+            self.tap(b'DROP')
+            self.close()
+            raise ConnectionClosedException()
+        self.__link.round_trip()
+
     def write_data(self, data):
-        self.__out_stream.write(data)
-        if self.__wire_tap is not None:
-            self.__wire_tap.write( ('SND(%d):' % len(data)).encode('ascii') )
-            self.__wire_tap.write(data)
-        self.__out_stream.flush()
+        self.__link.transfer(len(data))
+        try:
+            self.__out_stream.write(data)
+            self.__out_stream.flush()
+        except BrokenPipeError:
+            # Client may close its end as soon as it got BYE.
+            raise ConnectionClosedException()
+        self.tap(('SND(%d)' % len(data)).encode('ascii'), data)
 
     def close(self):
         self.__in_stream.close()
         self.__out_stream.close()
 
-    def __read_literal():
-        assert self.__buffer[0] == b'{'
-        while self.__buffer.find(b'}') == -1:
-            self.__ensure_read(len(self.__buffer)+1)
+    def __read_literal(self):
+        assert self.__buffer[0:1] == b'{'
+        while self.__buffer.find(b'}' + _CRLF) == -1:
+            self.ensure_read(len(self.__buffer)+1)
         close_brace_idx = self.__buffer.find(b'}')
         byte_count = int(self.__buffer[1:close_brace_idx])
-        self.eat_data(close_brace_idx)
+        self.eat_data(close_brace_idx + 1 + len(_CRLF))
+        self.literal_count += 1
         self.write_data(b'+ go ahead' + _CRLF)
         self.ensure_read(byte_count)
         literal  = self.__buffer[:byte_count]
@@ -428,9 +892,13 @@ class IMAPIOBuffer(object):
             return self.read_string(False)
         self.eat_chars(b'(')
         res = []
+        self.ensure_read(1)
+        if self.__buffer[0:1] == b')':
+            self.eat_chars(b')')
+            return res
         while True:
             if self.__buffer[0:1] == b'(':
-                res.append(self.__read_list_or_string())
+                res.append(self.read_list_or_string())
             else:
                 res.append(self.read_string(False))
             self.ensure_read(1)
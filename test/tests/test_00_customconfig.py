@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import unittest
+from configparser import NoOptionError
+from offlineimap.CustomConfig import CustomConfigParser
+
+
+class TestCustomConfigLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.config = CustomConfigParser()
+        self.config.read_string("[general]\n"
+                                "root = /tmp\n"
+                                "metadata = %(root)s/metadata\n"
+                                "fsync = no\n")
+
+    def test_cached(self):
+        self.assertEqual(self.config.get('general', 'metadata'),
+                         '/tmp/metadata')
+        self.assertFalse(self.config.getdefaultboolean('general', 'fsync',
+                                                       True))
+        self.assertIn(('getdefaultboolean', 'general', 'fsync', True),
+                      self.config._lookups)
+        self.assertFalse(self.config.getdefaultboolean('general', 'fsync',
+                                                       True))
+        self.assertEqual(self.config.getdefaultint('general', 'maxage',
+                                                   None), None)
+
+    def test_changes(self):
+        self.assertEqual(self.config.getdefault('general', 'metadata', None),
+                         '/tmp/metadata')
+        self.config.set('general', 'root', '/var')
+        self.assertEqual(self.config.getdefault('general', 'metadata', None),
+                         '/var/metadata')
+        self.config.read_string("[general]\nfsync = yes\n")
+        self.assertTrue(self.config.getboolean('general', 'fsync'))
+        self.config.remove_option('general', 'fsync')
+        self.assertTrue(self.config.getdefaultboolean('general', 'fsync',
+                                                      True))
+        with self.assertRaises(NoOptionError):
+            self.config.get('general', 'fsync')
+
+    def test_keyword_arguments(self):
+        self.assertEqual(self.config.get('general', 'metadata', raw=True),
+                         '%(root)s/metadata')
+        self.assertEqual(self.config.get('general', 'metadata'),
+                         '/tmp/metadata')
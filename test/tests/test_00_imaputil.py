@@ -74,3 +74,33 @@ class TestInternalFunctions(unittest.TestCase):
         """Test imaputil.uid_sequence()"""
         res = imaputil.uid_sequence([1, 2, 3, 4, 5, 10, 12, 13])
         self.assertEqual(res, '1:5,10,12:13')
+
+    def test_08_parse_fetch_flags(self):
+        """Test imaputil.parse_fetch_flags()"""
+        from offlineimap.imaplibutil import Internaldate2epoch
+        response = b'1 (FLAGS (\\Seen Old) UID 4807 ' \
+                   b'INTERNALDATE " 7-Mar-2024 23:04:05 -0130")'
+        res = imaputil.parse_fetch_flags(response)
+        self.assertEqual(res, (4807, set('S'), {'Old'},
+                               Internaldate2epoch(response)))
+        # Items in any order, no flag.
+        res = imaputil.parse_fetch_flags(
+            b'2 (UID 12 INTERNALDATE "17-Jul-1996 02:44:25 +0700" FLAGS ())')
+        self.assertEqual(res, (12, set(), set(), 837546265))
+        res = imaputil.parse_fetch_flags(b'3 (FLAGS (\\Deleted))')
+        self.assertEqual(res, (None, set('T'), set(), None))
+
+    def test_09_uid_sequence_chunks(self):
+        """Test imaputil.uid_sequence_chunks()"""
+        res = imaputil.uid_sequence_chunks([13, 1, 2, 3, 4, 5, 10, 12], 8)
+        self.assertEqual(res, [([1, 2, 3, 4, 5, 10], '1:5,10'),
+                               ([12, 13], '12:13')])
+        res = imaputil.uid_sequence_chunks(range(1, 200, 2), 100)
+        self.assertTrue(all(len(seq) <= 100 for _, seq in res))
+        self.assertEqual(sum((uids for uids, _ in res), []),
+                         list(range(1, 200, 2)))
+
+    def test_10_uid_sequence_to_list(self):
+        """Test imaputil.uid_sequence_to_list()"""
+        res = imaputil.uid_sequence_to_list('1:5,10,13:12')
+        self.assertEqual(res, [1, 2, 3, 4, 5, 10, 12, 13])
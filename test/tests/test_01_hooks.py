@@ -0,0 +1,58 @@
+import sys
+import unittest
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.hooks import HookProcess
+from offlineimap.ui import UI_LIST, setglobalui
+
+HOOK = """
+import json, sys, time
+for line in sys.stdin:
+    event = json.loads(line)["event"]
+    if event == "hang":
+        time.sleep(60)
+    elif event == "exit":
+        sys.exit(1)
+    print(event, flush=True)
+"""
+
+
+class Account:
+    def getname(self):
+        return 'Test'
+
+    def __str__(self):
+        return 'Test'
+
+
+class TestHookProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.ui = UI_LIST['basic'](CustomConfigParser())
+        self.ui.stoplogwriter()
+        setglobalui(self.ui)
+        self.warnings = []
+        self.ui.warn = self.warnings.append
+        self.hook = HookProcess(Account(), "'%s' -c '%s'" % (
+            sys.executable, HOOK), 0.5)
+
+    def tearDown(self):
+        self.hook.stop()
+        for handler in self.ui.logger.handlers[:]:
+            self.ui.logger.removeHandler(handler)
+
+    def test_restart(self):
+        self.hook.send('presync', 'full')
+        pid = self.hook.proc.pid
+        self.hook.send('folder', 'full', folder='INBOX', new=1)
+        self.assertEqual(self.hook.proc.pid, pid)
+        self.assertEqual(self.warnings, [])
+
+        self.hook.send('hang', 'full')
+        self.assertIsNone(self.hook.proc)
+        self.assertIn("did not answer", self.warnings[-1])
+        self.hook.send('exit', 'full')
+        self.assertIn("exited on event exit", self.warnings[-1])
+        self.hook.send('postsync', 'full')
+        self.assertNotEqual(self.hook.proc.pid, pid)
+        self.assertEqual(len(self.warnings), 2)
@@ -0,0 +1,111 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.accounts import Account
+from offlineimap.repository.IMAP import IMAPRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+
+class Connection:
+    def __init__(self):
+        self.loggedout = False
+
+    def logout(self):
+        self.loggedout = True
+
+
+class TestIMAPHost(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata = tempfile.mkdtemp()
+        self.config = CustomConfigParser()
+        self.config.read_string("[general]\nmetadata = %s\ndry-run = no\n" %
+                                self.metadata)
+        self.ui = UI_LIST['basic'](self.config)
+        self.ui.stoplogwriter()
+        setglobalui(self.ui)
+        # The hosts are process-wide, each test has its own.
+        self.hostname = self.id().rsplit('.', 1)[-1] + '.example.com'
+
+    def tearDown(self):
+        shutil.rmtree(self.metadata)
+        for handler in self.ui.logger.handlers[:]:
+            self.ui.logger.removeHandler(handler)
+
+    def server(self, name, user='user', **options):
+        """Returns the IMAPServer of a new account."""
+
+        self.config.read_dict({
+            'Account %s' % name: {'localrepository': 'Local',
+                                  'remoterepository': name},
+            'Repository %s' % name: dict(type='IMAP',
+                                         remotehost=self.hostname,
+                                         remoteuser=user, ssl='no',
+                                         **options)})
+        return IMAPRepository(name, Account(self.config, name)).imapserver
+
+    def idle(self, server):
+        """Adds an idle connection to server, holding a host slot."""
+
+        imapobj = Connection()
+        server.host.acquire(server)
+        server.availableconnections.append(imapobj)
+        server.lastowner[imapobj] = 0
+        return imapobj
+
+    def test_takeidleconnection(self):
+        server = self.server('A')
+        first, second = self.idle(server), self.idle(server)
+        self.assertIs(server.takeidleconnection(), first)
+        self.assertIs(server.takeidleconnection(), second)
+        self.assertIsNone(server.takeidleconnection())
+        self.assertEqual(server.lastowner, {})
+
+    def test_shared(self):
+        a = self.server('A', maxhostconnections='2')
+        b = self.server('B', maxhostconnections='2')
+        imapobj = self.idle(a)
+        self.assertIs(b.host, a.host)
+        self.assertIs(b.host.acquire(b), imapobj)
+        self.assertEqual(a.availableconnections, [])
+        self.assertEqual(a.host.connections, 1)
+
+    def test_not_shared(self):
+        # Neither by default, nor between other users or settings.
+        a = self.server('A')
+        b = self.server('B')
+        self.idle(a)
+        self.assertIsNone(b.host.acquire(b))
+        for name, user, options in (('C', 'other', {}),
+                                    ('D', 'user', {'readonly': 'yes'}),
+                                    ('E', 'user', {'reference': 'Mail'})):
+            self.idle(self.server(name, user, maxhostconnections='10',
+                                  **options))
+        f = self.server('F', maxhostconnections='10')
+        self.assertIsNone(f.host.acquire(f))
+        self.assertEqual(f.host.connections, 6)
+
+    def test_limit(self):
+        a = self.server('A', user='other', maxhostconnections='1')
+        b = self.server('B', maxhostconnections='1')
+        imapobj = self.idle(a)
+        # The idle connection of another user is closed to make room.
+        self.assertIsNone(b.host.acquire(b))
+        self.assertTrue(imapobj.loggedout)
+        self.assertEqual(a.availableconnections, [])
+        self.assertEqual(b.host.connections, 1)
+
+        # Then b waits for its connection to be released.
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(
+            a.host.acquire(a)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(acquired, [])
+        b.host.release()
+        thread.join()
+        self.assertEqual(acquired, [None])
+        self.assertEqual(b.host.connections, 1)
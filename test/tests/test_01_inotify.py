@@ -0,0 +1,65 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from offlineimap.utils.inotify import IN_Q_OVERFLOW, MaildirWatcher
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "inotify is Linux only")
+class TestMaildirWatcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for subdir in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.folder, subdir))
+        self.watcher = MaildirWatcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def touch(self, *path):
+        with open(os.path.join(self.folder, *path), 'w') as f:
+            f.write('x')
+
+    def test_changes(self):
+        self.watcher.watch(self.folder)
+        # Nothing stored yet, the folder has to be listed.
+        self.assertIsNone(self.watcher.checkout(self.folder))
+        self.watcher.checkin(self.folder, {1: 'list'})
+        self.assertEqual(self.watcher.checkout(self.folder),
+                         ({1: 'list'}, set()))
+        self.watcher.checkin(self.folder, {1: 'list'})
+
+        self.touch('tmp', 'a')  # Not watched.
+        os.rename(os.path.join(self.folder, 'tmp', 'a'),
+                  os.path.join(self.folder, 'new', 'a'))
+        self.touch('cur', 'b:2,S')
+        messagelist, changes = self.watcher.checkout(self.folder)
+        self.assertEqual(messagelist, {1: 'list'})
+        self.assertEqual(changes, {'new/a', 'cur/b:2,S'})
+        # Handed over until stored back.
+        self.assertIsNone(self.watcher.checkout(self.folder))
+
+    def test_folder_removed(self):
+        self.watcher.watch(self.folder)
+        self.watcher.checkin(self.folder, {})
+        shutil.rmtree(self.folder)
+        self.assertIsNone(self.watcher.checkout(self.folder))
+
+    def test_overflow_during_sync(self):
+        self.watcher.watch(self.folder)
+        self.assertIsNone(self.watcher.checkout(self.folder))
+        self.watcher.checkin(self.folder, {})
+
+        # The folder is being synced when the queue overflows.
+        messagelist, _ = self.watcher.checkout(self.folder)
+        read_events = self.watcher._inotify.read_events
+        self.watcher._inotify.read_events = lambda: read_events() + [
+            (-1, IN_Q_OVERFLOW, '')]
+        self.watcher.checkin(self.folder, messagelist)
+        self.watcher._inotify.read_events = read_events
+        self.assertIsNone(self.watcher.checkout(self.folder))
+        # Listed again after the overflow, the folder is trusted again.
+        self.watcher.checkin(self.folder, {})
+        self.assertEqual(self.watcher.checkout(self.folder), ({}, set()))
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from queue import Empty
+
+from offlineimap import accounts, init, supervisor
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.supervisor import assign, Supervisor
+from offlineimap.ui import UI_LIST, setglobalui
+
+
+class TestAssign(unittest.TestCase):
+    def test_balanced(self):
+        weights = {'a': 10, 'b': 6, 'c': 5, 'd': 1}
+        shards = assign(['a', 'b', 'c', 'd'], weights, 2)
+        self.assertEqual(sorted(shards), [['a', 'd'], ['b', 'c']])
+
+    def test_unknown_weight(self):
+        # Accounts never synced weigh as much as the average one.
+        shards = assign(['a', 'b', 'new'], {'a': 4, 'b': 4}, 3)
+        self.assertEqual(sorted(map(len, shards)), [1, 1, 1])
+        self.assertEqual(assign(['a', 'b'], {}, 1), [['a', 'b']])
+
+
+def stubworker(options, configtext, loglevel, accountnames, events, commands):
+    """Stands for runworker(): the accounts sync in no time, reporting the
+    sync time of their 'synctime' option, and loop until stopped unless
+    their 'stub' option is 'once'.  What the worker does is appended to
+    the file 'record' of the metadata directory."""
+
+    config = CustomConfigParser()
+    config.read_string(configtext)
+    recordpath = os.path.join(config.get('general', 'metadata'), 'record')
+
+    def record(what):
+        with open(recordpath, 'a') as f:
+            f.write('%d %s\n' % (os.getpid(), what))
+
+    terminated = []
+
+    def handler(sig, frame):
+        record(signal.Signals(sig).name)
+        if sig == signal.SIGTERM:
+            terminated.append(sig)
+
+    signal.signal(signal.SIGUSR1, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+    running = set()
+    exitstatus = 0
+
+    def sync(name):
+        section = 'Account ' + name
+        record('sync ' + name)
+        events.put(('synced', name,
+                    config.getdefaultfloat(section, 'synctime', 1.0)))
+        if config.getdefault(section, 'stub', 'loop') == 'once':
+            events.put(('stopped', name))
+        else:
+            running.add(name)
+        if config.has_option(section, 'log'):
+            events.put(('log', logging.makeLogRecord(
+                {'msg': config.get(section, 'log'), 'levelno': logging.INFO,
+                 'levelname': 'INFO'})))
+        return config.getdefaultint(section, 'exitstatus', 0)
+
+    for name in accountnames:
+        exitstatus = max(exitstatus, sync(name))
+    record('ready')
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if terminated:
+            for name in running:
+                events.put(('stopped', name))
+            running.clear()
+        try:
+            command, *args = commands.get(True, 0.1)
+        except Empty:
+            continue
+        if command == 'start':
+            record('start ' + args[0])
+            sync(args[0])
+        elif command == 'stop':
+            record('stop ' + args[0])
+            running.discard(args[0])
+            events.put(('stopped', args[0]))
+        elif command == 'quit':
+            break
+    sys.exit(exitstatus)
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = CustomConfigParser()
+        self.config.read_dict({'general': {'metadata': self.tmpdir,
+                                           'dry-run': 'no'}})
+        self.ui = UI_LIST['quiet'](self.config)
+        self.ui.stoplogwriter()
+        setglobalui(self.ui)
+        self.warnings = []
+        self.ui.warn = self.warnings.append
+        self.runworker = supervisor.runworker
+        supervisor.runworker = stubworker
+        self.supervisor = Supervisor(self.config, Namespace(runonce=False), 2)
+
+    def tearDown(self):
+        supervisor.runworker = self.runworker
+        accounts.Account.abort_soon_signal.clear()
+        accounts.Account.abort_NOW_signal.clear()
+        for handler in self.ui.logger.handlers[:]:
+            self.ui.logger.removeHandler(handler)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def addaccounts(self, **options):
+        self.config.read_dict(dict(('Account ' + name, values)
+                                   for name, values in options.items()))
+        return sorted(options)
+
+    def records(self):
+        """Returns the list of (pid, what) done by the workers so far."""
+        try:
+            with open(os.path.join(self.tmpdir, 'record')) as f:
+                return [tuple(line.rstrip('\n').split(' ', 1)) for line in f]
+        except FileNotFoundError:
+            return []
+
+    def waitfor(self, what, count=1):
+        for _ in range(300):
+            if [w for _, w in self.records()].count(what) >= count:
+                return
+            time.sleep(0.1)
+        self.fail("Workers did not record %s: %s" % (what, self.records()))
+
+    def start(self, accountnames):
+        """Runs the supervisor in a thread, so that the test can act on the
+        running workers."""
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(self.supervisor.run(accountnames)))
+        thread.start()
+        return thread, result
+
+    def test_rebalance(self):
+        # Saved sync times: a and c on a worker, b on the other.
+        with open(os.path.join(self.tmpdir, 'shards.json'), 'w') as f:
+            json.dump({'a': 5, 'b': 5, 'c': 1}, f)
+        names = self.addaccounts(a={'synctime': '5'}, b={'synctime': '0'},
+                                 c={'synctime': '1', 'autorefresh': '1'})
+        previous = supervisor.REBALANCE_INTERVAL
+        supervisor.REBALANCE_INTERVAL = 0
+        try:
+            thread, result = self.start(names)
+            # b syncs faster than it used to, c is moved to its worker.
+            self.waitfor('start c')
+            self.supervisor.forward(signal.SIGTERM)
+            thread.join()
+        finally:
+            supervisor.REBALANCE_INTERVAL = previous
+        self.assertEqual(result, [0])
+
+        pids = dict((what, pid) for pid, what in self.records())
+        self.assertEqual(pids['sync a'], pids['stop c'])
+        self.assertEqual(pids['sync b'], pids['start c'])
+        self.assertNotEqual(pids['sync a'], pids['sync b'])
+        with open(os.path.join(self.tmpdir, 'shards.json')) as f:
+            timings = json.load(f)
+        self.assertEqual(timings, {'a': 5, 'b': 3.5, 'c': 1})
+
+    def test_signals(self):
+        names = self.addaccounts(a={}, b={})
+        oi = init.OfflineImap()
+        oi.config = self.config
+        oi.ui = self.ui
+        oi.num_sigterm = 0
+        oi.supervisor = self.supervisor
+        thread, result = self.start(names)
+        self.waitfor('ready', 2)
+
+        # Handled by the supervisor as usual, and by the workers.
+        oi._signal_handler(signal.SIGUSR1, None)
+        self.waitfor('SIGUSR1', 2)
+        self.assertEqual(self.config.get('Account a', 'skipsleep'), '1')
+        self.assertEqual(self.config.get('Account b', 'skipsleep'), '1')
+
+        oi._signal_handler(signal.SIGTERM, None)
+        self.waitfor('SIGTERM', 2)
+        thread.join()
+        self.assertTrue(accounts.Account.abort_NOW_signal.is_set())
+        self.assertIn("Preparing to shutdown", self.warnings[0])
+        self.assertEqual(result, [0])
+        self.assertEqual(len(set(pid for pid, what in self.records()
+                                 if what == 'SIGTERM')), 2)
+
+    def test_exit_status(self):
+        names = self.addaccounts(
+            a={'stub': 'once', 'exitstatus': '3', 'log': 'failed in a'},
+            b={'stub': 'once'})
+        logged = []
+        handler = logging.Handler()
+        handler.emit = lambda record: logged.append(record.getMessage())
+        self.ui.logger.addHandler(handler)
+        self.assertEqual(self.supervisor.run(names), 3)
+        self.assertEqual(logged, ['failed in a'])
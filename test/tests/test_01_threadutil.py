@@ -0,0 +1,54 @@
+import threading
+import time
+import unittest
+
+from offlineimap import threadutil
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_jobs(self):
+        pool = threadutil.WorkerPool('Test', 2)
+        jobs = threadutil.JobGroup()
+        lock = threading.Lock()
+        running = []
+        done = []
+        threads = set()
+
+        def job(num):
+            with lock:
+                running.append(num)
+                self.assertLessEqual(len(running), 2)
+                threads.add(threading.current_thread())
+            time.sleep(0.01)
+            with lock:
+                running.remove(num)
+                done.append(num)
+
+        for num in range(10):
+            pool.submit(jobs, job, num)
+        jobs.wait()
+        self.assertEqual(sorted(done), list(range(10)))
+        # The same workers ran all the jobs.
+        self.assertLessEqual(len(threads), 2)
+
+        jobs = threadutil.JobGroup()
+        pool.submit(jobs, job, 10)
+        jobs.wait()
+        self.assertLessEqual(len(threads), 2)
+
+    def test_exception(self):
+        pool = threadutil.WorkerPool('Test', 1)
+        jobs = threadutil.JobGroup()
+
+        def fail():
+            raise ValueError("job failed")
+
+        pool.submit(jobs, fail)
+        jobs.wait()
+        thread = threadutil.exitedThreads.get(True, 5)
+        self.assertIsInstance(thread.exit_exception, ValueError)
+        # A new worker runs the next jobs.
+        done = []
+        pool.submit(jobs, done.append, 1)
+        jobs.wait()
+        self.assertEqual(done, [1])
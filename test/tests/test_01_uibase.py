@@ -0,0 +1,66 @@
+import logging
+import threading
+import unittest
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.ui import UI_LIST
+
+
+class Folder:
+    def __init__(self, name):
+        self.name = name
+        self.repository = 'Repo'
+
+    def __str__(self):
+        return self.name
+
+
+class TestUIBaseLogging(unittest.TestCase):
+
+    def setUp(self):
+        config = CustomConfigParser()
+        config.read_string("[general]\nprogressinterval = 3600\n")
+        self.ui = UI_LIST['basic'](config)
+        self.records = []
+        handler = logging.Handler()
+        handler.emit = self.records.append
+        self.ui._addhandler(handler)
+
+    def tearDown(self):
+        self.ui.stoplogwriter()
+        for handler in self.ui.logger.handlers[:]:
+            self.ui.logger.removeHandler(handler)
+
+    def messages(self):
+        self.ui.flushlog()
+        return [record.getMessage() for record in self.records]
+
+    def test_writer_thread(self):
+        self.ui.info("Message %s")
+        self.assertEqual(self.messages(), ["Message %s"])
+        self.assertEqual(self.records[0].threadName,
+                         threading.current_thread().name)
+        self.ui.stoplogwriter()
+        self.ui.info("Synchronous")
+        self.assertEqual(self.messages()[1:], ["Synchronous"])
+
+    def test_debug(self):
+        self.ui.logger.setLevel(logging.DEBUG)
+        self.ui.add_debug('imap')
+        flags = {'S'}
+        self.ui.debug('imap', "Flags %r", flags)
+        self.ui.debug('maildir', "Not logged %s", 1)
+        self.assertIn("[imap]: Flags {'S'}", self.messages())
+        self.assertNotIn("[maildir]: Not logged 1", self.messages())
+        self.assertTrue(self.ui.getThreadDebugLog(
+            threading.current_thread()).endswith(
+            "imap: Flags {'S'}\nmaildir: Not logged 1"))
+
+    def test_progress(self):
+        src, dst = Folder('INBOX'), Folder('Local')
+        for num in range(1, 11):
+            self.ui.copyingmessage(num * 3, num, 10, src, dst)
+        self.assertEqual(
+            [msg for msg in self.messages() if msg.startswith("Copy")],
+            ["Copy messages (1/10) Repo:INBOX -> Repo:Local",
+             "Copy messages (10/10) Repo:INBOX -> Repo:Local"])
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.accounts import Account
+from offlineimap.repository.IMAP import IMAPRepository
+from offlineimap.ui import UI_LIST, setglobalui
+from test import helper
+
+SERVER = os.path.join(os.path.dirname(__file__), '..', 'test_imap_server.py')
+
+
+class TestIMAPRepositoryFolders(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = os.path.join(self.tmpdir, 'state.json')
+        initial = os.path.join(self.tmpdir, 'initial.json')
+        with open(initial, 'w') as f:
+            json.dump(helper.get_sample_imap_data(), f)
+        config = CustomConfigParser()
+        config.read_dict({
+            'general': {'metadata': self.tmpdir, 'dry-run': 'no'},
+            'Account Test': {'localrepository': 'Local',
+                             'remoterepository': 'Remote'},
+            'Repository Remote': {
+                'type': 'IMAP', 'remoteuser': 'test',
+                'remotepass': 'password',
+                'transporttunnel': "'%s' '%s' --initial_mboxes_content '%s' "
+                                   "--encode_str_as utf7m --dump_mbox_filename "
+                                   "'%s' --state_filename '%s'" % (
+                                       sys.executable, SERVER, initial,
+                                       os.path.join(self.tmpdir, 'final.json'),
+                                       self.state)}})
+        self.ui = UI_LIST['quiet'](config)
+        setglobalui(self.ui)
+        account = Account(config, 'Test')
+        os.makedirs(account.getaccountmeta())
+        self.repository = IMAPRepository('Remote', account)
+
+    def tearDown(self):
+        self.repository.dropconnections()
+        self.ui.stoplogwriter()
+        for handler in self.ui.logger.handlers[:]:
+            self.ui.logger.removeHandler(handler)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def inbox(self):
+        for folder in self.repository.getfolders():
+            if folder.getname() == 'INBOX':
+                return folder
+
+    def test_uidvalidity_change(self):
+        inbox = self.inbox()
+        self.assertTrue(inbox.check_uidvalidity())  # Saved.
+        self.repository.forgetfolders()
+        self.assertIs(self.inbox(), inbox)
+        self.assertTrue(inbox.check_uidvalidity())
+
+        # INBOX is recreated on the server between two syncs.
+        self.repository.forgetfolders()
+        with helper.edit_shared_mailboxes(self.state) as state:
+            state['INBOX']['uid_validity'] += 1
+        self.assertIs(self.inbox(), inbox)
+        self.assertFalse(inbox.check_uidvalidity())
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.accounts import Account
+from offlineimap.folder.LocalStatus import LocalStatusFolder
+from offlineimap.repository.LocalStatus import LocalStatusRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+
+class TestLocalStatusAutosave(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = CustomConfigParser()
+        config.read_string("[general]\nmetadata = %s\naccounts = Test\n"
+                           "fsync = false\ndry-run = false\n"
+                           "[Account Test]\n" % self.tmpdir)
+        setglobalui(UI_LIST['quiet'](config))
+        account = Account(config, 'Test')
+        os.makedirs(account.getaccountmeta())
+        self.repository = LocalStatusRepository('Test', account)
+        self.repository.setup_backend('plain')
+        os.makedirs(self.repository.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def reload(self):
+        folder = LocalStatusFolder('INBOX', self.repository)
+        folder.cachemessagelist()
+        return folder.getmessageuidlist()
+
+    def test_autosave(self):
+        folder = LocalStatusFolder('INBOX', self.repository)
+        folder.cachemessagelist()
+        for uid in range(1, 11):
+            folder.savemessage(uid, None, set('S'), 0)
+        # Below the threshold, nothing written yet.
+        self.assertEqual(self.reload(), [])
+        for uid in range(11, folder.autosave_changes + 1):
+            folder.savemessage(uid, None, set('S'), 0)
+        self.assertEqual(len(self.reload()), folder.autosave_changes)
+
+        folder.deletemessage(1)
+        self.assertEqual(len(self.reload()), folder.autosave_changes)
+        folder.dropmessagelistcache()
+        self.assertEqual(len(self.reload()), folder.autosave_changes - 1)